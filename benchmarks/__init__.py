@@ -0,0 +1,16 @@
+"""
+Offline benchmarks of the evaluation scripts.
+
+    python -m benchmarks.run_benchmarks --sizes 1000,100000,1000000 --out benchmarks.json
+
+generates seeded synthetic dialogues/notes (benchmarks.synthetic), times the section tagger, divide_and_output,
+the id validation, cohort aggregation and the end-to-end evaluator pipeline with stand-in model scorers
+(benchmarks.stand_in), and writes the timings as JSON so runs can be compared ( --compare previous.json ).
+"""
+import os
+import sys
+
+# the scripts are standalone modules importing each other by name
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts')
+if SCRIPTS_DIR not in sys.path:
+    sys.path.insert(0, SCRIPTS_DIR)
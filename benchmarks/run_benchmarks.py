@@ -0,0 +1,245 @@
+"""
+Runs the benchmarks at each --sizes number of notes and writes their timings as JSON.
+
+    python -m benchmarks.run_benchmarks --sizes 1000,100000 --benchmarks section_tagger,end_to_end --out new.json
+    python -m benchmarks.run_benchmarks --sizes 1000,100000 --compare new.json
+
+Every benchmark stage is timed with instrumentation.Instrumentation ( seconds, notes per second, peak RSS ).
+"""
+import io
+import os
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import contextlib
+
+from collections import OrderedDict
+
+import numpy as np
+
+from benchmarks import SCRIPTS_DIR
+from benchmarks.synthetic import generate_dataset
+from benchmarks.stand_in import stand_in_scorers
+
+import evaluate_summarization as es
+from instrumentation import Instrumentation
+from sectiontagger import SectionTagger
+from divide_and_output_files import divide_and_output
+from submission_validation import TASKB_PREFIX, validate_file
+from table_io import read_table, write_table
+
+DEFAULT_SIZES = [1000, 100000, 1000000]
+
+
+def bench_section_tagger(df, args, timer):
+    tagger = SectionTagger()
+    notes = df['note'].tolist()
+    with timer.stage('section_tagger') as stage:
+        tagger.divide_many(notes, workers=args.workers)
+        stage['instances'] = len(notes)
+
+
+def bench_divide_and_output(df, args, timer):
+    outdir = tempfile.mkdtemp(prefix='bench_divide_', dir=args.tmp_dir)
+    try:
+        with timer.stage('divide_and_output') as stage:
+            divide_and_output(df[['encounter_id', 'dataset', 'dialogue', 'note']].copy(), outdir, 'bench')
+            stage['instances'] = len(df)
+    finally:
+        shutil.rmtree(outdir)
+
+
+def bench_validate_ids(df, args, timer):
+    """Streams a run file through the submission validation, its ID range widened to the number of notes."""
+    tmpdir = tempfile.mkdtemp(prefix='bench_validate_', dir=args.tmp_dir)
+    try:
+        fn_sys = os.path.join(tmpdir, 'taskB_bench_run1.csv')
+        df_sys = df[['prediction']].rename(columns={'prediction': 'SystemOutput'})
+        df_sys.insert(0, 'TestID', ['%s%07d' % (TASKB_PREFIX, ind) for ind in range(len(df))])
+        df_sys.to_csv(fn_sys, index=False)
+        with timer.stage('validate_ids') as stage:
+            num_rows, errors = validate_file(fn_sys, TASKB_PREFIX, [0, len(df) - 1], num_columns=2)
+            stage['instances'] = num_rows
+        assert len(errors) == 0, errors
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_aggregate(df, args, timer):
+    rng = np.random.default_rng(args.seed)
+    num_notes = len(df)
+    divisions = es.DIVISION_NAMES
+    instance_info = {
+        'id': df['encounter_id'].tolist() * len(divisions),
+        'division': np.repeat(np.arange(len(divisions), dtype=np.int8), num_notes),
+        'dataset': df['dataset'].tolist() * len(divisions),
+        'src_len': rng.integers(50, 1500, num_notes).tolist() * len(divisions),
+    }
+    keys = [key for name in es.SCORERS for key in es.SCORERS[name][3]]
+    all_scores = {key: rng.random(num_notes * len(divisions)) for key in keys}
+
+    with timer.stage('aggregate') as stage:
+        score_keys, scores = es.score_matrix(all_scores)
+        cohorts = es.build_cohorts(instance_info, 'taskB', 512)
+        es.aggregate_cohorts(score_keys, scores, cohorts)
+        stage['instances'] = len(scores)
+    if args.bootstrap > 0:
+        with timer.stage('bootstrap') as stage:
+            es.bootstrap_cohorts(score_keys, scores, cohorts, args.bootstrap, seed=args.seed)
+            stage['instances'] = len(scores)
+
+
+def bench_end_to_end(df, args, timer):
+    """The evaluator's steps for one taskB system ( --input_format files to cohort means ), model scorers stood in."""
+    tmpdir = tempfile.mkdtemp(prefix='bench_e2e_', dir=args.tmp_dir)
+    try:
+        fn_gold = os.path.join(tmpdir, f'gold.{args.input_format}')
+        fn_sys = os.path.join(tmpdir, f'sys.{args.input_format}')
+        write_table(df[['encounter_id', 'note', 'dialogue']].rename(
+            columns={'encounter_id': 'TestID', 'note': 'SystemOutput'}
+        ), fn_gold)
+        write_table(df[['encounter_id', 'prediction']].rename(
+            columns={'encounter_id': 'TestID', 'prediction': 'SystemOutput'}
+        ), fn_sys)
+
+        eval_args = argparse.Namespace(
+            task='taskB', id_column='TestID', note_column='SystemOutput', dialogue_column='dialogue',
+            section_workers=args.workers, metrics=list(es.SCORERS), backends=None, metric_workers=1,
+            metric_cores=None, score_cache=None, score_cache_max_entries=es.DEFAULT_MAX_ENTRIES,
+            max_tokens_per_batch=es.DEFAULT_MAX_TOKENS_PER_BATCH, note_length_cutoff=512, fn_metadata=None,
+            section_scoring='reencode',
+        )
+        loaded = stand_in_scorers(eval_args.metrics)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            with timer.stage('e2e_load_data') as stage:
+                df_references = read_table(fn_gold)
+                df_predictions = read_table(fn_sys)
+                stage['instances'] = len(df_references)
+            with timer.stage('e2e_merge') as stage:
+                full_df = es.merge_inputs(eval_args, df_references, df_predictions)
+                stage['instances'] = len(full_df)
+            with timer.stage('e2e_section_division') as stage:
+                full_df, references, predictions, instance_info = es.build_instances(eval_args, full_df)
+                stage['instances'] = len(full_df)
+            # times score_{name} stages
+            all_scores, _, _, _ = es.score_instances(eval_args, references, predictions, loaded=loaded, timer=timer)
+            with timer.stage('e2e_aggregate') as stage:
+                score_keys, scores = es.score_matrix(all_scores)
+                cohorts = es.build_cohorts(instance_info, 'taskB', eval_args.note_length_cutoff)
+                es.aggregate_cohorts(score_keys, scores, cohorts)
+                stage['instances'] = len(scores)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+BENCHMARKS = OrderedDict([
+    ('section_tagger', bench_section_tagger),
+    ('divide_and_output', bench_divide_and_output),
+    ('validate_ids', bench_validate_ids),
+    ('aggregate', bench_aggregate),
+    ('end_to_end', bench_end_to_end),
+])
+
+
+def parse_list(value):
+    return [item for item in value.split(',') if item != '']
+
+
+def environment():
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=SCRIPTS_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def compare(results, baseline):
+    """Prints the time of every benchmark stage relative to the same stage and size in baseline."""
+    print('stage, notes: seconds (baseline) ratio')
+    for size, timings in results['sizes'].items():
+        for name, stats in timings.items():
+            base = baseline['sizes'].get(size, {}).get(name)
+            if base is None or name == 'total':
+                continue
+            ratio = stats['seconds'] / max(base['seconds'], 1e-9)
+            print(f'\t{name}, {size}: {stats["seconds"]:.3f}s ({base["seconds"]:.3f}s) x{ratio:.2f}')
+
+
+if __name__ == "__main__" :
+    parser = argparse.ArgumentParser(
+        prog='run_benchmarks',
+        description='Benchmarks the evaluation scripts on synthetic notes and writes the timings as JSON.'
+    )
+    parser.add_argument(
+        '--sizes', default=DEFAULT_SIZES, type=lambda value: [int(size) for size in parse_list(value)],
+        help='comma separated numbers of notes to benchmark at (default 1000,100000,1000000).'
+    )
+    parser.add_argument(
+        '--benchmarks', default=list(BENCHMARKS), type=parse_list,
+        help='comma separated benchmarks to run, out of ' + ', '.join(BENCHMARKS) + ' (default all).'
+    )
+    parser.add_argument('--seed', default=0, type=int, help='seed of the synthetic data.')
+    parser.add_argument(
+        '--pool_size', default=None, type=int,
+        help='generate only this many distinct notes and repeat them, to bound memory at large sizes.'
+    )
+    parser.add_argument('--min_sentences', default=1, type=int, help='fewest sentences per note section.')
+    parser.add_argument('--max_sentences', default=4, type=int, help='most sentences per note section.')
+    parser.add_argument('--workers', default=None, type=int, help='section division processes (default cpu count).')
+    parser.add_argument('--bootstrap', default=0, type=int, help='also time --bootstrap with this many resamples.')
+    parser.add_argument(
+        '--input_format', default='csv', choices=['csv', 'parquet', 'arrow'],
+        help='file format of the end_to_end gold and system files.'
+    )
+    parser.add_argument('--tmp_dir', default=None, help='directory for the files written by the benchmarks.')
+    parser.add_argument('--out', default='benchmarks.json', help='JSON file to write the results to.')
+    parser.add_argument('--compare', default=None, help='results JSON of an earlier run to compare against.')
+    args = parser.parse_args()
+
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if len(unknown) > 0:
+        parser.error(f'unknown benchmarks {unknown}, expected some of {list(BENCHMARKS)}')
+
+    results = {'environment': environment(), 'config': vars(args), 'sizes': {}}
+    for size in args.sizes:
+        print(f'Benchmarking {size} notes')
+        timer = Instrumentation()
+        with timer.stage('generate') as stage:
+            df = generate_dataset(
+                size, seed=args.seed, pool_size=args.pool_size,
+                min_sentences=args.min_sentences, max_sentences=args.max_sentences
+            )
+            stage['instances'] = size
+        for name in args.benchmarks:
+            BENCHMARKS[name](df, args, timer)
+        del df
+
+        results['sizes'][str(size)] = timer.summary()
+        for name, stats in results['sizes'][str(size)].items():
+            line = f'\t{name} -> {stats["seconds"]:.2f}s'
+            if 'instances_per_second' in stats:
+                line += f', {stats["instances_per_second"]:.1f} instances/s'
+            if 'peak_rss_mb' in stats:
+                line += f', peak rss {stats["peak_rss_mb"]:.0f}MB'
+            print(line)
+
+    print(f'Saving results to {args.out}')
+    with open(args.out, 'w') as fd:
+        json.dump(results, fd, indent=4)
+
+    if args.compare is not None:
+        with open(args.compare) as fd:
+            compare(results, json.load(fd))
@@ -0,0 +1,39 @@
+"""
+Stand-in for the model scorers ( BERTScore, BLEURT ) so the evaluator pipeline runs offline.
+
+Scores are the token overlap of each pair, cheap but deterministic and proportional to the text lengths,
+returned under the same keys as evaluate's metrics.
+"""
+from evaluate_summarization import SCORERS
+
+
+class StandInScorer:
+
+    config_name = 'stand_in'
+
+    def __init__(self, keys):
+        self.keys = keys
+
+    def compute(self, predictions, references, **kwargs):
+        values = []
+        for ref, pred in zip(references, predictions):
+            ref_tokens = set(ref.lower().split())
+            pred_tokens = set(pred.lower().split())
+            values.append(len(ref_tokens & pred_tokens) / max(len(ref_tokens | pred_tokens), 1))
+        return {key: list(values) for key in self.keys}
+
+
+def stand_in_scorers(names, keep={'rouge': 'native'}):
+    """
+    name -> load_scorer style tuple for score_sequentially( loaded=... ), with stand-ins for every scorer
+    except those in keep, loaded with their keep backend ( the built-in ROUGE needs no download ).
+    """
+    from evaluate_summarization import load_scorer
+    loaded = {}
+    for name in names:
+        if name in keep:
+            loaded[name] = load_scorer(name, keep[name])
+        else:
+            _, kwargs, keys, save_keys = SCORERS[name]
+            loaded[name] = (StandInScorer(keys), kwargs, keys, save_keys)
+    return loaded
@@ -0,0 +1,99 @@
+"""
+Seeded generator of synthetic doctor-patient dialogues and clinical notes.
+
+Notes are built from the section headers of sectiontagger.sectcat2subsections written in the styles found in
+real notes (upper/title/lower case, "HEADER:" on its own line, "Header: text" inline, a bare header line without
+colon, and the case sensitive IMPRESSION), with optional untitled text before the first header and sections
+left out, so every path of the section tagger is exercised. The same seed always gives the same data.
+"""
+import random
+
+from sectiontagger import sectcat2subsections
+
+WORDS = (
+    'patient reports denies pain mild moderate severe knee back chest shoulder left right fever cough week month '
+    'daily history medication dose blood pressure heart rate normal abnormal exam tenderness swelling range motion '
+    'follow up recommend continue start stop labs results x-ray mri imaging diabetes hypertension asthma allergy '
+    'the a of and with for in on no to is was has had will we she he they this that there'
+).split()
+
+CASES = [str.upper, str.title, str.lower]
+
+
+def sentence(rng, min_words=4, max_words=14):
+    words = rng.choices(WORDS, k=rng.randint(min_words, max_words))
+    return ' '.join(words).capitalize() + '.'
+
+
+def header_line(rng, variant):
+    """One section header line in a random style, returned with whether text may follow it on the same line."""
+    case = rng.choice(CASES)
+    base = variant[:-1].strip() if variant.endswith(':') else variant
+    style = rng.randrange(3)
+    if style == 0 and variant.endswith(':'):
+        return case(base) + ':', True
+    if style == 1:
+        return case(base) + ' :', True
+    # bare header alone on its line
+    return case(base), False
+
+
+def generate_note(rng, min_sentences=1, max_sentences=4, skip_rate=0.15, impression_rate=0.2, preamble_rate=0.2):
+    lines = []
+    if rng.random() < preamble_rate:
+        lines.append(sentence(rng))
+    for sectcat, subsections in sectcat2subsections.items():
+        if rng.random() < skip_rate:
+            continue
+        if sectcat == 'assessment_and_plan' and rng.random() < impression_rate:
+            headers = [(rng.choice(['IMPRESSION', 'IMPRESSION:']), False)]
+        else:
+            names = rng.sample(list(subsections), k=rng.randint(1, len(subsections)))
+            headers = [header_line(rng, rng.choice(subsections[name])) for name in names]
+        for header, inline in headers:
+            body = [sentence(rng) for _ in range(rng.randint(min_sentences, max_sentences))]
+            if inline and rng.random() < 0.5:
+                lines.append(header + ' ' + body.pop(0))
+            else:
+                lines.append(header)
+            lines.extend(body)
+    if len(lines) == 0:
+        # every section skipped, an empty note would read back from csv as NaN
+        lines.append(sentence(rng))
+    return '\n'.join(lines)
+
+
+def generate_dialogue(rng, min_turns=4, max_turns=20):
+    turns = []
+    for ind in range(rng.randint(min_turns, max_turns)):
+        speaker = '[doctor]' if ind % 2 == 0 else '[patient]'
+        turns.append(speaker + ' ' + ' '.join(sentence(rng) for _ in range(rng.randint(1, 3))))
+    return '\n'.join(turns)
+
+
+def perturb_note(rng, note, rate=0.1):
+    """A system output for a note: the note with a fraction of its words replaced."""
+    words = note.split(' ')
+    for ind in range(len(words)):
+        if rng.random() < rate:
+            words[ind] = rng.choice(WORDS)
+    return ' '.join(words)
+
+
+def generate_dataset(num_notes, seed=0, pool_size=None, datasets=('virtassist', 'virtscribe', 'aci'), **lengths):
+    """
+    Returns a DataFrame of num_notes rows with encounter_id, dataset, dialogue, note and prediction columns.
+    With pool_size, only that many distinct notes are generated and repeated, which keeps memory small
+    for very large num_notes. lengths are passed on to generate_note ( min_sentences, max_sentences ... ).
+    """
+    import pandas as pd
+    rng = random.Random(seed)
+    num_distinct = num_notes if pool_size is None else min(pool_size, num_notes)
+    rows = []
+    for _ in range(num_distinct):
+        note = generate_note(rng, **lengths)
+        rows.append((rng.choice(datasets), generate_dialogue(rng), note, perturb_note(rng, note)))
+    rows = [rows[ind % num_distinct] for ind in range(num_notes)]
+    df = pd.DataFrame(rows, columns=['dataset', 'dialogue', 'note', 'prediction'])
+    df.insert(0, 'encounter_id', ['D2N%07d' % ind for ind in range(num_notes)])
+    return df
@@ -0,0 +1,251 @@
+"""
+CPU-optimized scorer backends, selected per metric with evaluate_summarization.py --backends:
+
+    bert_scorer=int8       BERTScore with the linear layers of the encoder dynamically quantized to int8 (torch)
+    bert_scorer=onnx       BERTScore with the encoder exported to ONNX and run by ONNX Runtime
+    bert_scorer=onnx-int8  the ONNX export with its weights quantized to int8 by ONNX Runtime
+    bluert=d12, d6, d3     the distilled BLEURT-20-D12/D6/D3 checkpoints in place of BLEURT-20
+
+The onnx backends need onnxruntime ( and onnx-int8 also onnx ), which are optional and not installed by
+install_evalvenv.sh, see requirements.txt; --backends refuses these backends when they are missing.
+
+The encoder is exported once per model and layer into the directory of the BERTSCORE_ONNX_DIR environment
+variable ( ~/.cache/bertscore_onnx by default ) and reused by later runs. These backends trade some accuracy for
+speed and memory, so how far their scores drift from the reference backend ( the default of each metric ) is
+measured on a run's instances with
+
+    python cpu_backends.py --fn_gold gold.csv --fn_sys run.csv --backends bert_scorer=int8,bluert=d6 --report drift.json
+
+tests/test_cpu_backends.py checks the BERTScore backends against the full-precision encoder on a tiny randomly
+initialized BERT written locally, without downloading a model.
+"""
+import os
+import json
+import argparse
+
+import numpy as np
+
+from embedding_store import DEFAULT_MODEL_TYPE, BertEncoder, score_pairs
+
+ONNX_DIR_ENV = 'BERTSCORE_ONNX_DIR'
+DEFAULT_ONNX_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'bertscore_onnx')
+ONNX_OPSET = 14
+
+
+class EncodedBertScore:
+    """
+    BERTScore computed from the token embeddings of a BertEncoder, a drop-in for evaluate's bertscore compute.
+    Subclasses change how the encoder runs in make_encoder.
+    """
+    config_name = 'encoder'
+
+    def __init__(self):
+        self.encoder = None
+
+    def make_encoder(self, model_type, num_layers, device):
+        return BertEncoder(model_type, num_layers, device=device)
+
+    def compute(self, predictions, references, model_type=None, num_layers=None, idf=False, device=None,
+                batch_size=64, **kwargs):
+        if idf:
+            raise ValueError(f'the {self.config_name} bert_scorer backend does not weight tokens by idf')
+        model_type = model_type or DEFAULT_MODEL_TYPE
+        if self.encoder is None or self.encoder.model_type != model_type or num_layers not in [None, self.encoder.num_layers]:
+            self.encoder = self.make_encoder(model_type, num_layers, device or 'cpu')
+        return score_pairs(self.encoder, references, predictions, batch_size)
+
+
+class QuantizedBertScore(EncodedBertScore):
+    """BERTScore with the encoder's linear layers quantized to int8 as it is loaded ( torch dynamic quantization )."""
+    config_name = 'int8'
+
+    def make_encoder(self, model_type, num_layers, device):
+        import torch
+        # quantized kernels only run on the cpu
+        encoder = BertEncoder(model_type, num_layers, device='cpu')
+        encoder.model = torch.quantization.quantize_dynamic(encoder.model, {torch.nn.Linear}, dtype=torch.qint8)
+        return encoder
+
+
+class OnnxEncoderModel:
+    """An exported encoder run by ONNX Runtime, called as bert_score calls the model: (hidden states,) of a batch."""
+
+    def __init__(self, path):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        # the thread limit evaluate_summarization sets for torch ( limit_threads ) holds for ONNX Runtime too
+        if os.environ.get('OMP_NUM_THREADS') is not None:
+            options.intra_op_num_threads = int(os.environ['OMP_NUM_THREADS'])
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+    def eval(self):
+        return self
+
+    def __call__(self, input_ids, attention_mask=None, output_hidden_states=False, **kwargs):
+        import torch
+        if output_hidden_states:
+            raise ValueError('the ONNX export only has the hidden states of the scoring layer')
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        outputs = self.session.run(['hidden_states'], {
+            'input_ids': input_ids.cpu().numpy().astype(np.int64),
+            'attention_mask': attention_mask.cpu().numpy().astype(np.int64),
+        })
+        return (torch.from_numpy(outputs[0]),)
+
+
+def onnx_path(model_type, num_layers, quantize=False):
+    directory = os.environ.get(ONNX_DIR_ENV, DEFAULT_ONNX_DIR)
+    name = f'{model_type.strip("/").replace("/", "--")}-L{num_layers}{"-int8" if quantize else ""}.onnx'
+    return os.path.join(directory, name)
+
+
+def export_onnx(model, path):
+    """Exports the hidden states of a bert_score model ( truncated to its scoring layer ) to an ONNX file at path."""
+    import torch
+
+    class _HiddenStates(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask):
+            return self.model(input_ids, attention_mask=attention_mask)[0]
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    dummy = torch.ones((2, 8), dtype=torch.long)
+    axes = {0: 'batch', 1: 'tokens'}
+    # written then renamed, so that a run stopped part way never leaves a broken export to be reused
+    with torch.no_grad():
+        torch.onnx.export(
+            _HiddenStates(model.eval()), (dummy, dummy), path + '.tmp', opset_version=ONNX_OPSET,
+            input_names=['input_ids', 'attention_mask'], output_names=['hidden_states'],
+            dynamic_axes={'input_ids': axes, 'attention_mask': axes, 'hidden_states': axes},
+        )
+    os.replace(path + '.tmp', path)
+
+
+def quantize_onnx(path, quantized_path):
+    """Writes the int8 weight quantization of the ONNX model at path ( ONNX Runtime dynamic quantization )."""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    quantize_dynamic(path, quantized_path + '.tmp', weight_type=QuantType.QInt8)
+    os.replace(quantized_path + '.tmp', quantized_path)
+
+
+class OnnxBertScore(EncodedBertScore):
+    """BERTScore with the encoder run by ONNX Runtime, exported ( and quantized to int8 ) on first use of a model."""
+
+    def __init__(self, quantize=False):
+        super().__init__()
+        self.quantize = quantize
+        self.config_name = 'onnx-int8' if quantize else 'onnx'
+
+    def make_encoder(self, model_type, num_layers, device):
+        # tokenizer and idf weights as bert_score has them, the torch model is only kept to export it
+        encoder = BertEncoder(model_type, num_layers, device='cpu')
+        path = onnx_path(model_type, encoder.num_layers)
+        if not os.path.exists(path):
+            print(f'Exporting {model_type} layer {encoder.num_layers} to {path}')
+            export_onnx(encoder.model, path)
+        if self.quantize:
+            quantized_path = onnx_path(model_type, encoder.num_layers, quantize=True)
+            if not os.path.exists(quantized_path):
+                quantize_onnx(path, quantized_path)
+            path = quantized_path
+        encoder.model = OnnxEncoderModel(path)
+        return encoder
+
+
+def drift_report(keys, scores, reference_scores, divisions):
+    """How far a backend's per-instance scores are from the reference backend's, see division_deviations."""
+    import evaluate_summarization as es
+    return es.division_deviations(
+        keys, scores, reference_scores, divisions, mean_names=('backend_mean', 'reference_mean')
+    )
+
+
+def backend_drift(args, timer):
+    """Scores the instances of a run with the reference and the selected backend of every --backends metric."""
+    import evaluate_summarization as es
+    from table_io import read_table
+
+    full_df = es.merge_inputs(args, read_table(args.fn_gold), read_table(args.fn_sys))
+    _, references, predictions, instance_info = es.build_instances(args, full_df)
+    plan = es.plan_scoring(references, predictions)
+    cohorts = es.build_cohorts(instance_info, args.task, args.note_length_cutoff)
+
+    report = {'instances': len(references), 'metrics': {}}
+    for name, backend in args.backends.items():
+        reference = args.reference_backends.get(name, next(iter(es.SCORERS[name][0])))
+        scores = {}
+        for label in [reference, backend]:
+            print(f'Scoring {name} with the {label} backend')
+            with timer.stage(f'load_{name}_{label}'):
+                scorer, kwargs, keys, _ = es.load_scorer(name, label)
+            with timer.stage(f'score_{name}_{label}') as stage:
+                scores[label], num_scored = es.compute_scores(
+                    name, scorer, kwargs, keys, plan, max_tokens_per_batch=args.max_tokens_per_batch
+                )
+                stage['instances'] = num_scored
+            # one model in memory at a time
+            del scorer
+        stages = timer.summary()
+        seconds = {label: stages[f'score_{name}_{label}']['seconds'] for label in [reference, backend]}
+        means = {label: es.aggregate_cohorts(*es.score_matrix(scores[label]), cohorts) for label in [reference, backend]}
+        report['metrics'][name] = {
+            'backend': backend,
+            'reference': reference,
+            'divisions': drift_report(keys, scores[backend], scores[reference], instance_info['division']),
+            # cohort means as [backend, reference], as a leaderboard would show them
+            'cohorts': {
+                cohort: {key: [means[backend][cohort][key], means[reference][cohort][key]] for key in keys}
+                for cohort, _ in cohorts
+            },
+            'speedup': seconds[reference] / max(seconds[backend], 1e-9),
+            'peak_rss_mb': {label: stages[f'score_{name}_{label}'].get('peak_rss_mb') for label in [reference, backend]},
+        }
+    report['timings'] = timer.summary()
+    return report
+
+
+if __name__ == "__main__":
+    import evaluate_summarization as es
+    from instrumentation import Instrumentation
+
+    parser = argparse.ArgumentParser(
+        prog='cpu_backends',
+        description='Reports how far the scores of CPU-optimized backends are from the reference backends on a run.'
+    )
+    parser.add_argument('--fn_gold', required=True, help='filename of gold references requires id and note column.')
+    parser.add_argument('--fn_sys', required=True, help='filename of system references requires id and note column.')
+    parser.add_argument('--task', action='store', default='taskB', help='summarization task, as evaluate_summarization.')
+    parser.add_argument('--id_column', default='TestID', help='column to use for identifying id.')
+    parser.add_argument('--note_column', default='SystemOutput', help='column to use for identifying note.')
+    parser.add_argument('--dialogue_column', default='dialogue', help='column to use for identifying dialogue.')
+    parser.add_argument('--section_workers', default=None, type=int, help='processes used for section division.')
+    parser.add_argument('--note_length_cutoff', default=512, type=int, help='source words of the shorter-src cohort.')
+    parser.add_argument(
+        '--backends', default='bert_scorer=int8', type=es.parse_backends,
+        help='backend per scorer to compare with its reference, e.g. bert_scorer=onnx,bluert=d6 (default bert_scorer=int8).'
+    )
+    parser.add_argument(
+        '--reference_backends', default={}, type=es.parse_backends,
+        help='backend per scorer to compare against (default the scorer default, e.g. bert_scorer=huggingface).'
+    )
+    parser.add_argument(
+        '--max_tokens_per_batch', default=es.DEFAULT_MAX_TOKENS_PER_BATCH, type=int,
+        help='BERTScore/BLEURT batching, as evaluate_summarization.'
+    )
+    parser.add_argument('--report', default='backend_drift.json', help='JSON file to write the report to.')
+    args = parser.parse_args()
+
+    report = backend_drift(args, Instrumentation())
+    with open(args.report, 'w') as fd:
+        json.dump(report, fd, indent=4)
+    for name, obj in report['metrics'].items():
+        print(f'{name}: {obj["backend"]} against {obj["reference"]}, {obj["speedup"]:.2f}x the speed')
+        for division, vals in obj['divisions'].items():
+            for key, stats in vals.items():
+                print(f'\t{division} {key}: mean |diff| {stats["mean_abs_diff"]:.4f}, max |diff| {stats["max_abs_diff"]:.4f}, '
+                      f'mean {stats["backend_mean"]:.4f} vs {stats["reference_mean"]:.4f}')
+    print(f'Report saved to {args.report}')
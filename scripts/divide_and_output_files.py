@@ -3,21 +3,43 @@ This is a courtesy script divides src/tgt text into seperate text files.
 Order of the original dataframe is preserved.
 
 Text files are also outputted for ease of browsing.
+With --format shards, the transcripts/reports are instead packed into jsonl shards with an index,
+with --format parquet into one Parquet file.
+The input may also be a Parquet or Arrow IPC file ( by extension ), read memory-mapped.
 
 Everything will be outputted in the same directory as the original file.
 """
 import sys
 import os
 import re
+import json
+import locale
+import argparse
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 
+from table_io import read_table, is_arrow, to_object_strings
+
 #metadata_columns = [  'dataset', 'encounter_id' ]
 TRANSCRIPT_COLUMN = 'dialogue'
 NOTE_COLUMN = 'note'
 
+SEPARATOR = '\x00'
+SPACES = re.compile( '[ ]+' )
+
+#threads writing the per-encounter files, files written per task, and how many files may wait for them
+DEFAULT_WRITERS = 8
+DEFAULT_BATCH_SIZE = 256
+DEFAULT_QUEUE_SIZE = 4096
+#encounters per jsonl shard with --format shards
+DEFAULT_SHARD_SIZE = 10000
 
-def divide_and_output( df, outdir, prefix, id_column='encounter_id' ) :
+
+def divide_and_output( df, outdir, prefix, id_column='encounter_id', output_format='files', workers=DEFAULT_WRITERS,
+                       shard_size=DEFAULT_SHARD_SIZE ) :
 
     columns = df.columns
     metadata_columns = [ x for x in columns if x not in [ TRANSCRIPT_COLUMN, NOTE_COLUMN ] ]
@@ -27,51 +49,162 @@ def divide_and_output( df, outdir, prefix, id_column='encounter_id' ) :
 
     #output src and targets
     if TRANSCRIPT_COLUMN in columns :
-        df[ TRANSCRIPT_COLUMN ].apply( lambda x: re.sub( '[ ]+', ' ', x.replace( '\n', ' ' ) ) ).to_csv( '%s/%s.src' %( outdir, prefix ), header=False, index=False )
+        normalize( df[ TRANSCRIPT_COLUMN ], ' ' ).to_csv( '%s/%s.src' %( outdir, prefix ), header=False, index=False )
     if NOTE_COLUMN in columns :
-        df[ NOTE_COLUMN ].apply( lambda x: re.sub( '[ ]+', ' ', x.replace( '\n', ' __lf1__ ' ) ) ).to_csv( '%s/%s.tgt' %( outdir, prefix ), header=False, index=False )
+        normalize( df[ NOTE_COLUMN ], ' __lf1__ ' ).to_csv( '%s/%s.tgt' %( outdir, prefix ), header=False, index=False )
 
     #create folder to output text files
     os.makedirs( '%s/output/%s' %( outdir, prefix ), exist_ok=True )
 
-    for _, row in df.iterrows() :
+    if output_format == 'shards' :
+        write_shards( df, '%s/output/%s' %( outdir, prefix ), id_column, shard_size=shard_size, workers=workers )
+        return
+    if output_format == 'parquet' :
+        encounter_records( df, id_column ).to_parquet( '%s/output/%s/%s.parquet' %( outdir, prefix, prefix ), index=False )
+        return
 
-        encounter_id = row[ id_column ]
+    #later rows overwrite earlier ones with the same id, keep only the last text per file so concurrent writes can't reorder them
+    fn2text = {}
+    encounter_ids = df[ id_column ].tolist()
+    if TRANSCRIPT_COLUMN in columns :
+        for encounter_id, dialogue in zip( encounter_ids, df[ TRANSCRIPT_COLUMN ].tolist() ) :
+            fn2text[ '%s/output/%s/%s.transcript.txt' %( outdir, prefix, encounter_id ) ] = dialogue
 
-        if TRANSCRIPT_COLUMN in columns :
-            dialogue = row[ 'dialogue' ]
-            fn = '%s/output/%s/%s.transcript.txt' %( outdir, prefix, encounter_id )
-            write_file( dialogue, fn )
+    if NOTE_COLUMN in columns :
+        for encounter_id, note in zip( encounter_ids, df[ NOTE_COLUMN ].tolist() ) :
+            fn2text[ '%s/output/%s/%s.report.txt' %( outdir, prefix, encounter_id ) ] = note
 
-        if NOTE_COLUMN in columns :
-            note = row[ 'note' ]
-            fn = '%s/output/%s/%s.report.txt' %( outdir, prefix, encounter_id )
-            write_file( note, fn )
+    write_files( fn2text, workers=workers )
 
 
-def write_file( text, fn ) :
-    with open( fn, 'w' ) as f :
-        f.write( text )
+def normalize( texts, newline ) :
+    """
+    Same as re.sub( '[ ]+', ' ', x.replace( '\n', newline ) ) on every row.
+    The rows are joined on a NUL separator and normalized in one pass, none of the replacements can cross it.
+    """
+    values = texts.tolist()
+    if all( type( x ) is str and SEPARATOR not in x for x in values ) :
+        joined = SPACES.sub( ' ', SEPARATOR.join( values ).replace( '\n', newline ) )
+        return pd.Series( joined.split( SEPARATOR ) if len( values ) > 0 else [], index=texts.index, dtype=object )
+    return texts.str.replace( '\n', newline, regex=False ).str.replace( '[ ]+', ' ', regex=True )
+
+
+def write_batch( batch, encoding ) :
+    #os level writes of pre-encoded text, same bytes as open( fn, 'w' ).write( text )
+    for fn, text in batch :
+        data = text.encode( encoding )
+        fd = os.open( fn, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666 )
+        try :
+            #os.write may write less than asked for large texts
+            view = memoryview( data )
+            while len( view ) > 0 :
+                view = view[ os.write( fd, view ): ]
+        finally :
+            os.close( fd )
+
+
+def write_files( fn2text, workers=DEFAULT_WRITERS, queue_size=DEFAULT_QUEUE_SIZE, batch_size=DEFAULT_BATCH_SIZE ) :
+    """
+    Writes every text to its file from a pool of threads, batch_size files per task.
+    At most queue_size files are queued at once, the first failed write is raised once the rest are done.
+    """
+    encoding = locale.getpreferredencoding( False )
+    slots = threading.BoundedSemaphore( max( queue_size // batch_size, 1 ) )
+    errors = []
+
+    def _done( future ) :
+        slots.release()
+        if future.exception() is not None :
+            errors.append( future.exception() )
+
+    items = list( fn2text.items() )
+    with ThreadPoolExecutor( max_workers=workers ) as pool :
+        for start in range( 0, len( items ), batch_size ) :
+            slots.acquire()
+            if len( errors ) > 0 :
+                slots.release()
+                break
+            pool.submit( write_batch, items[ start : start + batch_size ], encoding ).add_done_callback( _done )
+
+    if len( errors ) > 0 :
+        raise errors[0]
+
+
+def encounter_records( df, id_column ) :
+    """encounter_id, transcript and report columns of every encounter, the latter two only for the columns present."""
+    records = pd.DataFrame( { 'encounter_id': df[ id_column ].values } )
+    if TRANSCRIPT_COLUMN in df.columns :
+        records[ 'transcript' ] = df[ TRANSCRIPT_COLUMN ].values
+    if NOTE_COLUMN in df.columns :
+        records[ 'report' ] = df[ NOTE_COLUMN ].values
+    return records
+
+
+def write_shards( df, shard_dir, id_column, shard_size=DEFAULT_SHARD_SIZE, workers=DEFAULT_WRITERS ) :
+    """
+    Packs the transcript/report of every encounter into shard-NNNNN.jsonl files of shard_size lines
+    ( {"encounter_id", "transcript", "report"}, keys only for the columns present ) and writes index.csv
+    mapping each encounter to its shard, byte offset and byte length.
+    """
+    records = encounter_records( df, id_column )
+
+    def _write_shard( shard_num ) :
+        shard = records.iloc[ shard_num * shard_size : ( shard_num + 1 ) * shard_size ]
+        fn = 'shard-%05d.jsonl' %shard_num
+        index = []
+        offset = 0
+        with open( os.path.join( shard_dir, fn ), 'wb' ) as f :
+            for record in shard.to_dict( 'records' ) :
+                line = ( json.dumps( record, default=str ) + '\n' ).encode( 'utf-8' )
+                f.write( line )
+                index.append( ( record[ 'encounter_id' ], fn, offset, len( line ) ) )
+                offset += len( line )
+        return index
+
+    num_shards = ( len( records ) + shard_size - 1 ) // shard_size
+    with ThreadPoolExecutor( max_workers=workers ) as pool :
+        indexes = list( pool.map( _write_shard, range( num_shards ) ) )
+
+    index = pd.DataFrame( [ row for shard_index in indexes for row in shard_index ], columns=[ 'encounter_id', 'shard', 'offset', 'length' ] )
+    index.to_csv( os.path.join( shard_dir, 'index.csv' ), index=False )
+
+
+def read_shard_record( shard_dir, shard, offset, length ) :
+    """Reads back one encounter of write_shards from its index.csv entry."""
+    with open( os.path.join( shard_dir, shard ), 'rb' ) as f :
+        f.seek( offset )
+        return json.loads( f.read( length ) )
 
 
 if __name__ == "__main__" :
     """
-    Assumes input is *.csv according to prepared files (which may have extra metadata in addition to either
-    dialogue note, or both ).
+    Assumes input is *.csv ( or *.parquet / *.arrow ) according to prepared files (which may have extra metadata
+    in addition to either dialogue note, or both ).
     Will output to same directory as file.
     """
-    if len( sys.argv ) > 1 :
-        fn = sys.argv[1]
-        id_column = [ sys.argv[2] if len(sys.argv)>2 else 'encounter_id' ][0]
-    else :
-        print( 'usage: python divide_and_output_files.py <*.csv>')
+    if len( sys.argv ) == 1 :
+        print( 'usage: python divide_and_output_files.py <*.csv> [id_column] [--format files|shards|parquet]')
         sys.exit( 0 )
-    
+
+    parser = argparse.ArgumentParser( prog='divide_and_output_files' )
+    parser.add_argument( 'fn', help='input csv, or Parquet/Arrow IPC file' )
+    parser.add_argument( 'id_column', nargs='?', default='encounter_id', help='column naming the per-encounter files' )
+    parser.add_argument( '--format', dest='output_format', default='files', choices=[ 'files', 'shards', 'parquet' ],
+                         help='one text file per transcript/report (default), packed jsonl shards with an index, or one Parquet file' )
+    parser.add_argument( '--workers', default=DEFAULT_WRITERS, type=int, help='threads writing the output files' )
+    parser.add_argument( '--shard_size', default=DEFAULT_SHARD_SIZE, type=int, help='encounters per shard with --format shards' )
+    args = parser.parse_args()
+    fn = args.fn
+
     file_dir = os.path.dirname( fn )
     prefix = fn.split( '/' )[-1].replace( '.csv', '' )
+    if is_arrow( fn ) :
+        prefix = os.path.splitext( fn.split( '/' )[-1] )[0]
 
     print( 'input csv: %s' %fn )
     print( 'outputting to: %s' %file_dir )
 
-    df = pd.read_csv( fn )
-    divide_and_output( df, file_dir, prefix, id_column=id_column )
\ No newline at end of file
+    #arrow string columns as the object columns of a csv read, the outputs are the same for either input
+    df = to_object_strings( read_table( fn ) )
+    divide_and_output( df, file_dir, prefix, id_column=args.id_column, output_format=args.output_format,
+                       workers=args.workers, shard_size=args.shard_size )
@@ -0,0 +1,276 @@
+"""
+Memory-mapped store of BERTScore reference embeddings.
+
+Gold references rarely change between runs, so their token embeddings are computed once:
+
+    python embedding_store.py --fn_gold gold.csv --store gold_bertscore
+
+encodes every gold note (and, for taskB, each of its section divisions) and writes the normalized token
+embeddings of all texts back to back into one flat array file, their idf weights into another, and an index
+of text hash -> (first row, number of rows). The 'store' bert_scorer backend of evaluate_summarization.py
+(--bertscore_store) then only encodes the predictions and does BERTScore's greedy matching against the
+memory-mapped reference rows, which every evaluator process reading the store shares through the page cache.
+"""
+import os
+import json
+import hashlib
+import argparse
+
+from collections import defaultdict
+
+import numpy as np
+
+DEFAULT_MODEL_TYPE = 'microsoft/deberta-xlarge-mnli'
+
+EMBEDDINGS_FILE = 'embeddings.bin'
+WEIGHTS_FILE = 'weights.bin'
+INDEX_FILE = 'index.json'
+META_FILE = 'meta.json'
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class BertEncoder:
+    """
+    Token embeddings and weights exactly as bert_score computes them for BERTScorer.score,
+    with the embeddings already normalized as in its greedy matching.
+    """
+
+    def __init__(self, model_type=DEFAULT_MODEL_TYPE, num_layers=None, device='cpu', idf_weights=None):
+        import torch
+        from bert_score.utils import get_model, get_tokenizer, model2layers
+
+        self.model_type = model_type
+        self.num_layers = num_layers or model2layers[model_type]
+        self.device = device
+        self.tokenizer = get_tokenizer(model_type)
+        self.model = get_model(model_type, self.num_layers, all_layers=False)
+        self.model.to(device)
+
+        # idf_weights ( token id -> weight, and a 'default' ) as written by build_store with --idf
+        if idf_weights is None:
+            self.idf_dict = defaultdict(lambda: 1.0)
+        else:
+            default = idf_weights['default']
+            self.idf_dict = defaultdict(lambda: default)
+            self.idf_dict.update({int(tok): weight for tok, weight in idf_weights['tokens'].items()})
+        self.idf_dict[self.tokenizer.sep_token_id] = 0
+        self.idf_dict[self.tokenizer.cls_token_id] = 0
+        self._torch = torch
+
+    def encode(self, texts, batch_size=64):
+        """Returns (float32 embeddings [tokens x dim], float32 idf weights [tokens]) for each text."""
+        from bert_score.utils import get_bert_embedding
+
+        # longest first like bert_score, so each batch pads to similar lengths
+        order = sorted(range(len(texts)), key=lambda ind: len(texts[ind].split(' ')), reverse=True)
+        encoded = [None] * len(texts)
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            embs, masks, idfs = get_bert_embedding(
+                [texts[ind] for ind in batch], self.model, self.tokenizer, self.idf_dict, device=self.device
+            )
+            embs = embs / self._torch.norm(embs, dim=-1, keepdim=True)
+            embs = embs.cpu().numpy().astype(np.float32)
+            lens = masks.sum(dim=1).cpu().tolist()
+            idfs = idfs.cpu().numpy().astype(np.float32)
+            for pos, ind in enumerate(batch):
+                encoded[ind] = (embs[pos, :lens[pos]], idfs[pos, :lens[pos]])
+        return encoded
+
+
+def greedy_match(ref_emb, ref_weights, hyp_emb, hyp_weights):
+    """BERTScore precision, recall and F1 of one pair from normalized token embeddings and idf weights."""
+    # only [CLS] and [SEP], bert_score scores the pair 0
+    if len(ref_emb) <= 2 or len(hyp_emb) <= 2:
+        return 0.0, 0.0, 0.0
+    sim = hyp_emb @ ref_emb.T
+    precision = float((sim.max(axis=1) * hyp_weights).sum() / hyp_weights.sum())
+    recall = float((sim.max(axis=0) * ref_weights).sum() / ref_weights.sum())
+    if precision + recall == 0:
+        return precision, recall, 0.0
+    return precision, recall, 2 * precision * recall / (precision + recall)
+
+
+def score_pairs(encoder, references, predictions, batch_size=64):
+    """BERTScore precision, recall and f1 lists of the pairs from a BertEncoder, every distinct text encoded once."""
+    texts = list(dict.fromkeys(list(references) + list(predictions)))
+    encoded = dict(zip(texts, encoder.encode(texts, batch_size=batch_size)))
+    results = {'precision': [], 'recall': [], 'f1': []}
+    for ref, pred in zip(references, predictions):
+        for key, val in zip(['precision', 'recall', 'f1'], greedy_match(*encoded[ref], *encoded[pred])):
+            results[key].append(val)
+    return results
+
+
+class EmbeddingStore:
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(os.path.join(path, META_FILE)):
+            raise ValueError(f'{path} is not a complete embedding store, rebuild it with embedding_store.py')
+        with open(os.path.join(path, META_FILE)) as fd:
+            self.meta = json.load(fd)
+        with open(os.path.join(path, INDEX_FILE)) as fd:
+            self.index = json.load(fd)
+
+        num_tokens = self.meta['num_tokens']
+        dim = self.meta['dim']
+        if num_tokens == 0:
+            self.embeddings = np.zeros((0, dim), dtype=self.meta['dtype'])
+            self.weights = np.zeros(0, dtype=np.float32)
+        else:
+            self.embeddings = np.memmap(
+                os.path.join(path, EMBEDDINGS_FILE), dtype=self.meta['dtype'], mode='r', shape=(num_tokens, dim)
+            )
+            self.weights = np.memmap(os.path.join(path, WEIGHTS_FILE), dtype=np.float32, mode='r', shape=(num_tokens,))
+
+    def __contains__(self, text):
+        return text_hash(text) in self.index
+
+    def get(self, text):
+        """Returns the stored (embeddings, weights) of text as memory-mapped views, or None if it is not stored."""
+        entry = self.index.get(text_hash(text))
+        if entry is None:
+            return None
+        start, length = entry
+        return self.embeddings[start:start + length], self.weights[start:start + length]
+
+
+def build_store(path, texts, encoder, dtype='float16', batch_size=64, idf_weights=None):
+    """Encodes the distinct texts and writes them as an EmbeddingStore at path, appending one batch at a time."""
+    os.makedirs(path, exist_ok=True)
+    # a store without its meta file is treated as incomplete, so drop it before rewriting the arrays
+    if os.path.exists(os.path.join(path, META_FILE)):
+        os.remove(os.path.join(path, META_FILE))
+
+    texts = list(dict.fromkeys(texts))
+    index = {}
+    num_tokens = 0
+    dim = 0
+    with open(os.path.join(path, EMBEDDINGS_FILE), 'wb') as emb_fd, open(os.path.join(path, WEIGHTS_FILE), 'wb') as w_fd:
+        for start in range(0, len(texts), batch_size):
+            batch = texts[start:start + batch_size]
+            for text, (emb, weights) in zip(batch, encoder.encode(batch, batch_size=batch_size)):
+                emb_fd.write(emb.astype(dtype).tobytes())
+                w_fd.write(weights.astype(np.float32).tobytes())
+                index[text_hash(text)] = [num_tokens, len(emb)]
+                num_tokens += len(emb)
+                dim = emb.shape[1]
+            print(f'Encoded {min(start + batch_size, len(texts))}/{len(texts)} texts')
+
+    with open(os.path.join(path, INDEX_FILE), 'w') as fd:
+        json.dump(index, fd)
+    meta = {
+        'model_type': encoder.model_type,
+        'num_layers': encoder.num_layers,
+        'dtype': dtype,
+        'dim': dim,
+        'num_texts': len(index),
+        'num_tokens': num_tokens,
+        'idf': idf_weights is not None,
+        'idf_weights': idf_weights,
+    }
+    with open(os.path.join(path, META_FILE), 'w') as fd:
+        json.dump(meta, fd)
+    return EmbeddingStore(path)
+
+
+class StoredBertScore:
+    """
+    BERTScore with the references looked up in an EmbeddingStore, a drop-in for evaluate's bertscore compute.
+    References missing from the store are encoded on the fly.
+    """
+
+    def __init__(self, path):
+        self.store = EmbeddingStore(path)
+        meta = self.store.meta
+        self.config_name = f'store-{meta["model_type"]}-{meta["num_layers"]}-{meta["dtype"]}-idf{int(meta["idf"])}'
+        self.encoder = None
+        self.stats = {'stored_references': 0, 'encoded_references': 0}
+
+    def compute(self, predictions, references, model_type=None, num_layers=None, idf=False, device=None,
+                batch_size=64, **kwargs):
+        meta = self.store.meta
+        if model_type not in [None, meta['model_type']] or num_layers not in [None, meta['num_layers']]:
+            raise ValueError(f'{self.store.path} holds {meta["model_type"]} layer {meta["num_layers"]} embeddings')
+        if bool(idf) != meta['idf']:
+            raise ValueError(f'{self.store.path} was built with idf={meta["idf"]}, not idf={idf}')
+        if self.encoder is None:
+            self.encoder = BertEncoder(
+                meta['model_type'], meta['num_layers'], device=device or 'cpu', idf_weights=meta['idf_weights']
+            )
+
+        ref_stats = {}
+        for ref in dict.fromkeys(references):
+            ref_stats[ref] = self.store.get(ref)
+        missing = [ref for ref, stats in ref_stats.items() if stats is None]
+        self.stats['stored_references'] += len(ref_stats) - len(missing)
+        self.stats['encoded_references'] += len(missing)
+
+        to_encode = list(dict.fromkeys(missing + list(predictions)))
+        encoded = dict(zip(to_encode, self.encoder.encode(to_encode, batch_size=batch_size)))
+        ref_stats.update({ref: encoded[ref] for ref in missing})
+
+        results = {'precision': [], 'recall': [], 'f1': []}
+        for ref, pred in zip(references, predictions):
+            ref_emb, ref_weights = ref_stats[ref]
+            hyp_emb, hyp_weights = encoded[pred]
+            scores = greedy_match(np.asarray(ref_emb, dtype=np.float32), ref_weights, hyp_emb, hyp_weights)
+            for key, val in zip(['precision', 'recall', 'f1'], scores):
+                results[key].append(val)
+        return results
+
+
+def gold_texts(args):
+    """The gold notes and, for taskB, their section divisions as evaluate_summarization scores them."""
+    from table_io import read_table, to_object_strings
+    from evaluate_summarization import divide_references, EMPTY_SECTION
+
+    df_references, reference_spans = divide_references(args, to_object_strings(read_table(args.fn_gold)))
+    texts = df_references['reference'].tolist()
+    if reference_spans is not None:
+        # divisions missing from a note are scored as the placeholder
+        texts.append(EMPTY_SECTION)
+        for row in range(len(reference_spans.division)):
+            texts.append(reference_spans.text(reference_spans.note_index[row], reference_spans.division[row]))
+    return texts
+
+
+if __name__ == "__main__" :
+    parser = argparse.ArgumentParser(
+        prog='embedding_store',
+        description='Precomputes the BERTScore embeddings of a gold file for evaluate_summarization.py --bertscore_store.'
+    )
+    parser.add_argument('--fn_gold', required=True, help='filename of gold references requires id and note column ( csv, or Parquet/Arrow IPC by extension ).')
+    parser.add_argument('--store', required=True, help='directory to write the embedding store to.')
+    parser.add_argument(
+        '--task', action='store', default='taskB',
+        help='summarization task, taskB also stores the section divisions of the gold notes.'
+    )
+    parser.add_argument('--note_column', default='SystemOutput', help='column to use for identifying note.')
+    parser.add_argument('--dialogue_column', default='dialogue', help='column to use for identifying dialogue.')
+    parser.add_argument('--section_workers', default=None, type=int, help='processes used for section division.')
+    parser.add_argument('--model_type', default=DEFAULT_MODEL_TYPE, help='BERTScore model.')
+    parser.add_argument('--num_layers', default=None, type=int, help='BERTScore layer (default is the model default).')
+    parser.add_argument('--device', default='cpu', help='device to encode on.')
+    parser.add_argument('--batch_size', default=64, type=int, help='texts encoded at once.')
+    parser.add_argument('--dtype', default='float16', choices=['float16', 'float32'], help='embedding storage type.')
+    parser.add_argument(
+        '--idf', default=False, action='store_true',
+        help='weight tokens by idf over the gold texts (scoring must then use idf=True).'
+    )
+    args = parser.parse_args()
+
+    texts = gold_texts(args)
+    idf_weights = None
+    if args.idf:
+        from bert_score.utils import get_idf_dict, get_tokenizer
+        idf_dict = get_idf_dict(texts, get_tokenizer(args.model_type))
+        idf_weights = {'default': idf_dict.default_factory(), 'tokens': {str(tok): w for tok, w in idf_dict.items()}}
+
+    encoder = BertEncoder(args.model_type, args.num_layers, device=args.device, idf_weights=idf_weights)
+    store = build_store(args.store, texts, encoder, dtype=args.dtype, batch_size=args.batch_size, idf_weights=idf_weights)
+    print(f'Stored {store.meta["num_texts"]} texts, {store.meta["num_tokens"]} tokens in {args.store}')
@@ -1,38 +1,277 @@
+import time
+START_TIME = time.time()
+
+import os
 import sys
 import json
+import zlib
+import queue
+import bisect
+import hashlib
 import argparse
+import functools
+import traceback
+import importlib.util
+import multiprocessing
 
-import evaluate
-import pandas as pd
 import numpy as np
 
-from sectiontagger import SectionTagger
-section_tagger = SectionTagger()
+from score_cache import ScoreCache, pair_hash, DEFAULT_MAX_ENTRIES
+from instrumentation import Instrumentation, peak_rss_mb
+from progressive import (
+    CohortTotals, StratifiedSample, FIRST_ROUND_SIZE, stratify, sample_order, stratified_estimates
+)
+from submission_validation import TASKS, validate_file, format_errors
+from table_io import read_table, read_chunks, to_object_strings
+
+# evaluate (torch, TF, datasets), pandas and the section tagger are imported on first use, see the loaders below
+_section_tagger = None
 
 
 SECTION_DIVISIONS = ['subjective', 'objective_exam', 'objective_results', 'assessment_and_plan']
+# instance division codes, the full note is 0 and each section division 1 + its index in SECTION_DIVISIONS
+DIVISION_NAMES = ['full'] + SECTION_DIVISIONS
+
+# filled in for a section division missing from a note
+EMPTY_SECTION = '#####EMPTY#####'
+
+# --section_scoring: every section division encoded on its own, or scored within the full notes' embeddings
+# ( the full_note bert_scorer backend, see section_scores.py )
+SECTION_SCORING_MODES = ['reencode', 'full_note']
+
+# --bertscore_store is passed to the store backend ( in-process or in a metric worker ) through the environment
+BERTSCORE_STORE_ENV = 'BERTSCORE_STORE'
+
+def _load_native_rouge():
+    from native_rouge import NativeRouge
+    return NativeRouge()
+
+
+def _load_rouge():
+    import evaluate
+    return evaluate.load('rouge')
+
+
+def _load_bertscore():
+    import evaluate
+    return evaluate.load('bertscore', device='cpu')
+
+
+def _load_stored_bertscore():
+    from embedding_store import StoredBertScore
+    if os.environ.get(BERTSCORE_STORE_ENV) is None:
+        raise ValueError('the store bert_scorer backend needs --bertscore_store')
+    return StoredBertScore(os.environ[BERTSCORE_STORE_ENV])
+
+
+def _load_section_bertscore():
+    from section_scores import SectionBertScore
+    return SectionBertScore()
+
+
+def _load_quantized_bertscore():
+    from cpu_backends import QuantizedBertScore
+    return QuantizedBertScore()
+
+
+def _load_onnx_bertscore():
+    from cpu_backends import OnnxBertScore
+    return OnnxBertScore()
+
+
+def _load_onnx_int8_bertscore():
+    from cpu_backends import OnnxBertScore
+    return OnnxBertScore(quantize=True)
+
+
+def _load_bleurt(config_name='BLEURT-20'):
+    import evaluate
+    return evaluate.load('bleurt', config_name=config_name)
+
+
+# name -> (backend -> loader, compute kwargs, keys returned by compute, keys saved in the results)
+# the first backend is the default, and a backend is only imported and loaded when its scorer is selected
+# ( the CPU-optimized int8/onnx BERTScore and smaller BLEURT backends are described in cpu_backends.py )
+SCORERS = {
+    'rouge': (
+        {'huggingface': _load_rouge, 'native': _load_native_rouge},
+        {'use_aggregator': False},
+        ['rouge1', 'rouge2', 'rougeL', 'rougeLsum'],
+        ['rouge1', 'rouge2', 'rougeL', 'rougeLsum']
+    ),
+    'bert_scorer': (
+        {
+            'huggingface': _load_bertscore, 'store': _load_stored_bertscore, 'full_note': _load_section_bertscore,
+            'int8': _load_quantized_bertscore, 'onnx': _load_onnx_bertscore, 'onnx-int8': _load_onnx_int8_bertscore,
+        },
+        {'model_type': 'microsoft/deberta-xlarge-mnli', 'device':'cpu'},
+        ['precision', 'recall', 'f1'],
+        ['bertscore_precision', 'bertscore_recall', 'bertscore_f1']
+    ),
+    'bluert': (
+        {
+            'huggingface': _load_bleurt, 'd12': functools.partial(_load_bleurt, 'BLEURT-20-D12'),
+            'd6': functools.partial(_load_bleurt, 'BLEURT-20-D6'), 'd3': functools.partial(_load_bleurt, 'BLEURT-20-D3'),
+        },
+        {},
+        ['scores'],
+        ['bleurt']
+    ),
+}
+
+# optional modules of backends, not in requirements.txt, checked when the backend is selected with --backends
+BACKEND_REQUIREMENTS = {
+    ('bert_scorer', 'onnx'): ['onnxruntime'],
+    ('bert_scorer', 'onnx-int8'): ['onnxruntime', 'onnx'],
+}
+
+# --metrics name -> scorer name
+METRICS = {'rouge': 'rouge', 'bertscore': 'bert_scorer', 'bleurt': 'bluert'}
+
+# thread pools of torch/TF (and the BLAS libraries under them) read these when they initialise
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS']
+
+# Scores given to trivial pairs without calling the metric, per scorer, pair kind (see trivial_pair_kind) and score key.
+#   rouge: an empty side has no overlap (0.0); identical placeholders are a single matching token, so rouge2 has
+#       no bigrams (0.0) and the rest overlap fully (1.0), exactly as rouge_score returns.
+#   bert_scorer: bert_score sets an empty side to 0.0; identical placeholders are scored as a perfect match (1.0).
+#   bluert: no rule, trivial pairs are scored by the model (once per unique pair).
+TRIVIAL_PAIR_SCORES = {
+    'rouge': {
+        'empty': {'rouge1': 0.0, 'rouge2': 0.0, 'rougeL': 0.0, 'rougeLsum': 0.0},
+        'placeholder': {'rouge1': 1.0, 'rouge2': 0.0, 'rougeL': 1.0, 'rougeLsum': 1.0},
+    },
+    'bert_scorer': {
+        'empty': {'precision': 0.0, 'recall': 0.0, 'f1': 0.0},
+        'placeholder': {'precision': 1.0, 'recall': 1.0, 'f1': 1.0},
+    },
+}
+
+# Scorers whose pairs are sorted by length and split into batches under --max_tokens_per_batch,
+# mapped to the compute argument setting the model batch size (None if the scorer has none).
+BATCHED_SCORERS = {'bert_scorer': 'batch_size', 'bluert': None}
+DEFAULT_MAX_TOKENS_PER_BATCH = 8192
+
+
+def get_section_tagger():
+    global _section_tagger
+    if _section_tagger is None:
+        from sectiontagger import SectionTagger
+        _section_tagger = SectionTagger()
+    return _section_tagger
+
+
+class SectionSpans:
+    """
+    Section divisions of a list of notes as a span table: note index, division code ( index in SECTION_DIVISIONS )
+    and start/end offsets into the note, one row per division detected in a note. The notes are not copied,
+    a section's text is only cut out of its note when it is asked for.
+    """
+
+    def __init__(self, notes, note_index, division, start, end, detected=None):
+        self.notes = notes
+        self.note_index = note_index
+        self.division = division
+        self.start = start
+        self.end = end
+        # row of the span table for every note and division, -1 where the note lacks the division
+        self.rows = np.full((len(notes), len(SECTION_DIVISIONS)), -1, dtype=np.int64)
+        self.rows[note_index, division] = np.arange(len(note_index))
+        # divisions found in any note of the table this one was taken from
+        self.detected = np.bincount(division, minlength=len(SECTION_DIVISIONS)) > 0 if detected is None else detected
+
+    @classmethod
+    def from_notes(cls, notes, workers=None):
+        """Section-divides notes ( with __lf1__ line breaks read as newlines ) into a span table."""
+        from sectiontagger import METASECTIONS
+        notes = list(notes)
+        columns = get_section_tagger().divide_many(notes, workers=workers, newline='__lf1__')
+        codes = np.array([SECTION_DIVISIONS.index(name) for name in METASECTIONS], dtype=np.int8)
+        return cls(
+            notes,
+            np.frombuffer(columns['note_index'], dtype=np.int64),
+            codes[np.frombuffer(columns['division'], dtype=np.int8)],
+            np.frombuffer(columns['start'], dtype=np.int64),
+            np.frombuffer(columns['end'], dtype=np.int64),
+        )
+
+    def take(self, note_indices):
+        """The span table of the notes at note_indices, in that order ( a note may be taken several times )."""
+        rows = self.rows[np.asarray(note_indices, dtype=np.int64)]
+        new_notes, divisions = np.nonzero(rows >= 0)
+        rows = rows[new_notes, divisions]
+        return SectionSpans(
+            [self.notes[ind] for ind in note_indices], new_notes, divisions.astype(np.int8),
+            self.start[rows], self.end[rows], detected=self.detected
+        )
+
+    def text(self, note, division):
+        """Text of a division of a note with its line breaks as __lf1__, None if the note lacks the division."""
+        row = self.rows[note, division]
+        if row < 0:
+            return None
+        return self.notes[note][self.start[row]:self.end[row]].replace('\n', '__lf1__')
+
+
+class InstanceTexts:
+    """
+    The references or predictions of the scoring instances: every full note, followed for taskB by each
+    section division of every note, cut out of the note when the instance is read. A division missing from a
+    note reads as EMPTY_SECTION, or '' when no note of the span table has it.
+    """
+
+    def __init__(self, notes, spans=None):
+        self.notes = notes
+        self.spans = spans
+        self.num_blocks = 1 if spans is None else 1 + len(SECTION_DIVISIONS)
+
+    def __len__(self):
+        return len(self.notes) * self.num_blocks
+
+    def __getitem__(self, ind):
+        if ind < 0:
+            ind += len(self)
+        if ind < 0 or ind >= len(self):
+            raise IndexError(ind)
+        block, note = divmod(ind, len(self.notes))
+        if block == 0:
+            return self.notes[note]
+        text = self.spans.text(note, block - 1)
+        if text is None:
+            return EMPTY_SECTION if self.spans.detected[block - 1] else ''
+        return text
 
-TASKA_RANGE = [0,199]
-TASKA_PREFIX = ''
+    def __iter__(self):
+        return (self[ind] for ind in range(len(self)))
 
-TASKB_RANGE = [88,127]
-TASKB_PREFIX = 'D2N'
 
-TASKC_RANGE = [128,167]
-TASKC_PREFIX = 'D2N'
+class ConcatTexts:
+    """Several InstanceTexts ( e.g. of several systems ) read as one sequence."""
 
+    def __init__(self, parts=()):
+        self.parts = []
+        self.offsets = [0]
+        for part in parts:
+            self.append(part)
 
-def add_section_divisions(row, dialogue_column ):
-    row['src_len'] = len(row[ dialogue_column ].split())
-    for evaltype in ['reference', 'prediction']:
-        text = row[evaltype]
-        text_with_endlines = text.replace( '__lf1__', '\n' )
-        detected_divisions = section_tagger.divide_note_by_metasections(text_with_endlines)
-        for detected_division in detected_divisions:
-            label, _, _, start, _, end = detected_division
-            row[ '%s_%s' % (evaltype, label)] = text_with_endlines[start:end].replace('\n', '__lf1__')
+    def append(self, part):
+        self.parts.append(part)
+        self.offsets.append(self.offsets[-1] + len(part))
 
-    return row
+    def __len__(self):
+        return self.offsets[-1]
+
+    def __getitem__(self, ind):
+        if ind < 0:
+            ind += len(self)
+        if ind < 0 or ind >= len(self):
+            raise IndexError(ind)
+        part = bisect.bisect_right(self.offsets, ind) - 1
+        return self.parts[part][ind - self.offsets[part]]
+
+    def __iter__(self):
+        for part in self.parts:
+            yield from part
 
 
 def select_values_by_indices(lst, indices) :
@@ -45,98 +284,459 @@ def read_text(fn):
     return texts
 
 
-def _validate(args, df_predictions, task_prefix, task_range):
-    id_range = df_predictions.apply(lambda row: int( str(row[args.id_column]).replace(task_prefix, '')), axis=1)
-    min_id = min(id_range)
-    max_id = max(id_range)
-    if min_id < task_range[0] or min_id > task_range[1]:
-        print('Your encounter ID range does not match the test encounters')
-        sys.exit(1)
-    if max_id < task_range[0] or max_id > task_range[1]:
-        print('Your encounter ID range does not match the test encounters')
-        sys.exit(1)
-    if not args.debug and len(df_predictions) != task_range[1] - task_range[0] + 1:
-        print('The number of test encounters does not match expected for this task!')
+def test_id_range(args, fn_sys):
+    """
+    Checks the ids of system file fn_sys against the task's prefix and range, also for duplicates and, unless
+    -debug, that every test encounter is present. Prints every problem and exits on any, returns the number of rows.
+    """
+    if args.task not in TASKS:
+        print(f'No encounter ID checks for task {args.task}, expected one of {list(TASKS)}')
+        return None
+    spec = TASKS[args.task]
+    num_rows, errors = validate_file(
+        fn_sys, spec['prefix'], spec['range'], id_column=args.id_column, complete=not args.debug
+    )
+    if len(errors) > 0:
+        print('Your encounter IDs do not match the test encounters of this task:')
+        for line in format_errors(fn_sys, errors):
+            print(f'\t{line}')
         sys.exit(1)
+    return num_rows
 
 
-def test_id_range( args, df_predictions):
-    # Make sure args.id_column is in range expected by task prefix (taskA or taskB)
-    print( df_predictions.columns )
-    id_1 = '%s' %df_predictions.iloc[0][args.id_column]
-    if args.task == 'taskA' and TASKA_PREFIX in id_1:
-        if args.task == 'taskB':
-            print('Your ID prefixes do not match this tasks expected encounter_ids.')
-            sys.exit(1)
-        _validate(args, df_predictions, TASKA_PREFIX, TASKA_RANGE)
-    elif TASKB_PREFIX in id_1:
-        if args.task == 'taskA':
-            print( 'Your ID prefixes do not match this tasks expected encounter_ids.' )
-            sys.exit(1)
-        if args.task == 'taskB':
-            _validate(args, df_predictions, TASKB_PREFIX, TASKB_RANGE)
-        if args.task == 'taskC':
-            _validate(args, df_predictions, TASKC_PREFIX, TASKC_RANGE)
+def metric_config(scorer, kwargs):
+    return json.dumps({'config_name': getattr(scorer, 'config_name', None), 'kwargs': kwargs}, sort_keys=True)
+
+
+def trivial_pair_kind(reference, prediction):
+    if reference == '' or prediction == '':
+        return 'empty'
+    if reference == prediction == EMPTY_SECTION:
+        return 'placeholder'
+    return None
+
+
+def plan_scoring(references, predictions):
+    """
+    Collapses duplicate (reference, prediction) pairs before scoring.
+    Returns the unique pairs, the unique pair position of every instance, and the trivial kind of every unique pair
+    """
+    pair2pos = {}
+    positions = [pair2pos.setdefault(pair, len(pair2pos)) for pair in zip(references, predictions)]
+    unique_pairs = list(pair2pos)
+    kinds = [trivial_pair_kind(ref, pred) for ref, pred in unique_pairs]
+    return unique_pairs, positions, kinds
+
+
+def pair_length(reference, prediction):
+    # whitespace tokens, a cheap proxy for the number of model tokens
+    return len(reference.split()) + len(prediction.split())
+
+
+def make_length_batches(lengths, max_tokens):
+    """
+    Sorts instances by length and groups them so that batch size x longest length stays within max_tokens
+    (an instance longer than max_tokens gets a batch of its own).
+    Returns a list of index lists
+    """
+    batches = []
+    batch = []
+    for ind in sorted(range(len(lengths)), key=lengths.__getitem__):
+        if len(batch) > 0 and (len(batch) + 1) * max(lengths[ind], 1) > max_tokens:
+            batches.append(batch)
+            batch = []
+        batch.append(ind)
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+def run_scorer(name, scorer, kwargs, keys, pairs, max_tokens_per_batch=None, on_batch=None):
+    """
+    Returns a list of score values (one per key) for each pair, in the order of pairs.
+    on_batch( pair indices, values ) is called as each batch completes.
+    """
+    if len(pairs) == 0:
+        return []
+    if name in BATCHED_SCORERS and max_tokens_per_batch is not None:
+        lengths = [pair_length(ref, pred) for ref, pred in pairs]
+        batches = make_length_batches(lengths, max_tokens_per_batch)
     else:
-        print(f'Your encounter ID -> {id_1} does not have an identifiable prefix supported by this evaluation' )
-        sys.exit(1)
+        lengths = None
+        batches = [list(range(len(pairs)))]
 
+    batch_kwargs = dict(kwargs)
+    values = [None] * len(pairs)
+    for num, batch in enumerate(batches, 1):
+        if BATCHED_SCORERS.get(name) is not None:
+            batch_kwargs[BATCHED_SCORERS[name]] = len(batch)
+        start = time.time()
+        scores = scorer.compute(
+            references=[pairs[ind][0] for ind in batch],
+            predictions=[pairs[ind][1] for ind in batch],
+            **batch_kwargs
+        )
+        for pos, ind in enumerate(batch):
+            values[ind] = [scores[key][pos] for key in keys]
+        if on_batch is not None:
+            on_batch(batch, [values[ind] for ind in batch])
+        if lengths is not None:
+            elapsed = max(time.time() - start, 1e-9)
+            num_tokens = sum(lengths[ind] for ind in batch)
+            print(
+                f'{name} batch {num}/{len(batches)}: {len(batch)} pairs, {num_tokens} tokens, '
+                f'{len(batch) / elapsed:.1f} pairs/s, {num_tokens / elapsed:.1f} tokens/s'
+            )
+    return values
 
-def filter_and_aggregate(obj, indices):
-    agg_obj = {}
-    for k, v in obj.items():
-        agg_obj[k] = float(np.mean([v[i] for i in indices]))
-    return agg_obj
 
+def _compute_pairs(name, scorer, kwargs, keys, pairs, score_cache=None, max_tokens_per_batch=None, on_batch=None):
+    """Returns a list of score values (one per key) for each pair, only scoring the pairs missing from score_cache."""
+    if score_cache is None:
+        values = run_scorer(name, scorer, kwargs, keys, pairs, max_tokens_per_batch, on_batch=on_batch)
+        return values, len(pairs)
 
-if __name__ == "__main__" :
-    parser = argparse.ArgumentParser(
-        prog='evaluate_summarization',
-        description='This runs basic evaluation for both snippet (taskA) and full note summarization (taskB).'
-    )
-    parser.add_argument('--fn_gold', required=True, help='filename of gold references requires id and note column.')
-    parser.add_argument('--fn_sys', required=True, help='filename of system references requires id and note column.')
-    parser.add_argument(
-        '--metadata_file', dest='fn_metadata', action='store', default=None,
-        help='filename of metadata requires id and dataset column.'
-    )
-    parser.add_argument(
-        '--task', action='store', default='taskB',
-        help='summarization task, default is for full note (taskB). (use snippet, taskA, otherwise).'
-    )
-    parser.add_argument('--id_column', default='TestID', help='column to use for identifying id.')
-    parser.add_argument('--note_column', default='SystemOutput', help='column to use for identifying note.')
-    parser.add_argument('--dialogue_column', default='dialogue', help='column to use for identifying dialogue.')
-    parser.add_argument(
-        '--use_section_check', action='store_true', default=False,
-        help='this flag with make sure evaluation shuts down for full task if 0 section divisions are detected.'
-    )
-    parser.add_argument(
-        '--note_length_cutoff', default=512, type=int,
-        help='Consider less than note_length_cutoff to be short and vice-versa for long'
+    config = metric_config(scorer, kwargs)
+    hashes = [pair_hash(ref, pred) for ref, pred in pairs]
+    hash2scores = score_cache.lookup(name, config, hashes)
+    missing = [ind for ind, h in enumerate(hashes) if h not in hash2scores]
+    if on_batch is not None:
+        hits = [ind for ind, h in enumerate(hashes) if h in hash2scores]
+        on_batch(hits, [hash2scores[hashes[ind]] for ind in hits])
+
+    def _on_missing_batch(batch, values):
+        score_cache.store(name, config, {hashes[missing[pos]]: [float(v) for v in vals] for pos, vals in zip(batch, values)})
+        if on_batch is not None:
+            on_batch([missing[pos] for pos in batch], values)
+
+    if len(missing) > 0:
+        values = run_scorer(
+            name, scorer, kwargs, keys, select_values_by_indices(pairs, missing), max_tokens_per_batch,
+            on_batch=_on_missing_batch
+        )
+        hash2scores.update({hashes[ind]: [float(v) for v in vals] for ind, vals in zip(missing, values)})
+    return [hash2scores[h] for h in hashes], len(missing)
+
+
+def compute_scores(name, scorer, kwargs, keys, plan, score_cache=None, max_tokens_per_batch=None, on_scores=None):
+    """
+    Scores the unique pairs of a plan_scoring plan and scatters them back to every instance.
+    on_scores( instance indices, {key: values} ) streams the per-instance scores as they become available.
+    Returns per-instance scores for each key, and the number of pairs passed to the scorer
+    """
+    unique_pairs, positions, kinds = plan
+    rules = TRIVIAL_PAIR_SCORES.get(name, {})
+
+    unique2instances = [[] for _ in unique_pairs]
+    for ind, pos in enumerate(positions):
+        unique2instances[pos].append(ind)
+
+    def _emit(unique_positions, values):
+        if on_scores is None:
+            return
+        indices = []
+        streamed = {key: [] for key in keys}
+        for pos, vals in zip(unique_positions, values):
+            for ind in unique2instances[pos]:
+                indices.append(ind)
+                for key, val in zip(keys, vals):
+                    streamed[key].append(val)
+        on_scores(indices, streamed)
+
+    unique_scores = [None] * len(unique_pairs)
+    trivial = []
+    todo = []
+    for pos, kind in enumerate(kinds):
+        if kind in rules:
+            unique_scores[pos] = [rules[kind][key] for key in keys]
+            trivial.append(pos)
+        else:
+            todo.append(pos)
+    _emit(trivial, select_values_by_indices(unique_scores, trivial))
+
+    computed, num_scored = _compute_pairs(
+        name, scorer, kwargs, keys, select_values_by_indices(unique_pairs, todo),
+        score_cache=score_cache, max_tokens_per_batch=max_tokens_per_batch,
+        on_batch=lambda batch, values: _emit([todo[ind] for ind in batch], values)
     )
-    parser.add_argument('--experiment', default='default', help='Prefix for save file.')
-    parser.add_argument('-debug', default=False, action='store_true', help='If true, just runs eval over first example')
+    for pos, values in zip(todo, computed):
+        unique_scores[pos] = values
 
-    args = parser.parse_args()
+    scores = {key: [unique_scores[pos][ind] for pos in positions] for ind, key in enumerate(keys)}
+    return scores, num_scored
+
+
+def load_scorer(name, backend=None):
+    loaders, kwargs, keys, save_keys = SCORERS[name]
+    if backend is None:
+        backend = next(iter(loaders))
+    return loaders[backend](), kwargs, keys, save_keys
+
+
+def score_sequentially(names, plan, backends=None, score_cache_path=None, score_cache_max_entries=DEFAULT_MAX_ENTRIES,
+                       max_tokens_per_batch=None, loaded=None, timer=None, on_metric=None):
+    """
+    Loads and runs each scorer in turn in this process, timing load_{name} and score_{name} stages in timer.
+    loaded ( name -> load_scorer output ) keeps scorers between calls, they are only loaded if missing from it.
+    on_metric( name, all_scores ) is called as each scorer completes, with the scores of the scorers done so far.
+    Returns all_scores ( save key -> per-instance scores ), scorer_stats ( name -> pairs scored ),
+    score cache stats
+    """
+    score_cache = None
+    if score_cache_path is not None:
+        score_cache = ScoreCache(score_cache_path, max_entries=score_cache_max_entries)
+    if loaded is None:
+        loaded = {}
+    if timer is None:
+        timer = Instrumentation()
+
+    all_scores = {}
+    scorer_stats = {}
+    for name in names:
+        if name not in loaded:
+            print(f'Loading {name}')
+            with timer.stage(f'load_{name}'):
+                loaded[name] = load_scorer(name, (backends or {}).get(name))
+        scorer, kwargs, keys, save_keys = loaded[name]
+        with timer.stage(f'score_{name}') as stage:
+            scores, num_scored = compute_scores(
+                name, scorer, kwargs, keys, plan, score_cache=score_cache, max_tokens_per_batch=max_tokens_per_batch
+            )
+            stage['instances'] = num_scored
+        scorer_stats[name] = {'scored': num_scored}
+        for score_key, save_key in zip(keys, save_keys):
+            all_scores[save_key] = scores[score_key]
+        if on_metric is not None:
+            on_metric(name, all_scores)
+
+    cache_stats = {}
+    if score_cache is not None:
+        cache_stats = score_cache.stats
+        score_cache.close()
+    return all_scores, scorer_stats, cache_stats
+
+
+def parse_metric_cores(value):
+    """Parses 'name=cores,name=cores' into a dict."""
+    metric_cores = {}
+    for item in value.split(','):
+        name, cores = item.split('=')
+        if name not in SCORERS:
+            raise argparse.ArgumentTypeError(f'unknown scorer {name}, expected one of {list(SCORERS)}')
+        metric_cores[name] = int(cores)
+    return metric_cores
+
+
+def parse_backends(value):
+    """Parses 'name=backend,name=backend' into a dict."""
+    backends = {}
+    for item in value.split(','):
+        name, backend = item.split('=')
+        if name not in SCORERS or backend not in SCORERS[name][0]:
+            raise argparse.ArgumentTypeError(
+                f'unknown backend {item}, expected one of ' +
+                ', '.join(f'{n}={b}' for n, spec in SCORERS.items() for b in spec[0])
+            )
+        missing = [
+            module for module in BACKEND_REQUIREMENTS.get((name, backend), []) if importlib.util.find_spec(module) is None
+        ]
+        if len(missing) > 0:
+            raise argparse.ArgumentTypeError(
+                f'the {item} backend needs the optional {" and ".join(missing)}, pip install {" ".join(missing)}'
+            )
+        backends[name] = backend
+    return backends
+
+
+def parse_metrics(value):
+    """Parses 'rouge,bertscore,bleurt' into scorer names (in SCORERS order)."""
+    selected = [metric.strip() for metric in value.split(',') if metric.strip() != '']
+    for metric in selected:
+        if metric not in METRICS:
+            raise argparse.ArgumentTypeError(f'unknown metric {metric}, expected some of {list(METRICS)}')
+    names = [METRICS[metric] for metric in selected]
+    return [name for name in SCORERS if name in names]
+
+
+def parse_shard(value):
+    """Parses 'i/N' into (i, N), shard i ( from 0 ) of N."""
+    try:
+        shard, num_shards = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expected a shard as i/N, e.g. 0/4, not {value}')
+    if num_shards < 1 or shard < 0 or shard >= num_shards:
+        raise argparse.ArgumentTypeError(f'shard {value} is not one of 0/{num_shards} to {num_shards - 1}/{num_shards}')
+    return shard, num_shards
+
+
+def allocate_cores(names, metric_cores=None, num_cores=None):
+    """
+    Input : scorer names, dict of name -> cores set by the user, cores on the machine (default cpu count)
+    Return: dict of name -> cores
+    rouge is pure python and gets one core unless set, the other scorers split the remaining cores evenly
+    """
+    num_cores = num_cores or os.cpu_count() or 1
+    cores = {name: cnt for name, cnt in (metric_cores or {}).items() if name in names}
+    if 'rouge' in names and 'rouge' not in cores:
+        cores['rouge'] = 1
+    rest = [name for name in names if name not in cores]
+    if len(rest) > 0:
+        free = max(num_cores - sum(cores.values()), len(rest))
+        for ind, name in enumerate(rest):
+            cores[name] = free // len(rest) + (1 if ind < free % len(rest) else 0)
+    return cores
+
+
+def limit_threads(num_threads):
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(num_threads)
+    os.environ['TF_NUM_INTEROP_THREADS'] = str(min(2, num_threads))
+    if 'torch' in sys.modules:
+        sys.modules['torch'].set_num_threads(num_threads)
+
+
+def _metric_worker(name, backend, plan, num_threads, score_cache_path, score_cache_max_entries, max_tokens_per_batch,
+                   results, start_time=None, profile_dir=None):
+    try:
+        timer = Instrumentation(start_time=start_time, profile_dir=profile_dir)
+        limit_threads(num_threads)
+        with timer.stage(f'load_{name}'):
+            scorer, kwargs, keys, save_keys = load_scorer(name, backend)
+        # torch is only imported by the loader, so cap it again now that it is there
+        limit_threads(num_threads)
+
+        score_cache = None
+        if score_cache_path is not None:
+            score_cache = ScoreCache(score_cache_path, max_entries=score_cache_max_entries)
+
+        def _on_scores(indices, values):
+            results.put(('scores', name, indices, {save: values[key] for key, save in zip(keys, save_keys)}))
+
+        with timer.stage(f'score_{name}') as stage:
+            _, num_scored = compute_scores(
+                name, scorer, kwargs, keys, plan,
+                score_cache=score_cache, max_tokens_per_batch=max_tokens_per_batch, on_scores=_on_scores
+            )
+            stage['instances'] = num_scored
+        if profile_dir is not None:
+            timer.write_profiles()
+        stats = {'scored': num_scored}
+        results.put((
+            'done', name, stats, score_cache.stats if score_cache is not None else {}, timer.stages, timer.events
+        ))
+    except Exception:
+        results.put(('error', name, traceback.format_exc()))
+
+
+def score_in_workers(names, plan, metric_workers, backends=None, metric_cores=None, score_cache_path=None,
+                     score_cache_max_entries=DEFAULT_MAX_ENTRIES, max_tokens_per_batch=None, timer=None, on_metric=None):
+    """
+    Runs each scorer in its own process (at most metric_workers at once) with its own thread limit,
+    merging the per-instance scores streamed back by the workers, and their stage timings into timer.
+    on_metric is called as each scorer completes, as in score_sequentially.
+    Returns the same as score_sequentially
+    """
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    cores = allocate_cores(names, metric_cores)
+    num_instances = len(plan[1])
+
+    all_scores = {}
+    scorer_stats = {}
+    cache_stats = {}
+    pending = list(names)
+    running = {}
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0 and len(running) < metric_workers:
+                name = pending.pop(0)
+                print(f'Starting {name} worker with {cores[name]} cores')
+                running[name] = ctx.Process(
+                    target=_metric_worker, daemon=True,
+                    args=(
+                        name, (backends or {}).get(name), plan, cores[name],
+                        score_cache_path, score_cache_max_entries, max_tokens_per_batch, results,
+                        None if timer is None else timer.start_time, None if timer is None else timer.profile_dir
+                    )
+                )
+                running[name].start()
 
-    # Read in reference/hyp files -added the latin encoding as one of the participants' file had a strange character somewhere
-    #df_references = pd.read_csv(args.fn_gold, encoding='latin1')
-    #df_predictions = pd.read_csv(args.fn_sys, encoding='latin1')
-    df_references = pd.read_csv(args.fn_gold)
-    df_predictions = pd.read_csv(args.fn_sys)
+            try:
+                msg = results.get(timeout=1)
+            except queue.Empty:
+                for name, proc in running.items():
+                    if not proc.is_alive() and results.empty():
+                        raise RuntimeError(f'{name} worker exited with code {proc.exitcode}')
+                continue
 
-    print(f'Gold path: {args.fn_gold} ({len(df_references)} summaries)')
-    print(f'System path: {args.fn_sys} ({len(df_predictions)} summaries)')
+            kind, name = msg[:2]
+            if kind == 'scores':
+                _, _, indices, values = msg
+                for save_key, vals in values.items():
+                    instance_scores = all_scores.setdefault(save_key, [None] * num_instances)
+                    for ind, val in zip(indices, vals):
+                        instance_scores[ind] = val
+            elif kind == 'done':
+                scorer_stats[name] = msg[2]
+                cache_stats.update(msg[3])
+                if timer is not None:
+                    timer.merge(msg[4], msg[5])
+                running.pop(name).join()
+                if on_metric is not None:
+                    # a worker's scores are all on the queue before its done message
+                    on_metric(name, {
+                        save_key: all_scores[save_key]
+                        for done in SCORERS if done in scorer_stats for save_key in SCORERS[done][3]
+                    })
+            else:
+                raise RuntimeError(f'{name} worker failed:\n{msg[2]}')
+    finally:
+        for proc in running.values():
+            proc.terminate()
 
-    # Check id formatting to determine if something obvious is amiss based on encounter id's and task
-    test_id_range(args, df_predictions)
+    # same key order as a sequential run
+    all_scores = {save_key: all_scores[save_key] for name in names for save_key in SCORERS[name][3]}
+    return all_scores, scorer_stats, cache_stats
 
-    # read in metadata file - if none exists, just creates a dummy
-    if args.fn_metadata is not None:
-        full_df = pd.read_csv(args.fn_metadata)
-        full_df = full_df.merge(df_references.rename({args.note_column: 'reference'}), on=args.id_column)
-        full_df = full_df.merge(df_predictions.rename({args.note_column: 'prediction'}), on=args.id_column)
+
+def id_index(df, id_column):
+    """The pd.Index of df's ids, built once for a frame that is joined with several others ( see join_on_ids )."""
+    import pandas as pd
+    return pd.Index(df[id_column])
+
+
+def join_on_ids(left, right, id_column, left_index=None):
+    """
+    Inner join of the rows of right onto the rows of left with the same id, in the order left.merge(right, on=id_column)
+    gives, by looking up right's ids in left_index ( id_index of left, built here if None ) rather than merging.
+    Repeated ids in left, ids of different kinds or other columns on both sides are left to merge.
+    """
+    import pandas as pd
+    if left_index is None:
+        left_index = id_index(left, id_column)
+    overlap = set(left.columns).intersection(right.columns) - {id_column}
+    if len(overlap) > 0 or not left_index.is_unique or left[id_column].dtype.kind != right[id_column].dtype.kind:
+        return left.merge(right, on=id_column)
+    left_rows = left_index.get_indexer(right[id_column])
+    right_rows = np.flatnonzero(left_rows >= 0)
+    # in the order of left, the rows of right with the same id in their own order
+    order = np.argsort(left_rows[right_rows], kind='stable')
+    left_rows, right_rows = left_rows[right_rows][order], right_rows[order]
+    return pd.concat([
+        left.iloc[left_rows].reset_index(drop=True),
+        right.drop(columns=[id_column]).iloc[right_rows].reset_index(drop=True),
+    ], axis=1)
+
+
+def merge_inputs(args, df_references, df_predictions, df_metadata=None, reference_index=None):
+    """
+    Joins references and predictions (and metadata if given) on args.id_column into one row per note.
+    reference_index is id_index of df_references, to build it once for references joined with several systems.
+    Arrow string columns of Parquet/Arrow inputs come out as the object columns a csv gives.
+    """
+    if df_metadata is not None:
+        full_df = join_on_ids(df_metadata, df_references.rename({args.note_column: 'reference'}), args.id_column)
+        full_df = join_on_ids(full_df, df_predictions.rename({args.note_column: 'prediction'}), args.id_column)
     else:
         def _conditional_rename(tmp_df, old_col, new_col):
             if new_col not in tmp_df.columns:
@@ -144,110 +744,1126 @@ if __name__ == "__main__" :
         _conditional_rename(df_predictions, args.note_column, 'prediction')
         _conditional_rename(df_references, args.note_column, 'reference')
         # Only need id and prediction from df_predictions
-        full_df = df_references.merge(df_predictions[[args.id_column, 'prediction']], on=args.id_column)
+        full_df = join_on_ids(
+            df_references, df_predictions[[args.id_column, 'prediction']], args.id_column, left_index=reference_index
+        )
         full_df['dataset'] = 0
+    return to_object_strings(full_df)
+
 
-    # create lists for references/predictions so we only need to calculate the scores once per instance
+def detect_divisions(args, references, predictions):
+    """
+    The divisions found in any of the reference and in any of the prediction notes, as
+    {'reference': flags, 'prediction': flags} with a flag per SECTION_DIVISIONS. A division missing from a note is
+    scored as EMPTY_SECTION where it is detected and as '' otherwise, so notes scored apart from the others ( a
+    --shard, a --stream_chunk_size chunk ) take the flags of all the notes, as a single run has them.
+    """
+    return {
+        'reference': SectionSpans.from_notes(references, workers=args.section_workers).detected.tolist(),
+        'prediction': SectionSpans.from_notes(predictions, workers=args.section_workers).detected.tolist(),
+    }
+
+
+def build_instances(args, full_df, reference_spans=None, detected=None):
+    """
+    Expands the merged notes into scoring instances, the full notes followed (for taskB) by each section division.
+    reference_spans is the span table of the references when they are already divided ( see divide_references ),
+    in which case full_df has their row in it as _reference_row. detected is the detect_divisions flags of all the
+    notes to score when full_df only has part of them, by default those of full_df's notes.
+    Returns full_df, references, predictions ( InstanceTexts ) and instance_info ( id, dataset, src_len list and
+    division code array per instance )
+    """
     references = full_df['reference'].tolist()
     predictions = full_df['prediction'].tolist()
     num_test = len(full_df)
+    src_lens = [None] * num_test
+    reference_divisions = None
+    prediction_divisions = None
 
     # =========== ADD SECTION DIVISIONS IF THIS IS THE FULL ENCOUNTER TASK ==========
     if args.task == 'taskB':
-        full_df = full_df.apply( lambda row: add_section_divisions( row, args.dialogue_column ), axis=1)
-        print( full_df.columns )
+        # number of whitespace separated words, counted without splitting every dialogue into a list
+        full_df['src_len'] = full_df[args.dialogue_column].str.count(r'\S+')
+        src_lens = [None if val != val else int(val) for val in full_df['src_len'].tolist()]
+        if reference_spans is None:
+            reference_divisions = SectionSpans.from_notes(references, workers=args.section_workers)
+        else:
+            reference_divisions = reference_spans.take(full_df['_reference_row'].to_numpy())
+        prediction_divisions = SectionSpans.from_notes(predictions, workers=args.section_workers)
+        if detected is not None:
+            reference_divisions.detected = np.array(detected['reference'], dtype=bool)
+            prediction_divisions.detected = np.array(detected['prediction'], dtype=bool)
+        print(f'Section divisions: {len(reference_divisions.division)} reference, '
+              f'{len(prediction_divisions.division)} prediction spans')
 
         # ===========CHECKS TO MAKE SURE THERE ARE SECTIONS ==========
-        #total_detected_sections = sum([
-        #    full_df[f'prediction_{division}'].notna().sum() for division in SECTION_DIVISIONS
-        #])
+        #total_detected_sections = len(prediction_divisions.division)
         #if total_detected_sections == 0:
         #    print('We detected 0 sections! - you can use override_section_check flag to run while ignoring this.')
         #    if args.use_section_check :
         #        sys.exit(1)
 
-        # Fill in missing section divisions as empty string
-        full_df.fillna('#####EMPTY#####', inplace=True)
-
-        ######## ADD INSTANCES FOR SECTION DIVISION ########
-        for division in SECTION_DIVISIONS:
-            null_default = [''] * num_test
-            references.extend(full_df.get(f'reference_{division}', null_default))
-            predictions.extend(full_df.get(f'prediction_{division}', null_default))
-
-        # sanity check, we should now have 5 x the original set (one for full note, 4 for the divisions)
-        rn = len(references)
-        pn = len(predictions)
-        en = len(full_df) * 5
-        assert rn == pn == en, f'The number of references ({rn}) and predictions ({pn}) does not match expected ({en})'
-
-    ######## Load Metrics from HuggingFace ########
-    print('Loading ROUGE, BERTScore, BLEURT from HuggingFace')
-    scorers = {
-        'rouge': (
-            evaluate.load('rouge'),
-            {'use_aggregator': False},
-            ['rouge1', 'rouge2', 'rougeL', 'rougeLsum'],
-            ['rouge1', 'rouge2', 'rougeL', 'rougeLsum']
-        ),
-        'bert_scorer': (
-            evaluate.load('bertscore', device='cpu'),
-            {'model_type': 'microsoft/deberta-xlarge-mnli', 'device':'cpu'},
-            ['precision', 'recall', 'f1'],
-            ['bertscore_precision', 'bertscore_recall', 'bertscore_f1']
-        ),
-        'bluert': (
-            evaluate.load('bleurt', config_name='BLEURT-20'),
-            {},
-            ['scores'],
-            ['bleurt']
-        ),
+        # as the section divisions, other missing values are filled in as empty
+        full_df.fillna(EMPTY_SECTION, inplace=True)
+
+    ######## ADD INSTANCES FOR SECTION DIVISION ########
+    # ( the division texts are only read out of the notes when the instances are scored )
+    references = InstanceTexts(references, reference_divisions)
+    predictions = InstanceTexts(predictions, prediction_divisions)
+
+    num_divisions = references.num_blocks
+    instance_info = {
+        'id': full_df[args.id_column].tolist() * num_divisions,
+        'division': np.repeat(np.arange(num_divisions, dtype=np.int8), num_test),
+        'dataset': full_df['dataset'].tolist() * num_divisions,
+        'src_len': src_lens * num_divisions,
     }
+    return full_df, references, predictions, instance_info
 
-    ######## CALCULATE PER INSTANCE SCORES ########
-    all_scores = {}
-    for name, (scorer, kwargs, keys, save_keys) in scorers.items():
-        scores = scorer.compute(references=references, predictions=predictions, **kwargs)
-        for score_key, save_key in zip(keys, save_keys):
-            all_scores[save_key] = scores[score_key]
+
+def build_cohorts(instance_info, task, note_length_cutoff):
+    """
+    Returns (cohort name, instance index array) pairs, cohorts other than the divisions only cover full notes.
+    The division of an instance is its code, the index in DIVISION_NAMES.
+    """
+    divisions = np.asarray(instance_info['division'])
+    datasets = np.asarray(instance_info['dataset'], dtype=object)
+    src_lens = np.array([np.nan if val is None else val for val in instance_info['src_len']], dtype=np.float64)
+    full = divisions == 0
 
     cohorts = [
-        ('all', list(range(num_test))),
+        ('all', np.flatnonzero(full)),
     ]
 
-    subsets = full_df['dataset'].unique().tolist()
-    for subset in subsets:
-        # Don't include anything after num_test (section-level)
-        indices = full_df[full_df['dataset'] == subset].index.tolist()
-        cohorts.append((f'dataset-{subset}', indices))
+    for subset in dict.fromkeys(datasets[full].tolist()):
+        cohorts.append((f'dataset-{subset}', np.flatnonzero(full & (datasets == subset))))
 
-    if args.task == 'taskB':
-        for ind, division in enumerate(SECTION_DIVISIONS):
-            start = (ind + 1) * num_test
-            end = (ind + 2) * num_test
-            cohorts.append((f'division-{division}', list(range(start, end))))
+    if task == 'taskB':
+        for code, division in enumerate(SECTION_DIVISIONS, 1):
+            cohorts.append((f'division-{division}', np.flatnonzero(divisions == code)))
 
         # ######## CALCULATE PER-LENGTH SCORES (bigger than --note_length_cutoff=512 vs not) ########
-        df_shortsrc = full_df[full_df['src_len'] <= args.note_length_cutoff]
-        if len(df_shortsrc) > 0:
-            indices = df_shortsrc.index.tolist()
+        # ( missing lengths are NaN, which is in neither cohort )
+        indices = np.flatnonzero(full & (src_lens <= note_length_cutoff))
+        if len(indices) > 0:
             cohorts.append(('shorter-src', indices))
 
-        df_longsrc = full_df[full_df['src_len'] > args.note_length_cutoff]
-        if len(df_longsrc) > 0:
-            indices = df_longsrc.index.tolist()
+        indices = np.flatnonzero(full & (src_lens > note_length_cutoff))
+        if len(indices) > 0:
             cohorts.append(('longer-src', indices))
 
-    outputs = {k: filter_and_aggregate(all_scores, idxs) for (k, idxs) in cohorts}
+    return cohorts
 
-    # ###### OUTPUT TO JSON FILE ########
-    fn_out = f'{args.experiment}_results.json'
+
+def score_instances(args, references, predictions, loaded=None, timer=None, plan=None, on_metric=None):
+    """
+    Scores every instance with the --metrics scorers, in worker processes if --metric_workers > 1.
+    plan is the plan_scoring plan of the instances, made here if None. on_metric( name, all_scores ) is called
+    as each scorer completes, with the scores of the scorers done so far.
+    Returns all_scores, scorer_stats and cache_stats as score_sequentially, and the number of unique pairs
+    """
+    if plan is None:
+        plan = plan_scoring(references, predictions)
+    if timer is None:
+        timer = Instrumentation()
+    print(f'Scoring plan: {len(references)} instances, {len(plan[0])} unique pairs')
+
+    # with --section_scoring full_note bert_scorer scores the instances itself rather than the unique pairs
+    from_full_notes = args.section_scoring == 'full_note' and 'bert_scorer' in args.metrics
+    names = [name for name in args.metrics if not (from_full_notes and name == 'bert_scorer')]
+    if args.metric_workers > 1:
+        all_scores, scorer_stats, cache_stats = score_in_workers(
+            names, plan, args.metric_workers, backends=args.backends, metric_cores=args.metric_cores,
+            score_cache_path=args.score_cache, score_cache_max_entries=args.score_cache_max_entries,
+            max_tokens_per_batch=args.max_tokens_per_batch, timer=timer, on_metric=on_metric
+        )
+    else:
+        all_scores, scorer_stats, cache_stats = score_sequentially(
+            names, plan, backends=args.backends,
+            score_cache_path=args.score_cache, score_cache_max_entries=args.score_cache_max_entries,
+            max_tokens_per_batch=args.max_tokens_per_batch, loaded=loaded, timer=timer, on_metric=on_metric
+        )
+
+    if from_full_notes:
+        if loaded is None:
+            loaded = {}
+        if 'bert_scorer' not in loaded:
+            print('Loading bert_scorer')
+            with timer.stage('load_bert_scorer'):
+                loaded['bert_scorer'] = load_scorer('bert_scorer', 'full_note')
+        scorer, kwargs, keys, save_keys = loaded['bert_scorer']
+        with timer.stage('score_bert_scorer') as stage:
+            scores, counts = scorer.score_instances(references, predictions, **kwargs)
+            # pairs the encoder scored on their own, the section divisions derived from them are saved
+            stage['instances'] = counts['full_notes'] + counts['reencoded']
+        scorer_stats['bert_scorer'] = {'scored': stage['instances'], 'section_scoring': counts}
+        all_scores.update({save_key: scores[key] for key, save_key in zip(keys, save_keys)})
+        all_scores = {save_key: all_scores[save_key] for name in args.metrics for save_key in SCORERS[name][3]}
+        if on_metric is not None:
+            on_metric('bert_scorer', all_scores)
+    return all_scores, scorer_stats, cache_stats, len(plan[0])
+
+
+def section_scoring_info(args, counts=None):
+    """
+    The --section_scoring mode the section division BERTScores were computed with, and with full_note the counts
+    of instances scored each way. None when no section division is scored with bert_scorer.
+    """
+    if args.task != 'taskB' or 'bert_scorer' not in args.metrics:
+        return None
+    info = {'mode': args.section_scoring}
+    if args.section_scoring == 'full_note':
+        info['instances'] = counts or {}
+    return info
+
+
+def add_stats(total, stats):
+    for key, val in stats.items():
+        total[key] = total.get(key, 0) + val
+
+
+def _lockstep_chunks(args, chunk_size):
+    """
+    Reads the gold and system files ( csv, Parquet or Arrow IPC ) chunk_size rows at a time and yields (references, predictions) frames
+    of the ids found on both sides so far, holding back ids whose counterpart has not been read yet.
+    """
+    import pandas as pd
+    readers = [read_chunks(args.fn_gold, chunk_size), read_chunks(args.fn_sys[0], chunk_size)]
+    pending = [None, None]
+    while readers[0] is not None or readers[1] is not None:
+        for side, reader in enumerate(readers):
+            if reader is None:
+                continue
+            try:
+                chunk = next(reader)
+            except StopIteration:
+                readers[side] = None
+                continue
+            pending[side] = chunk if pending[side] is None else pd.concat([pending[side], chunk], ignore_index=True)
+
+        if pending[0] is None or pending[1] is None:
+            continue
+        matched = [pending[side][args.id_column].isin(pending[1 - side][args.id_column]) for side in range(2)]
+        if matched[0].any():
+            yield pending[0][matched[0]].reset_index(drop=True), pending[1][matched[1]].reset_index(drop=True)
+        pending = [pending[side][~matched[side]].reset_index(drop=True) for side in range(2)]
+
+
+def stream_config(args):
+    """Everything a resumed run has to share with the interrupted one."""
+    return {
+        'fn_gold': os.path.abspath(args.fn_gold),
+        'fn_sys': os.path.abspath(args.fn_sys[0]),
+        'fn_metadata': None if args.fn_metadata is None else os.path.abspath(args.fn_metadata),
+        'input_sizes': [os.path.getsize(fn) for fn in [args.fn_gold, args.fn_sys[0], args.fn_metadata] if fn is not None],
+        'task': args.task,
+        'id_column': args.id_column,
+        'note_column': args.note_column,
+        'dialogue_column': args.dialogue_column,
+        'stream_chunk_size': args.stream_chunk_size,
+        'metrics': args.metrics,
+        'backends': args.backends,
+        'section_scoring': args.section_scoring,
+    }
+
+
+def stream_detected_divisions(args, df_metadata, timer):
+    """
+    The detect_divisions flags of all the notes a --stream_chunk_size run scores, from a first pass reading and
+    section-dividing them chunk by chunk. None if there are no notes.
+    """
+    detected = None
+    with timer.stage('section_detection') as stage:
+        stage['instances'] = 0
+        for df_references, df_predictions in _lockstep_chunks(args, args.stream_chunk_size):
+            full_df = merge_inputs(args, df_references, df_predictions, df_metadata)
+            flags = detect_divisions(args, full_df['reference'].tolist(), full_df['prediction'].tolist())
+            if detected is not None:
+                flags = {side: [a or b for a, b in zip(detected[side], flags[side])] for side in flags}
+            detected = flags
+            stage['instances'] += len(full_df)
+    return detected
+
+
+def write_checkpoint(fn, checkpoint):
+    # write then rename, so an interruption never leaves a partial checkpoint behind
+    with open(fn + '.tmp', 'w') as fd:
+        json.dump(checkpoint, fd, indent=4)
+    os.replace(fn + '.tmp', fn)
+
+
+def score_streaming(args, timer, loaded=None):
+    """
+    Merges, section-divides and scores --stream_chunk_size notes at a time, appending every instance with its
+    scores to {experiment}_instances.jsonl and checkpointing after each chunk. A run interrupted part way
+    resumes after its last completed chunk, provided it is restarted with the same inputs and options.
+    For taskB the divisions detected in all the notes are found by a first pass over the inputs and kept in the
+    checkpoint, so every chunk scores a missing division as a single run of all the notes does.
+    The cohort means of the chunks done so far are saved as partial results after each chunk.
+    loaded keeps the scorers as in score_sequentially.
+    Returns the instances file name, the scoring_plan counts, the score cache stats and the --section_scoring
+    full_note counts
+    """
+    fn_instances = f'{args.experiment}_instances.jsonl'
+    fn_checkpoint = f'{args.experiment}_checkpoint.json'
+    config = stream_config(args)
+
+    checkpoint = {
+        'config': config, 'chunks_done': 0, 'offset': 0, 'scoring_plan': {}, 'score_cache': {}, 'section_scoring': {},
+        'cohort_totals': {}, 'detected_divisions': None,
+    }
+    if os.path.exists(fn_checkpoint):
+        with open(fn_checkpoint) as fd:
+            previous = json.load(fd)
+        if previous['config'] != config:
+            print(f'{fn_checkpoint} was written with different inputs or options, remove it or use another --experiment')
+            sys.exit(1)
+        checkpoint = previous
+        print(f'Resuming from {fn_checkpoint} after {checkpoint["chunks_done"]} chunks')
+    # running cohort sums for the partial results, kept in the checkpoint
+    totals = CohortTotals(checkpoint['cohort_totals'])
+
+    # drop anything written after the last checkpoint
+    with open(fn_instances, 'a') as fd:
+        fd.truncate(checkpoint['offset'])
+
+    df_metadata = read_table(args.fn_metadata) if args.fn_metadata is not None else None
+    if args.task == 'taskB' and checkpoint.get('detected_divisions') is None:
+        checkpoint['detected_divisions'] = stream_detected_divisions(args, df_metadata, timer)
+    if loaded is None:
+        loaded = {}
+    chunks = enumerate(_lockstep_chunks(args, args.stream_chunk_size))
+    while True:
+        with timer.stage('load_data') as stage:
+            chunk_num, (df_references, df_predictions) = next(chunks, (None, (None, None)))
+            stage['instances'] = 0 if df_references is None else len(df_references)
+        if chunk_num is None:
+            break
+        if chunk_num < checkpoint['chunks_done']:
+            continue
+        with timer.stage('merge') as stage:
+            full_df = merge_inputs(args, df_references, df_predictions, df_metadata)
+            stage['instances'] = len(full_df)
+
+        with timer.stage('section_division') as stage:
+            full_df, references, predictions, instance_info = build_instances(
+                args, full_df, detected=checkpoint.get('detected_divisions')
+            )
+            stage['instances'] = len(full_df)
+        print(f'Chunk {chunk_num + 1}: {len(full_df)} notes')
+
+        all_scores, scorer_stats, cache_stats, num_unique = score_instances(
+            args, references, predictions, loaded, timer=timer
+        )
+        add_stats(checkpoint['scoring_plan'], {'instances': len(references), 'unique_pairs': num_unique})
+        for name in args.metrics:
+            add_stats(checkpoint['scoring_plan'], {
+                f'{name}_scored': scorer_stats[name]['scored'],
+                f'{name}_saved': len(references) - scorer_stats[name]['scored'],
+            })
+        add_stats(checkpoint['score_cache'], cache_stats)
+        add_stats(checkpoint['section_scoring'], scorer_stats.get('bert_scorer', {}).get('section_scoring', {}))
+        score_keys, scores = score_matrix(all_scores)
+        totals.add(score_keys, scores, build_cohorts(instance_info, args.task, args.note_length_cutoff))
+
+        with timer.stage('write_instances') as stage:
+            with open(fn_instances, 'a') as fd:
+                for ind in range(len(references)):
+                    fd.write(json.dumps(instance_record(instance_info, all_scores, ind)) + '\n')
+                fd.flush()
+                os.fsync(fd.fileno())
+                checkpoint['offset'] = fd.tell()
+            checkpoint['chunks_done'] = chunk_num + 1
+            write_checkpoint(fn_checkpoint, checkpoint)
+            stage['instances'] = len(references)
+
+        snapshot = totals.means()
+        snapshot['scoring_plan'] = checkpoint['scoring_plan']
+        snapshot['progress'] = {
+            'complete': False,
+            'chunks_done': checkpoint['chunks_done'],
+            'instances_done': checkpoint['scoring_plan']['instances'],
+            'elapsed_seconds': time.time() - timer.start_time,
+        }
+        write_snapshots(args.experiment, {'stream': snapshot})
+
+    return fn_instances, checkpoint['scoring_plan'], checkpoint['score_cache'], checkpoint['section_scoring']
+
+
+def instance_record(instance_info, all_scores, ind):
+    """The line of instance ind in a per-instance file, its division by name."""
+    record = {key: vals[ind] for key, vals in instance_info.items()}
+    record['division'] = DIVISION_NAMES[record['division']]
+    record.update({key: float(vals[ind]) for key, vals in all_scores.items()})
+    return record
+
+
+def read_instances(fn, score_keys, extra_keys=()):
+    """
+    Reads back a per-instance file as instance_info and all_scores ( score key -> per-instance scores ).
+    extra_keys are read into instance_info too, as the shard keys of --shard files.
+    """
+    instance_info = {key: [] for key in ['id', 'division', 'dataset', 'src_len'] + list(extra_keys)}
+    all_scores = {key: [] for key in score_keys}
+    with open(fn) as fd:
+        for line in fd:
+            record = json.loads(line)
+            for key, vals in instance_info.items():
+                vals.append(record[key])
+            for key, vals in all_scores.items():
+                vals.append(record[key])
+    name2code = {name: code for code, name in enumerate(DIVISION_NAMES)}
+    instance_info['division'] = np.array([name2code[name] for name in instance_info['division']], dtype=np.int8)
+    return instance_info, all_scores
+
+
+# hex digits of pair_hash kept per instance in --shard files, enough to tell the pairs of any corpus apart
+PAIR_DIGEST_LENGTH = 16
+
+
+def shard_of(note_id, num_shards):
+    # crc32 of the id as text, the same in every process and on every machine ( unlike the salted hash() )
+    return zlib.crc32(str(note_id).encode('utf-8')) % num_shards
+
+
+def shard_file_names(experiment, shard, num_shards):
+    """The per-instance file and the manifest of shard i of N."""
+    prefix = f'{experiment}_shard-{shard}-of-{num_shards}'
+    return f'{prefix}.jsonl', f'{prefix}.json'
+
+
+def shard_config(args):
+    """Everything the shards of one evaluation have to share, with what merge_shards.py needs to aggregate them."""
+    return {
+        'task': args.task,
+        'id_column': args.id_column,
+        'note_column': args.note_column,
+        'dialogue_column': args.dialogue_column,
+        'metrics': args.metrics,
+        'backends': args.backends,
+        'note_length_cutoff': args.note_length_cutoff,
+        'bootstrap': args.bootstrap,
+        'bootstrap_seed': args.bootstrap_seed,
+        'score_cache': args.score_cache is not None,
+        'section_scoring': args.section_scoring,
+    }
+
+
+def notes_digest(full_df, id_column):
+    """sha256 of the ids and notes of the merged inputs, the same for every shard of the same inputs."""
+    digest = hashlib.sha256()
+    for row in zip(full_df[id_column].tolist(), full_df['reference'].tolist(), full_df['prediction'].tolist()):
+        digest.update(json.dumps([str(val) for val in row]).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def score_shard(args, timer, loaded=None):
+    """
+    Scores only the notes of shard args.shard = (i, N), those shard_of puts in i, writing every instance with its
+    scores, cohort keys and position in a single-process run to {experiment}_shard-i-of-N.jsonl, then the manifest
+    {experiment}_shard-i-of-N.json merge_shards.py checks and combines the shards with.
+    The whole inputs are read, validated, merged and section-divided by every shard, which is cheap next to scoring.
+    loaded keeps the scorers as in score_sequentially.
+    Returns the manifest
+    """
+    shard, num_shards = args.shard
+    fn_instances, fn_manifest = shard_file_names(args.experiment, shard, num_shards)
+
+    with timer.stage('load_data') as stage:
+        df_references = read_table(args.fn_gold)
+        df_predictions = read_table(args.fn_sys[0])
+        df_metadata = read_table(args.fn_metadata) if args.fn_metadata is not None else None
+        stage['instances'] = len(df_references)
+    with timer.stage('validate') as stage:
+        stage['instances'] = test_id_range(args, args.fn_sys[0])
+    with timer.stage('merge') as stage:
+        full_df = merge_inputs(args, df_references, df_predictions, df_metadata)
+        stage['instances'] = len(full_df)
+
+    ids = full_df[args.id_column].tolist()
+    rows = np.flatnonzero([shard_of(note_id, num_shards) == shard for note_id in ids])
+    print(f'Shard {shard}/{num_shards}: {len(rows)} of {len(ids)} notes')
+    with timer.stage('section_division') as stage:
+        # the divisions of all the notes, not only of the shard's, decide how a missing division is scored
+        detected = None
+        if args.task == 'taskB':
+            detected = detect_divisions(args, full_df['reference'].tolist(), full_df['prediction'].tolist())
+        _, references, predictions, instance_info = build_instances(
+            args, full_df.iloc[rows].reset_index(drop=True), detected=detected
+        )
+        stage['instances'] = len(full_df)
+
+    plan = plan_scoring(references, predictions)
+    all_scores, scorer_stats, cache_stats, _ = score_instances(
+        args, references, predictions, loaded=loaded, timer=timer, plan=plan
+    )
+
+    with timer.stage('write_instances') as stage:
+        # a single-process run has the notes of each division in turn, in the order of the merged inputs
+        positions = instance_info['division'].astype(np.int64) * len(ids) + np.tile(rows, references.num_blocks)
+        unique_pairs, pair_positions, kinds = plan
+        digests = [pair_hash(ref, pred)[:PAIR_DIGEST_LENGTH] for ref, pred in unique_pairs]
+        with open(fn_instances, 'w') as fd:
+            for ind in range(len(references)):
+                record = instance_record(instance_info, all_scores, ind)
+                record['position'] = int(positions[ind])
+                record['pair'] = digests[pair_positions[ind]]
+                record['trivial'] = kinds[pair_positions[ind]]
+                fd.write(json.dumps(record) + '\n')
+        stage['instances'] = len(references)
+
+    manifest = {
+        'config': shard_config(args),
+        'shard': shard,
+        'num_shards': num_shards,
+        'notes': len(ids),
+        'divisions': references.num_blocks,
+        'notes_digest': notes_digest(full_df, args.id_column),
+        'detected_divisions': detected,
+        'instances_file': os.path.basename(fn_instances),
+        'instances': len(references),
+        'scored': {name: scorer_stats[name]['scored'] for name in args.metrics},
+        'score_cache': cache_stats,
+        'section_scoring': scorer_stats.get('bert_scorer', {}).get('section_scoring', {}),
+        'timings': timer.summary(),
+    }
+    # written last, a manifest is only there once its shard is complete
+    write_checkpoint(fn_manifest, manifest)
+    print(f'Shard instances saved to {fn_instances}, manifest to {fn_manifest}')
+    return manifest
+
+
+def list_systems(fn_systems, note_columns):
+    """Returns (system name, file, note column) for every file and column, named after the file (and column)."""
+    systems = []
+    for fn in fn_systems:
+        for column in note_columns:
+            name = os.path.splitext(os.path.basename(fn))[0]
+            if len(note_columns) > 1:
+                name = f'{name}_{column}'
+            if name in [system[0] for system in systems]:
+                name = f'{name}_{len(systems)}'
+            systems.append((name, fn, column))
+    return systems
+
+
+def divide_references(args, df_references):
+    """
+    Section-divides the gold notes once, so every system merged with them only divides its own predictions.
+    Returns df_references with each note's row as _reference_row, and the span table of the notes ( None unless taskB )
+    """
+    df_references = df_references.rename(columns={args.note_column: 'reference'})
+    df_references['_reference_row'] = np.arange(len(df_references))
+    reference_spans = None
+    if args.task == 'taskB':
+        reference_spans = SectionSpans.from_notes(df_references['reference'].tolist(), workers=args.section_workers)
+    return df_references, reference_spans
+
+
+def score_matrix(all_scores):
+    """Stacks per-instance scores into an instances x metrics matrix, returning the metric keys and the matrix."""
+    keys = list(all_scores)
+    matrix = np.empty((len(next(iter(all_scores.values()), [])), len(keys)), dtype=np.float64)
+    for col, key in enumerate(keys):
+        matrix[:, col] = all_scores[key]
+    return keys, matrix
+
+
+def cohort_matrix(cohorts, num_instances):
+    """instances x cohorts 0/1 matrix of cohort membership."""
+    membership = np.zeros((num_instances, len(cohorts)), dtype=np.float64)
+    for col, (_, indices) in enumerate(cohorts):
+        membership[indices, col] = 1.0
+    return membership
+
+
+def aggregate_cohorts(keys, matrix, cohorts):
+    """Returns cohort -> {metric key: mean over the cohort instances} for every cohort in one pass."""
+    # concatenate the cohorts' rows and sum each cohort's run of rows at once
+    sizes = np.array([len(indices) for _, indices in cohorts], dtype=np.int64)
+    rows = np.concatenate([indices for _, indices in cohorts] + [np.zeros(0, dtype=np.int64)])
+    starts = np.cumsum(sizes) - sizes
+    means = np.full((len(cohorts), len(keys)), np.nan)
+    nonempty = sizes > 0
+    if nonempty.any():
+        sums = np.add.reduceat(matrix[rows], starts[nonempty], axis=0)
+        means[nonempty] = sums / sizes[nonempty, None]
+    return {name: dict(zip(keys, means[ind].tolist())) for ind, (name, _) in enumerate(cohorts)}
+
+
+def bootstrap_cohorts(keys, matrix, cohorts, num_resamples, seed=0, confidence=0.95, block_size=4096):
+    """
+    Poisson bootstrap of every cohort mean at once: each resample weights every instance by a Poisson(1) count,
+    so all cohorts and metrics are resampled together with one weight matrix, built block by block of instances
+    to keep memory bounded. Returns cohort -> {metric key: [low, high]} confidence intervals.
+    """
+    rng = np.random.default_rng(seed)
+    num_instances, num_keys = matrix.shape
+    membership = cohort_matrix(cohorts, num_instances)
+    num_cohorts = len(cohorts)
+
+    weighted_sums = np.zeros((num_resamples, num_cohorts * num_keys))
+    weight_totals = np.zeros((num_resamples, num_cohorts))
+    for start in range(0, num_instances, block_size):
+        end = min(start + block_size, num_instances)
+        weights = rng.poisson(1.0, size=(num_resamples, end - start)).astype(np.float64)
+        block = membership[start:end]
+        # instances x (cohorts x metrics): each score repeated in the column of every cohort containing it
+        values = (block[:, :, None] * matrix[start:end, None, :]).reshape(end - start, -1)
+        weighted_sums += weights @ values
+        weight_totals += weights @ block
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = weighted_sums.reshape(num_resamples, num_cohorts, num_keys) / weight_totals[:, :, None]
+    alpha = (1.0 - confidence) / 2
+    lows, highs = np.nanquantile(means, [alpha, 1.0 - alpha], axis=0)
+    return {
+        name: {key: [lows[ind, col], highs[ind, col]] for col, key in enumerate(keys)}
+        for ind, (name, _) in enumerate(cohorts)
+    }
+
+
+def division_deviations(keys, scores, reference_scores, divisions, mean_names=('mean', 'reference_mean')):
+    """
+    How far per-instance scores ( key -> scores ) are from reference_scores of the same instances, per division
+    with instances and score key: instances, mean and largest absolute difference, mean difference, correlation
+    and the means of the scores and of the reference scores, under mean_names.
+    """
+    report = {}
+    for code, division in enumerate(DIVISION_NAMES):
+        indices = np.flatnonzero(np.asarray(divisions) == code)
+        if len(indices) == 0:
+            continue
+        report[division] = {}
+        for key in keys:
+            new = np.asarray(scores[key], dtype=np.float64)[indices]
+            old = np.asarray(reference_scores[key], dtype=np.float64)[indices]
+            diff = new - old
+            correlated = len(indices) > 1 and new.std() > 0 and old.std() > 0
+            report[division][key] = {
+                'instances': int(len(indices)),
+                'mean_abs_diff': float(np.abs(diff).mean()),
+                'max_abs_diff': float(np.abs(diff).max()),
+                'mean_diff': float(diff.mean()),
+                'pearson': float(np.corrcoef(new, old)[0, 1]) if correlated else None,
+                mean_names[0]: float(new.mean()),
+                mean_names[1]: float(old.mean()),
+            }
+    return report
+
+
+def system_results(args, score_keys, scores, instance_info, scoring_plan, cache_stats, timer, section_scoring=None):
+    """
+    The results of one system from its instances x metrics scores: the cohort means, scoring_plan, the --backends
+    if any were selected, the section_scoring_info, the --bootstrap intervals and the score cache stats if
+    --score_cache was used.
+    Returns the results as saved in the results file, and the intervals
+    """
+    with timer.stage('aggregate') as stage:
+        cohorts = build_cohorts(instance_info, args.task, args.note_length_cutoff)
+        outputs = aggregate_cohorts(score_keys, scores, cohorts)
+        outputs['scoring_plan'] = scoring_plan
+        if args.backends is not None:
+            outputs['backends'] = args.backends
+        if section_scoring is not None:
+            outputs['section_scoring'] = section_scoring
+        stage['instances'] = len(scores)
+    intervals = {}
+    if args.bootstrap > 0:
+        with timer.stage('bootstrap') as stage:
+            intervals = bootstrap_cohorts(score_keys, scores, cohorts, args.bootstrap, seed=args.bootstrap_seed)
+            stage['instances'] = len(scores)
+        outputs['bootstrap'] = {'resamples': args.bootstrap, 'seed': args.bootstrap_seed, 'confidence': 0.95}
+        outputs['bootstrap']['intervals'] = {
+            cohort: {k: [float(v) for v in bounds] for k, bounds in obj.items()} for cohort, obj in intervals.items()
+        }
+    if args.score_cache is not None:
+        outputs['score_cache'] = cache_stats
+    return outputs, intervals
+
+
+def write_metric_snapshots(args, system_instances, done_scores, timer):
+    """
+    Saves every system's cohort means of the scorers done so far ( done_scores, as on_metric gets them ) as partial
+    results with a 'progress' block, unless all the scorers are done and the results follow.
+    """
+    done = [name for name in args.metrics if SCORERS[name][3][0] in done_scores]
+    if len(done) == len(args.metrics):
+        return
+    score_keys, scores = score_matrix(done_scores)
+    snapshots = {}
+    for system, (instance_info, start, end) in system_instances.items():
+        cohorts = build_cohorts(instance_info, args.task, args.note_length_cutoff)
+        snapshots[system] = aggregate_cohorts(score_keys, scores[start:end], cohorts)
+        snapshots[system]['progress'] = {
+            'complete': False,
+            'metrics_done': done,
+            'metrics_pending': [name for name in args.metrics if name not in done],
+            'elapsed_seconds': time.time() - timer.start_time,
+        }
+    write_snapshots(args.experiment, snapshots)
+
+
+def score_within_budget(args, references, predictions, system_instances, timer, loaded=None):
+    """
+    --time_budget: scores a stratified sample of the instances of every system in rounds ( see progressive.py ),
+    saving each system's cohort means estimated from the sample, with their standard errors, after every round.
+    Rounds go on until --time_budget seconds from the start of the run have passed or every instance is scored,
+    the first round is always scored.
+    Returns system name -> results, the last round's being saved by the caller
+    """
+    if loaded is None:
+        loaded = {}
+    deadline = timer.start_time + args.time_budget
+    instance_infos = [instance_info for instance_info, _, _ in system_instances.values()]
+    strata, _ = stratify(instance_infos, args.note_length_cutoff)
+    sample = StratifiedSample(strata, sample_order(
+        [note_id for instance_info in instance_infos for note_id in instance_info['id']],
+        np.concatenate([instance_info['division'] for instance_info in instance_infos]), seed=args.budget_seed
+    ))
+    cohorts = {
+        system: build_cohorts(instance_info, args.task, args.note_length_cutoff)
+        for system, (instance_info, _, _) in system_instances.items()
+    }
+    score_keys = [save_key for name in args.metrics for save_key in SCORERS[name][3]]
+    scores = np.full((len(references), len(score_keys)), np.nan)
+    sampled = np.zeros(len(references), dtype=bool)
+    scoring_plan = {}
+    cache_stats = {}
+
+    size = FIRST_ROUND_SIZE
+    rounds = 0
+    while True:
+        start = time.time()
+        indices = sample.grow(size)
+        rounds += 1
+        print(f'Round {rounds}: scoring {len(indices)} more instances, {len(sample)} of {len(references)} sampled')
+        all_scores, scorer_stats, round_cache_stats, num_unique = score_instances(
+            args, [references[ind] for ind in indices], [predictions[ind] for ind in indices], loaded=loaded, timer=timer
+        )
+        for col, key in enumerate(score_keys):
+            scores[indices, col] = all_scores[key]
+        sampled[indices] = True
+        add_stats(scoring_plan, {'instances': len(indices), 'unique_pairs': num_unique})
+        for name in args.metrics:
+            add_stats(scoring_plan, {
+                f'{name}_scored': scorer_stats[name]['scored'],
+                f'{name}_saved': len(indices) - scorer_stats[name]['scored'],
+            })
+        add_stats(cache_stats, round_cache_stats)
+
+        system_outputs = {}
+        for system, (instance_info, first, end) in system_instances.items():
+            outputs, errors, num_sampled = stratified_estimates(
+                score_keys, scores[first:end], sampled[first:end], strata[first:end], cohorts[system]
+            )
+            outputs['scoring_plan'] = scoring_plan
+            if args.backends is not None:
+                outputs['backends'] = args.backends
+            section_scoring = section_scoring_info(args)
+            if section_scoring is not None:
+                outputs['section_scoring'] = section_scoring
+            outputs['estimate'] = {
+                'complete': sample.complete,
+                'rounds': rounds,
+                'time_budget': args.time_budget,
+                'seed': args.budget_seed,
+                'instances': int(end - first),
+                'sampled': int(sampled[first:end].sum()),
+                'cohort_sampled': num_sampled,
+                'standard_errors': errors,
+            }
+            if args.score_cache is not None:
+                outputs['score_cache'] = cache_stats
+            system_outputs[system] = outputs
+
+        seconds_per_instance = (time.time() - start) / max(len(indices), 1)
+        left = deadline - time.time()
+        if sample.complete or left <= 0:
+            return system_outputs
+        write_snapshots(args.experiment, system_outputs)
+        # at most double the sample, as much as the last round's rate fits in the time left
+        size = min(len(sample), int(left / seconds_per_instance))
+        if size < 1:
+            return system_outputs
+
+
+# results blocks that are not cohorts
+RESULTS_INFO_KEYS = ['scoring_plan', 'backends', 'section_scoring', 'score_cache', 'bootstrap', 'estimate', 'progress', 'timings']
+
+
+def results_file(experiment, system, num_systems):
+    """The results file of a system, named after it when several systems are evaluated together."""
+    if num_systems > 1:
+        return f'{experiment}_{system}_results.json'
+    return f'{experiment}_results.json'
+
+
+def save_results(fn_out, outputs, intervals):
     print(f'Saving results to {fn_out}')
-    with open(fn_out, 'w') as fd:
-        json.dump(outputs, fd, indent=4)
+    # replaces any partial results at once, see write_snapshots
+    write_checkpoint(fn_out, outputs)
 
+    errors = outputs.get('estimate', {}).get('standard_errors', {})
     for cohort, obj in outputs.items():
+        if cohort in RESULTS_INFO_KEYS:
+            continue
         print(cohort)
         for k, v in obj.items():
-            print(f'\t{k} -> {round(v, 3)}')
+            if k in intervals.get(cohort, {}):
+                low, high = intervals[cohort][k]
+                print(f'\t{k} -> {round(v, 3)} (95% CI {low:.3f} - {high:.3f})')
+            elif k in errors.get(cohort, {}):
+                print(f'\t{k} -> {round(v, 3)} (standard error {errors[cohort][k]:.3f})')
+            else:
+                print(f'\t{k} -> {round(v, 3)}')
+        print('\n')
+
+
+def leaderboard_frame(system_outputs):
+    """One row per system with a cohort/metric column for every cohort mean."""
+    import pandas as pd
+    rows = []
+    for system, outputs in system_outputs.items():
+        row = {'system': system}
+        for cohort, obj in outputs.items():
+            if cohort in RESULTS_INFO_KEYS:
+                continue
+            row.update({f'{cohort}/{k}': v for k, v in obj.items()})
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def write_leaderboard(fn_out, system_outputs):
+    """One row per system with a cohort/metric column for every cohort mean, saved as csv."""
+    leaderboard = leaderboard_frame(system_outputs)
+    print(f'Saving leaderboard to {fn_out}')
+    leaderboard.to_csv(fn_out + '.tmp', index=False)
+    os.replace(fn_out + '.tmp', fn_out)
+    return leaderboard
+
+
+def write_snapshots(experiment, system_outputs):
+    """
+    Writes the partial results of every system over its results file ( and of several systems the leaderboard ),
+    replacing each file at once so that a reader never sees a half-written one.
+    """
+    for system, outputs in system_outputs.items():
+        write_checkpoint(results_file(experiment, system, len(system_outputs)), outputs)
+    if len(system_outputs) > 1:
+        fn_leaderboard = f'{experiment}_leaderboard.csv'
+        leaderboard_frame(system_outputs).to_csv(fn_leaderboard + '.tmp', index=False)
+        os.replace(fn_leaderboard + '.tmp', fn_leaderboard)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='evaluate_summarization',
+        description='This runs basic evaluation for both snippet (taskA) and full note summarization (taskB).'
+    )
+    parser.add_argument('--fn_gold', required=True, help='filename of gold references requires id and note column ( csv, or Parquet/Arrow IPC by extension ).')
+    parser.add_argument(
+        '--fn_sys', required=True, nargs='+',
+        help='filename of system references requires id and note column, several files are scored as a leaderboard.'
+    )
+    parser.add_argument(
+        '--metadata_file', dest='fn_metadata', action='store', default=None,
+        help='filename of metadata requires id and dataset column.'
+    )
+    parser.add_argument(
+        '--task', action='store', default='taskB',
+        help='summarization task, default is for full note (taskB). (use snippet, taskA, otherwise).'
+    )
+    parser.add_argument('--id_column', default='TestID', help='column to use for identifying id.')
+    parser.add_argument('--note_column', default='SystemOutput', help='column to use for identifying note.')
+    parser.add_argument(
+        '--sys_note_columns', default=None, type=lambda value: value.split(','),
+        help='comma separated note columns of the system files to score as separate systems, e.g. '
+             'SystemOutput1,SystemOutput2 (default --note_column).'
+    )
+    parser.add_argument('--dialogue_column', default='dialogue', help='column to use for identifying dialogue.')
+    parser.add_argument(
+        '--use_section_check', action='store_true', default=False,
+        help='this flag with make sure evaluation shuts down for full task if 0 section divisions are detected.'
+    )
+    parser.add_argument(
+        '--note_length_cutoff', default=512, type=int,
+        help='Consider less than note_length_cutoff to be short and vice-versa for long'
+    )
+    parser.add_argument(
+        '--section_workers', default=None, type=int,
+        help='processes used for section division of large files (default is cpu count, small files run serially).'
+    )
+    parser.add_argument(
+        '--score_cache', default=None,
+        help='sqlite file caching per-instance scores between runs, only unseen pairs are scored (off by default).'
+    )
+    parser.add_argument(
+        '--score_cache_max_entries', default=DEFAULT_MAX_ENTRIES, type=int,
+        help='least recently used scores are evicted from --score_cache past this many entries.'
+    )
+    parser.add_argument(
+        '--max_tokens_per_batch', default=DEFAULT_MAX_TOKENS_PER_BATCH, type=int,
+        help='BERTScore/BLEURT pairs are sorted by length and batched so batch size x longest pair stays under this.'
+    )
+    parser.add_argument(
+        '--metrics', default='rouge,bertscore,bleurt', type=parse_metrics,
+        help='comma separated metrics to compute, only the selected backends are imported and loaded.'
+    )
+    parser.add_argument(
+        '--backends', default=None, type=parse_backends,
+        help='backend per scorer, e.g. rouge=native,bert_scorer=int8,bluert=d6 (default: huggingface, the evaluate '
+             'metrics; rouge=native is the built-in ROUGE matching rouge_score, see cpu_backends.py for the '
+             'CPU-optimized BERTScore and BLEURT backends).'
+    )
+    parser.add_argument(
+        '--bertscore_store', default=None,
+        help='embedding store of the gold references written by embedding_store.py, BERTScore then only encodes '
+             'the predictions (selects the bert_scorer=store backend).'
+    )
+    parser.add_argument(
+        '--section_scoring', default='reencode', choices=SECTION_SCORING_MODES,
+        help='taskB section divisions for BERTScore: encoded on their own (reencode, default), or scored within the '
+             'embeddings of their full notes (full_note, about 5x less encoding, see section_scores.py).'
+    )
+    parser.add_argument(
+        '--metric_workers', default=1, type=int,
+        help='run up to this many scorers at once, each in its own process (default 1 runs them in turn in-process).'
+    )
+    parser.add_argument(
+        '--metric_cores', default=None, type=parse_metric_cores,
+        help='cores per scorer worker, e.g. rouge=1,bert_scorer=8,bluert=7 (default rouge=1, others split the rest).'
+    )
+    parser.add_argument(
+        '--stream_chunk_size', default=None, type=int,
+        help='read and score the inputs this many notes at a time, writing per-instance scores to '
+             '{experiment}_instances.jsonl and resuming an interrupted run from its last completed chunk.'
+    )
+    parser.add_argument(
+        '--shard', default=None, type=parse_shard,
+        help='score only shard i/N of the notes ( split by id ), writing {experiment}_shard-i-of-N.jsonl/.json for '
+             'merge_shards.py to combine into the results of a single run.'
+    )
+    parser.add_argument(
+        '--bootstrap', default=0, type=int,
+        help='resample every cohort this many times and report 95%% confidence intervals of the means (off by default).'
+    )
+    parser.add_argument('--bootstrap_seed', default=0, type=int, help='random seed of --bootstrap resampling.')
+    parser.add_argument(
+        '--time_budget', default=None, type=float,
+        help='score a stratified random sample of the instances in growing rounds until this many seconds from the '
+             'start have passed ( or all are scored ), saving cohort estimates with standard errors after every round.'
+    )
+    parser.add_argument('--budget_seed', default=0, type=int, help='random seed of the --time_budget sample.')
+    parser.add_argument(
+        '--trace', default=None,
+        help='save the timed stages as a Chrome trace event file (chrome://tracing or Perfetto) to this path.'
+    )
+    parser.add_argument(
+        '--profile_dir', default=None,
+        help='run every stage under cProfile and dump one {stage}.prof per stage into this directory.'
+    )
+    parser.add_argument('--experiment', default='default', help='Prefix for save file.')
+    parser.add_argument('-debug', default=False, action='store_true', help='If true, just runs eval over first example')
+    return parser
+
+
+def check_options(args):
+    """Raises ValueError for options that cannot be combined."""
+    if args.section_scoring == 'full_note':
+        if args.bertscore_store is not None or (args.backends or {}).get('bert_scorer') not in [None, 'full_note']:
+            raise ValueError('--section_scoring full_note scores BERTScore with the full_note bert_scorer backend only')
+    if args.stream_chunk_size is not None:
+        if args.metric_workers > 1:
+            raise ValueError('--stream_chunk_size scores each chunk in-process, it cannot be combined with --metric_workers')
+        if len(args.fn_sys) > 1 or args.sys_note_columns is not None:
+            raise ValueError('--stream_chunk_size evaluates a single system, use one --fn_sys and --note_column')
+    if args.shard is not None:
+        if args.stream_chunk_size is not None:
+            raise ValueError('--shard scores its notes at once, it cannot be combined with --stream_chunk_size')
+        if len(args.fn_sys) > 1 or args.sys_note_columns is not None:
+            raise ValueError('--shard evaluates a single system, use one --fn_sys and --note_column')
+    if args.time_budget is not None:
+        if args.time_budget <= 0:
+            raise ValueError('--time_budget is a number of seconds above 0')
+        if args.stream_chunk_size is not None or args.shard is not None:
+            raise ValueError('--time_budget samples all the notes at once, it cannot be combined with --stream_chunk_size or --shard')
+        if args.metric_workers > 1:
+            raise ValueError('--time_budget scores its rounds in-process, it cannot be combined with --metric_workers')
+        if args.section_scoring == 'full_note':
+            raise ValueError('--time_budget scores sampled instances, not whole notes as --section_scoring full_note does')
+        if args.bootstrap > 0:
+            raise ValueError('--time_budget reports standard errors of its estimates rather than --bootstrap intervals')
+
+
+def evaluate(args, loaded=None, timer=None):
+    """
+    Runs the evaluation of parsed command line args, saving the results files as the command line does.
+    loaded ( name -> load_scorer output ) reuses already loaded scorers, timer times the stages.
+    Returns system name -> results, as saved in the results files ( empty for a --shard run, see score_shard ).
+    """
+    if args.bertscore_store is not None:
+        os.environ[BERTSCORE_STORE_ENV] = os.path.abspath(args.bertscore_store)
+        args.backends = dict(args.backends or {})
+        args.backends.setdefault('bert_scorer', 'store')
+    if args.section_scoring == 'full_note':
+        args.backends = dict(args.backends or {})
+        args.backends['bert_scorer'] = 'full_note'
+
+    if timer is None:
+        timer = Instrumentation(profile_dir=args.profile_dir)
+
+    systems = list_systems(args.fn_sys, args.sys_note_columns or [args.note_column])
+    # results already estimated by --time_budget
+    system_outputs = None
+
+    if args.shard is not None:
+        # results only once merge_shards.py has combined all the shards
+        score_shard(args, timer, loaded=loaded)
+        return {}
+
+    if args.stream_chunk_size is not None:
+        # Check id formatting, the file is streamed row by row like the notes are read chunk by chunk
+        with timer.stage('validate') as stage:
+            stage['instances'] = test_id_range(args, args.fn_sys[0])
+        fn_instances, scoring_plan, cache_stats, section_counts = score_streaming(args, timer, loaded=loaded)
+        print(f'Per-instance scores saved to {fn_instances}')
+
+        with timer.stage('read_instances') as stage:
+            instance_info, all_scores = read_instances(
+                fn_instances, [save_key for name in args.metrics for save_key in SCORERS[name][3]]
+            )
+            stage['instances'] = len(instance_info['id'])
+        system_instances = {systems[0][0]: (instance_info, 0, len(instance_info['id']))}
+    else:
+        # Read in reference/hyp files -added the latin encoding as one of the participants' file had a strange character somewhere
+        #df_references = pd.read_csv(args.fn_gold, encoding='latin1')
+        #df_predictions = pd.read_csv(args.fn_sys, encoding='latin1')
+        with timer.stage('load_data') as stage:
+            df_references = read_table(args.fn_gold)
+            print(f'Gold path: {args.fn_gold} ({len(df_references)} summaries)')
+
+            # read in metadata file - if none exists, just creates a dummy
+            df_metadata = read_table(args.fn_metadata) if args.fn_metadata is not None else None
+            stage['instances'] = len(df_references)
+
+        # with several systems the gold notes are divided once here rather than once per system
+        reference_spans = None
+        if len(systems) > 1:
+            with timer.stage('section_division') as stage:
+                df_references, reference_spans = divide_references(args, df_references)
+                stage['instances'] = len(df_references)
+        # the gold ids are looked up by every system's join
+        reference_index = id_index(df_references, args.id_column)
+
+        # instances of every system are scored in one pass, system_instances keeps each system's slice of them
+        references = ConcatTexts()
+        predictions = ConcatTexts()
+        system_instances = {}
+        sys_dfs = {}
+        for name, fn_sys, column in systems:
+            if fn_sys not in sys_dfs:
+                with timer.stage('load_data') as stage:
+                    sys_dfs[fn_sys] = read_table(fn_sys)
+                    print(f'System path: {fn_sys} ({len(sys_dfs[fn_sys])} summaries)')
+                    stage['instances'] = len(sys_dfs[fn_sys])
+
+                # Check id formatting to determine if something obvious is amiss based on encounter id's and task
+                with timer.stage('validate') as stage:
+                    stage['instances'] = test_id_range(args, fn_sys)
+            df_predictions = sys_dfs[fn_sys]
+            if args.sys_note_columns is not None:
+                df_predictions = df_predictions[[args.id_column, column]].rename(columns={column: 'prediction'})
+
+            with timer.stage('merge') as stage:
+                full_df = merge_inputs(args, df_references, df_predictions, df_metadata, reference_index)
+                stage['instances'] = len(full_df)
+
+            with timer.stage('section_division') as stage:
+                full_df, sys_references, sys_predictions, instance_info = build_instances(args, full_df, reference_spans)
+                stage['instances'] = len(full_df)
+            system_instances[name] = (instance_info, len(references), len(references) + len(sys_references))
+            references.append(sys_references)
+            predictions.append(sys_predictions)
+
+        ######## CALCULATE PER INSTANCE SCORES ########
+        if args.time_budget is not None:
+            system_outputs = score_within_budget(args, references, predictions, system_instances, timer, loaded=loaded)
+            system_intervals = {system: {} for system in system_outputs}
+            scoring_plan = next(iter(system_outputs.values()))['scoring_plan']
+        else:
+            # every system's partial results are saved as each scorer completes
+            all_scores, scorer_stats, cache_stats, num_unique = score_instances(
+                args, references, predictions, loaded=loaded, timer=timer,
+                on_metric=lambda name, done_scores: write_metric_snapshots(args, system_instances, done_scores, timer)
+            )
+            section_counts = scorer_stats.get('bert_scorer', {}).get('section_scoring')
+
+            scoring_plan = {'instances': len(references), 'unique_pairs': num_unique}
+            if len(systems) > 1:
+                # the counts cover all systems, which are planned and scored together
+                scoring_plan['systems'] = len(systems)
+            for name in args.metrics:
+                num_scored = scorer_stats[name]['scored']
+                scoring_plan[f'{name}_scored'] = num_scored
+                scoring_plan[f'{name}_saved'] = len(references) - num_scored
+
+    for name in args.metrics:
+        num_saved = scoring_plan[f'{name}_saved']
+        print(f'{name}: scored {scoring_plan[f"{name}_scored"]} pairs, saved {num_saved} scorer instances')
+
+    if system_outputs is None:
+        score_keys, scores = score_matrix(all_scores)
+        system_outputs = {}
+        system_intervals = {}
+        for system, (instance_info, start, end) in system_instances.items():
+            outputs, intervals = system_results(
+                args, score_keys, scores[start:end], instance_info, scoring_plan, cache_stats, timer,
+                section_scoring=section_scoring_info(args, section_counts)
+            )
+            system_outputs[system] = outputs
+            system_intervals[system] = intervals
+
+    # ###### OUTPUT TO JSON FILE ########
+    timings = timer.summary()
+    for system, outputs in system_outputs.items():
+        outputs['timings'] = timings
+        if len(systems) > 1:
+            print(f'System: {system}')
+        save_results(results_file(args.experiment, system, len(systems)), outputs, system_intervals[system])
+
+    if len(systems) > 1:
+        leaderboard = write_leaderboard(f'{args.experiment}_leaderboard.csv', system_outputs)
+        print(leaderboard[['system'] + [col for col in leaderboard.columns if col.startswith('all/')]].to_string(index=False))
         print('\n')
+
+    if args.trace is not None:
+        print(f'Saving trace to {args.trace}')
+        timer.write_trace(args.trace)
+    if args.profile_dir is not None:
+        print(f'Saving stage profiles to {args.profile_dir}')
+        timer.write_profiles()
+
+    print('Stage times')
+    for name, stats in timings.items():
+        line = f'\t{name} -> {stats["seconds"]:.2f}s'
+        if 'instances_per_second' in stats:
+            line += f', {stats["instances"]} instances, {stats["instances_per_second"]:.1f}/s'
+        if 'peak_rss_mb' in stats:
+            line += f', peak rss {stats["peak_rss_mb"]:.0f}MB'
+        print(line)
+
+    return system_outputs
+
+
+if __name__ == "__main__" :
+    parser = build_parser()
+    args = parser.parse_args()
+    try:
+        check_options(args)
+    except ValueError as e:
+        parser.error(str(e))
+
+    timer = Instrumentation(start_time=START_TIME, profile_dir=args.profile_dir)
+    timer.record('startup', time.time() - START_TIME, start=START_TIME, peak_rss=peak_rss_mb())
+    evaluate(args, timer=timer)
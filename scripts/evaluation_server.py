@@ -0,0 +1,418 @@
+"""
+Long-running evaluation server, keeping the scorers and the section tagger loaded between evaluations.
+
+    python evaluation_server.py serve --socket /tmp/evaluate.sock --metrics rouge,bertscore,bleurt
+    python evaluation_server.py submit --socket /tmp/evaluate.sock -- --fn_gold gold.csv --fn_sys sys.csv --experiment run1
+
+A job is an evaluate_summarization.py command line: its arguments are parsed with the same options, it saves
+the same results files and returns system name -> results in the same JSON shape. Jobs wait in a bounded queue
+and --concurrency of them run at once, each loaded scorer computing for one job at a time. The API is HTTP,
+over a Unix socket (--socket) or TCP (--host, --port):
+
+    POST /jobs        {"args": [...], "wait": false} -> {"id", "status"}, or the finished job with "wait": true
+    GET  /jobs/<id>   -> {"id", "status": queued|running|done|failed, "results", "error", "log", "seconds"}
+    GET  /health      -> the loaded scorers and the number of queued and running jobs
+
+Relative paths in the job arguments are relative to the server's working directory, submit makes them absolute.
+Jobs with --metric_workers > 1 load their scorers in the worker processes as the command line does.
+"""
+import io
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import socket
+import argparse
+import threading
+import traceback
+import http.client
+import socketserver
+
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import evaluate_summarization as es
+from instrumentation import Instrumentation
+
+DEFAULT_CONCURRENCY = 1
+DEFAULT_MAX_QUEUE = 100
+# finished jobs kept for GET /jobs/<id>, the oldest are forgotten first
+DEFAULT_KEEP_JOBS = 1000
+
+# evaluate_summarization options taking paths, made absolute by submit
+PATH_OPTIONS = [
+    '--fn_gold', '--fn_sys', '--metadata_file', '--experiment', '--score_cache', '--bertscore_store', '--trace',
+    '--profile_dir',
+]
+
+
+class SharedScorer:
+    """A loaded scorer shared by concurrent jobs, computing for one job at a time."""
+
+    def __init__(self, scorer):
+        self.scorer = scorer
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.scorer, name)
+
+    def compute(self, *args, **kwargs):
+        with self.lock:
+            return self.scorer.compute(*args, **kwargs)
+
+    def score_instances(self, *args, **kwargs):
+        with self.lock:
+            return self.scorer.score_instances(*args, **kwargs)
+
+    def clear_cache(self):
+        """Drops what the scorer caches between computes ( the texts NativeRouge tokenized ), if it caches any."""
+        with self.lock:
+            if hasattr(self.scorer, 'clear_cache'):
+                self.scorer.clear_cache()
+
+
+class JobOutput(io.TextIOBase):
+    """sys.stdout replacement collecting what each job's thread prints into its log, other threads print through."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.logs = {}
+
+    def write(self, text):
+        log = self.logs.get(threading.get_ident())
+        if log is None:
+            return self.stream.write(text)
+        log.append(text)
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+def _parse_error(message):
+    raise ValueError(message)
+
+
+class EvaluationServer:
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, max_queue=DEFAULT_MAX_QUEUE, keep_jobs=DEFAULT_KEEP_JOBS):
+        self.parser = es.build_parser()
+        # report bad job arguments to the client instead of exiting
+        self.parser.error = _parse_error
+        self.scorers = {}
+        self.load_lock = threading.Lock()
+        self.jobs = OrderedDict()
+        self.jobs_lock = threading.Lock()
+        self.keep_jobs = keep_jobs
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.output = JobOutput(sys.stdout)
+        self.workers = [threading.Thread(target=self._work, daemon=True) for _ in range(concurrency)]
+
+    def start(self):
+        sys.stdout = self.output
+        for worker in self.workers:
+            worker.start()
+
+    def scorer_key(self, args, name):
+        """(name, backend, store path) a job's scorer is loaded and kept under."""
+        backend = (args.backends or {}).get(name)
+        store = None
+        if name == 'bert_scorer' and args.bertscore_store is not None and backend in [None, 'store']:
+            backend, store = 'store', os.path.abspath(args.bertscore_store)
+        if name == 'bert_scorer' and args.section_scoring == 'full_note':
+            backend = 'full_note'
+        if backend is None:
+            backend = next(iter(es.SCORERS[name][0]))
+        return name, backend, store
+
+    def load_scorers(self, args):
+        """name -> load_scorer output of the --metrics of args, loading only those not loaded yet."""
+        loaded = {}
+        for name in args.metrics:
+            key = self.scorer_key(args, name)
+            with self.load_lock:
+                if key not in self.scorers:
+                    print(f'Loading {name} ({key[1]})')
+                    start = time.time()
+                    if key[2] is not None:
+                        os.environ[es.BERTSCORE_STORE_ENV] = key[2]
+                    scorer, kwargs, keys, save_keys = es.load_scorer(name, key[1])
+                    self.scorers[key] = (SharedScorer(scorer), kwargs, keys, save_keys)
+                    print(f'Loaded {name} in {time.time() - start:.1f}s')
+            loaded[name] = self.scorers[key]
+        return loaded
+
+    def warm_up(self, argv):
+        """Loads the scorers of evaluate_summarization options argv and the section tagger before any job."""
+        args = self.parser.parse_args(['--fn_gold', '', '--fn_sys', ''] + argv)
+        self.load_scorers(args)
+        es.get_section_tagger()
+
+    def submit(self, argv):
+        """Queues a job, raising ValueError for arguments evaluate_summarization rejects and queue.Full."""
+        try:
+            args = self.parser.parse_args(argv)
+        except SystemExit:
+            # --help
+            raise ValueError('the job arguments only print the usage')
+        es.check_options(args)
+        job = {
+            'id': uuid.uuid4().hex, 'status': 'queued', 'args': argv, 'results': None, 'error': None, 'log': '',
+            'submitted': time.time(), 'seconds': None, '_done': threading.Event(),
+        }
+        with self.jobs_lock:
+            self.queue.put_nowait((job, args))
+            self.jobs[job['id']] = job
+            self._forget_finished()
+        return job
+
+    def _forget_finished(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job['status'] in ['done', 'failed']]
+        for job_id in finished[:max(len(self.jobs) - self.keep_jobs, 0)]:
+            del self.jobs[job_id]
+
+    def get(self, job_id):
+        with self.jobs_lock:
+            return self.jobs.get(job_id)
+
+    def wait(self, job, timeout=None):
+        job['_done'].wait(timeout)
+        return job
+
+    def health(self):
+        with self.jobs_lock:
+            running = sum(job['status'] == 'running' for job in self.jobs.values())
+        return {
+            'scorers': [list(key) for key in self.scorers],
+            'queued': self.queue.qsize(),
+            'running': running,
+            'concurrency': len(self.workers),
+        }
+
+    def _work(self):
+        while True:
+            job, args = self.queue.get()
+            log = []
+            self.output.logs[threading.get_ident()] = log
+            job['status'] = 'running'
+            start = time.time()
+            loaded = {}
+            try:
+                loaded = self.load_scorers(args)
+                timer = Instrumentation(start_time=start, profile_dir=args.profile_dir)
+                job['results'] = es.evaluate(args, loaded=loaded, timer=timer)
+                job['status'] = 'done'
+            except SystemExit as e:
+                # the evaluation's checks print their problems and exit
+                job['status'] = 'failed'
+                job['error'] = f'evaluation exited with code {e.code}'
+            except Exception:
+                job['status'] = 'failed'
+                job['error'] = traceback.format_exc()
+            finally:
+                # a daemon's scorers must not keep growing with the texts of every job
+                for scorer, _, _, _ in loaded.values():
+                    scorer.clear_cache()
+                del self.output.logs[threading.get_ident()]
+                job['log'] = ''.join(log)
+                job['seconds'] = time.time() - start
+                job['_done'].set()
+                self.queue.task_done()
+            self.output.stream.write(f'job {job["id"]} {job["status"]} in {job["seconds"]:.2f}s\n')
+            self.output.stream.flush()
+
+
+def job_view(job):
+    return {key: val for key, val in job.items() if not key.startswith('_')}
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+
+    server_version = 'evaluation_server'
+
+    def _reply(self, status, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        evaluation = self.server.evaluation
+        if self.path == '/health':
+            return self._reply(200, evaluation.health())
+        if self.path.startswith('/jobs/'):
+            job = evaluation.get(self.path[len('/jobs/'):])
+            if job is None:
+                return self._reply(404, {'error': 'no such job'})
+            return self._reply(200, job_view(job))
+        self._reply(404, {'error': f'no route {self.path}'})
+
+    def do_POST(self):
+        if self.path != '/jobs':
+            return self._reply(404, {'error': f'no route {self.path}'})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            argv = request['args']
+            if not isinstance(argv, list) or not all(isinstance(arg, str) for arg in argv):
+                raise ValueError('args must be a list of command line arguments')
+            job = self.server.evaluation.submit(argv)
+        except (ValueError, KeyError) as e:
+            return self._reply(400, {'error': str(e)})
+        except queue.Full:
+            return self._reply(503, {'error': 'the job queue is full, retry later'})
+        if request.get('wait', False):
+            self.server.evaluation.wait(job)
+            return self._reply(200, job_view(job))
+        self._reply(202, job_view(job))
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def log_message(self, format, *args):
+        self.server.evaluation.output.stream.write(f'{self.address_string()} {format % args}\n')
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+
+def make_server(evaluation, socket_path=None, host='127.0.0.1', port=8000):
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, RequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), RequestHandler)
+    server.evaluation = evaluation
+    return server
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def request(method, path, body=None, socket_path=None, host='127.0.0.1', port=8000, timeout=None):
+    """Sends one API request to a server, returns the HTTP status and the decoded JSON reply."""
+    if socket_path is not None:
+        conn = UnixHTTPConnection(socket_path, timeout=timeout)
+    else:
+        conn = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        payload = None if body is None else json.dumps(body).encode('utf-8')
+        conn.request(method, path, body=payload, headers={'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        conn.close()
+
+
+def absolute_paths(argv):
+    """argv with the values of the PATH_OPTIONS made absolute."""
+    converted = []
+    option = None
+    for arg in argv:
+        if arg.startswith('--') and '=' in arg:
+            name, value = arg.split('=', 1)
+            converted.append(f'{name}={os.path.abspath(value)}' if name in PATH_OPTIONS else arg)
+            option = None
+        elif arg.startswith('-'):
+            converted.append(arg)
+            option = arg
+        else:
+            converted.append(os.path.abspath(arg) if option in PATH_OPTIONS else arg)
+            # only --fn_sys takes several values
+            if option != '--fn_sys':
+                option = None
+    return converted
+
+
+def add_address_arguments(parser):
+    parser.add_argument('--socket', default=None, help='Unix socket path to serve on or connect to (default TCP).')
+    parser.add_argument('--host', default='127.0.0.1', help='TCP host, without --socket.')
+    parser.add_argument('--port', default=8000, type=int, help='TCP port, without --socket.')
+
+
+if __name__ == "__main__" :
+    parser = argparse.ArgumentParser(
+        prog='evaluation_server',
+        description='Serves evaluate_summarization jobs with the scorers loaded once, or submits a job to a server.'
+    )
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve = commands.add_parser('serve', help='load the scorers and serve evaluation jobs.')
+    add_address_arguments(serve)
+    serve.add_argument(
+        '--metrics', default='rouge,bertscore,bleurt',
+        help='comma separated metrics loaded at start, jobs selecting others load them on first use.'
+    )
+    serve.add_argument('--backends', default=None, help='backend per scorer loaded at start, as evaluate_summarization.')
+    serve.add_argument('--bertscore_store', default=None, help='embedding store loaded at start, as evaluate_summarization.')
+    serve.add_argument('--concurrency', default=DEFAULT_CONCURRENCY, type=int, help='jobs run at once.')
+    serve.add_argument('--max_queue', default=DEFAULT_MAX_QUEUE, type=int, help='jobs waiting at most, others are refused.')
+
+    submit = commands.add_parser('submit', help='submit an evaluation job and print its output.')
+    add_address_arguments(submit)
+    submit.add_argument('--no_wait', action='store_true', help='print the job id instead of waiting for the job.')
+    submit.add_argument('args', nargs=argparse.REMAINDER, help='evaluate_summarization arguments, after --.')
+
+    status = commands.add_parser('status', help='print a job, or the server health without a job id.')
+    add_address_arguments(status)
+    status.add_argument('job_id', nargs='?', default=None)
+
+    args = parser.parse_args()
+    address = {'socket_path': args.socket, 'host': args.host, 'port': args.port}
+
+    if args.command == 'serve':
+        evaluation = EvaluationServer(concurrency=args.concurrency, max_queue=args.max_queue)
+        warm_args = ['--metrics', args.metrics]
+        if args.backends is not None:
+            warm_args += ['--backends', args.backends]
+        if args.bertscore_store is not None:
+            warm_args += ['--bertscore_store', args.bertscore_store]
+        start = time.time()
+        evaluation.warm_up(warm_args)
+        print(f'Scorers loaded in {time.time() - start:.1f}s')
+
+        server = make_server(evaluation, **address)
+        evaluation.start()
+        print(f'Serving on {args.socket or f"http://{args.host}:{args.port}"}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if args.socket is not None and os.path.exists(args.socket):
+                os.remove(args.socket)
+    elif args.command == 'submit':
+        argv = absolute_paths(args.args[1:] if args.args[:1] == ['--'] else args.args)
+        code, reply = request('POST', '/jobs', {'args': argv, 'wait': not args.no_wait}, **address)
+        if code >= 400:
+            print(reply['error'])
+            sys.exit(1)
+        if args.no_wait:
+            print(reply['id'])
+        else:
+            print(reply['log'], end='')
+            if reply['status'] == 'failed':
+                print(reply['error'])
+                sys.exit(1)
+    else:
+        path = '/health' if args.job_id is None else f'/jobs/{args.job_id}'
+        code, reply = request('GET', path, **address)
+        print(json.dumps(reply, indent=4))
+        sys.exit(0 if code < 400 else 1)
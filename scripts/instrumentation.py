@@ -0,0 +1,139 @@
+"""
+Per-stage timing, throughput and memory instrumentation of the evaluation pipeline.
+
+Every stage (loading, validation, section division, each scorer's load and scoring, aggregation ...) is
+recorded with its wall time, the instances it processed and the peak RSS reached while it ran. The summary
+goes into the 'timings' block of the results, the events can be saved as a Chrome trace (chrome://tracing,
+Perfetto) and each stage can be run under cProfile with one .prof dump per stage.
+"""
+import os
+import json
+import time
+import cProfile
+import resource
+import threading
+
+from contextlib import contextmanager
+
+_CLEAR_REFS = '/proc/self/clear_refs'
+_STATUS = '/proc/self/status'
+
+
+def peak_rss_mb():
+    """High-water mark of this process' resident memory, since start or since the last reset_peak_rss()."""
+    try:
+        with open(_STATUS) as fd:
+            for line in fd:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KB on linux ( and cannot be reset )
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reset_peak_rss():
+    """Resets the RSS high-water mark where the kernel allows it (linux clear_refs), so each stage gets its own peak."""
+    try:
+        with open(_CLEAR_REFS, 'w') as fd:
+            fd.write('5')
+    except OSError:
+        pass
+
+
+class Instrumentation:
+
+    def __init__(self, start_time=None, profile_dir=None):
+        self.start_time = time.time() if start_time is None else start_time
+        self.profile_dir = profile_dir
+        self.stages = {}
+        self.events = []
+        self.profiles = {}
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Times the enclosed block as stage name. Yields a dict, whose 'instances' the block can set to the number
+        of instances it processed.
+        """
+        info = {'instances': None}
+        reset_peak_rss()
+        profile = None
+        if self.profile_dir is not None:
+            profile = self.profiles.setdefault(name, cProfile.Profile())
+            profile.enable()
+        start = time.time()
+        try:
+            yield info
+        finally:
+            seconds = time.time() - start
+            if profile is not None:
+                profile.disable()
+            self.record(name, seconds, start=start, instances=info['instances'], peak_rss=peak_rss_mb())
+
+    def record(self, name, seconds, start=None, instances=None, peak_rss=None):
+        """Adds one timed run of stage name, started at start ( epoch seconds )."""
+        stats = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0})
+        stats['seconds'] += seconds
+        stats['calls'] += 1
+        if instances is not None:
+            stats['instances'] = stats.get('instances', 0) + instances
+            stats['instances_per_second'] = stats['instances'] / max(stats['seconds'], 1e-9)
+        if peak_rss is not None:
+            stats['peak_rss_mb'] = max(stats.get('peak_rss_mb', 0.0), peak_rss)
+
+        if start is None:
+            start = time.time() - seconds
+        args = {}
+        if peak_rss is not None:
+            args['peak_rss_mb'] = peak_rss
+        if instances is not None:
+            args['instances'] = instances
+        self.events.append({
+            'name': name, 'ph': 'X', 'cat': 'stage',
+            'ts': (start - self.start_time) * 1e6, 'dur': seconds * 1e6,
+            'pid': os.getpid(), 'tid': threading.get_ident(),
+            'args': args,
+        })
+
+    def merge(self, stages, events):
+        """Adds the stages and trace events of another process' Instrumentation, e.g. a metric worker."""
+        for name, stats in stages.items():
+            total = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0})
+            for key in ['seconds', 'calls', 'instances']:
+                if key in stats:
+                    total[key] = total.get(key, 0) + stats[key]
+            if 'instances' in total:
+                total['instances_per_second'] = total['instances'] / max(total['seconds'], 1e-9)
+            if 'peak_rss_mb' in stats:
+                total['peak_rss_mb'] = max(total.get('peak_rss_mb', 0.0), stats['peak_rss_mb'])
+        self.events.extend(events)
+
+    def summary(self):
+        """stage -> {seconds, calls, instances, instances_per_second, peak_rss_mb}, plus the total wall time."""
+        timings = {name: dict(stats) for name, stats in self.stages.items()}
+        timings['total'] = {
+            'seconds': time.time() - self.start_time,
+            # the stage peaks are reset between stages, so the process peak is the highest of them
+            'peak_rss_mb': max(
+                [resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, peak_rss_mb()] +
+                [stats['peak_rss_mb'] for stats in self.stages.values() if 'peak_rss_mb' in stats]
+            ),
+            'children_peak_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        }
+        return timings
+
+    def write_trace(self, fn):
+        """Saves the stage events in the Chrome trace event format."""
+        with open(fn, 'w') as fd:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, fd)
+
+    def write_profiles(self):
+        """Dumps one cProfile file per stage into profile_dir, returns their paths."""
+        os.makedirs(self.profile_dir, exist_ok=True)
+        paths = []
+        for name, profile in self.profiles.items():
+            path = os.path.join(self.profile_dir, f'{name}.prof')
+            profile.dump_stats(path)
+            paths.append(path)
+        return paths
@@ -0,0 +1,191 @@
+"""
+Combines the outputs of evaluate_summarization.py --shard runs into the {experiment}_results.json a single-process
+run of the same inputs and options writes.
+
+    python evaluate_summarization.py --fn_gold gold.csv --fn_sys run.csv --shard 0/4 --experiment run   # ... 3/4
+    python merge_shards.py run_shard-*-of-4.json --experiment run
+
+The shards may run as separate processes on any machines. Their manifests ( the .json files, each with its .jsonl
+instances file next to it ) are checked to be of the same inputs and options, and their instances to cover every
+instance of a single run exactly once. The instances are put back in single-run order, so the cohort means and
+--bootstrap intervals come out the same, and the scoring_plan counts are recomputed as a single run counts them
+( with --score_cache the shards' counts are summed, as cache hits depend on the runs before ).
+"""
+import os
+import sys
+import json
+import argparse
+
+import numpy as np
+
+import evaluate_summarization as es
+from instrumentation import Instrumentation
+
+# read from the shard instances files on top of the cohort keys and scores
+SHARD_KEYS = ['position', 'pair', 'trivial']
+# examples listed per coverage problem
+_MAX_LISTED = 10
+
+
+def read_manifests(fns):
+    """The manifests of shard runs, with the path of their instances file as fn_instances."""
+    manifests = []
+    for fn in fns:
+        with open(fn) as fd:
+            manifest = json.load(fd)
+        manifest['fn_instances'] = os.path.join(os.path.dirname(fn), manifest['instances_file'])
+        manifests.append(manifest)
+    return manifests
+
+
+def check_manifests(fns, manifests):
+    """Problems of shard manifests that are not each shard of one evaluation exactly once."""
+    problems = []
+    for fn, manifest in zip(fns, manifests):
+        for key in ['config', 'num_shards', 'notes', 'divisions', 'notes_digest']:
+            if manifest[key] != manifests[0][key]:
+                problems.append(f'{fn}: {key} differs from {fns[0]}, the shards are not of the same inputs and options')
+        if manifest.get('detected_divisions') != manifests[0].get('detected_divisions'):
+            problems.append(
+                f'{fn}: the section divisions detected in the notes differ from {fns[0]}, '
+                'missing divisions would not be scored the same in every shard'
+            )
+        if not os.path.exists(manifest['fn_instances']):
+            problems.append(f'{fn}: instances file {manifest["fn_instances"]} does not exist')
+    if len(problems) > 0:
+        return problems
+
+    num_shards = manifests[0]['num_shards']
+    shard2fn = {}
+    for fn, manifest in zip(fns, manifests):
+        if manifest['shard'] in shard2fn:
+            problems.append(f'{fn}: shard {manifest["shard"]}/{num_shards} is also {shard2fn[manifest["shard"]]}')
+        else:
+            shard2fn[manifest['shard']] = fn
+    missing = [f'{shard}/{num_shards}' for shard in range(num_shards) if shard not in shard2fn]
+    if len(missing) > 0:
+        problems.append(f'{len(missing)} shards are missing: {", ".join(missing)}')
+    return problems
+
+
+def check_coverage(instance_info, num_notes, num_divisions):
+    """Problems of merged instances that do not cover every instance of a single run exactly once."""
+    problems = []
+    positions = np.asarray(instance_info['position'], dtype=np.int64)
+    num_instances = num_notes * num_divisions
+    outside = np.flatnonzero((positions < 0) | (positions >= num_instances))
+    if len(outside) > 0:
+        return [f'{len(outside)} instances have positions outside of the {num_instances} instances of the inputs']
+
+    counts = np.bincount(positions, minlength=num_instances)
+    repeated = np.flatnonzero(counts[positions] > 1)
+    if len(repeated) > 0:
+        listed = dict.fromkeys(
+            f'{instance_info["id"][ind]} ({es.DIVISION_NAMES[instance_info["division"][ind]]})' for ind in repeated
+        )
+        problems.append(
+            f'{len(listed)} instances are in more than one shard: {", ".join(list(listed)[:_MAX_LISTED])}'
+        )
+    missing = np.flatnonzero(counts == 0)
+    if len(missing) > 0:
+        listed = [f'note {pos % num_notes} ({es.DIVISION_NAMES[pos // num_notes]})' for pos in missing[:_MAX_LISTED]]
+        problems.append(f'{len(missing)} instances are in no shard: {", ".join(listed)}')
+    return problems
+
+
+def scoring_plan(config, manifests, instance_info):
+    """The scoring_plan counts of a single run over the instances of all the shards."""
+    pairs = instance_info['pair']
+    plan = {'instances': len(pairs), 'unique_pairs': len(set(pairs))}
+    for name in config['metrics']:
+        if config['score_cache']:
+            num_scored = sum(manifest['scored'][name] for manifest in manifests)
+        else:
+            # every unique pair without a trivial score rule for the scorer is scored once
+            rules = es.TRIVIAL_PAIR_SCORES.get(name, {})
+            num_scored = len({pair for pair, kind in zip(pairs, instance_info['trivial']) if kind not in rules})
+        plan[f'{name}_scored'] = num_scored
+        plan[f'{name}_saved'] = len(pairs) - num_scored
+    return plan
+
+
+def merge_shards(fns, experiment, timer=None):
+    """
+    Checks and merges the shards of manifest files fns, saving {experiment}_results.json.
+    Raises ValueError listing the problems if they are not every shard of one evaluation, exactly once.
+    Returns the results
+    """
+    if timer is None:
+        timer = Instrumentation()
+    manifests = read_manifests(fns)
+    problems = check_manifests(fns, manifests)
+    if len(problems) > 0:
+        raise ValueError('\n'.join(problems))
+    config = manifests[0]['config']
+    score_keys = [save_key for name in config['metrics'] for save_key in es.SCORERS[name][3]]
+
+    with timer.stage('read_instances') as stage:
+        instance_info = {key: [] for key in ['id', 'division', 'dataset', 'src_len'] + SHARD_KEYS}
+        all_scores = {key: [] for key in score_keys}
+        for fn, manifest in zip(fns, manifests):
+            shard_info, shard_scores = es.read_instances(manifest['fn_instances'], score_keys, extra_keys=SHARD_KEYS)
+            misplaced = [
+                note_id for note_id in dict.fromkeys(shard_info['id'])
+                if es.shard_of(note_id, manifest['num_shards']) != manifest['shard']
+            ]
+            if len(misplaced) > 0:
+                problems.append(f'{fn}: {len(misplaced)} notes belong to other shards, e.g. {misplaced[0]}')
+            for key, vals in shard_info.items():
+                instance_info[key].extend(vals.tolist() if key == 'division' else vals)
+            for key, vals in shard_scores.items():
+                all_scores[key].extend(vals)
+        stage['instances'] = len(instance_info['id'])
+
+    problems.extend(check_coverage(instance_info, manifests[0]['notes'], manifests[0]['divisions']))
+    if len(problems) > 0:
+        raise ValueError('\n'.join(problems))
+
+    # back in the order of a single-process run
+    order = np.argsort(np.asarray(instance_info['position'], dtype=np.int64), kind='stable')
+    instance_info = {key: [vals[ind] for ind in order] for key, vals in instance_info.items()}
+    instance_info['division'] = np.array(instance_info['division'], dtype=np.int8)
+    all_scores = {key: np.asarray(vals, dtype=np.float64)[order] for key, vals in all_scores.items()}
+
+    plan = scoring_plan(config, manifests, instance_info)
+    cache_stats = {}
+    section_counts = {}
+    for manifest in manifests:
+        es.add_stats(cache_stats, manifest['score_cache'])
+        es.add_stats(section_counts, manifest['section_scoring'])
+    for name in config['metrics']:
+        print(f'{name}: scored {plan[f"{name}_scored"]} pairs, saved {plan[f"{name}_saved"]} scorer instances')
+
+    args = argparse.Namespace(
+        task=config['task'], metrics=config['metrics'], backends=config['backends'],
+        note_length_cutoff=config['note_length_cutoff'],
+        bootstrap=config['bootstrap'], bootstrap_seed=config['bootstrap_seed'],
+        score_cache=True if config['score_cache'] else None, section_scoring=config['section_scoring'],
+    )
+    score_keys, scores = es.score_matrix(all_scores)
+    outputs, intervals = es.system_results(
+        args, score_keys, scores, instance_info, plan, cache_stats, timer,
+        section_scoring=es.section_scoring_info(args, section_counts)
+    )
+    outputs['timings'] = timer.summary()
+    es.save_results(f'{experiment}_results.json', outputs, intervals)
+    return outputs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='merge_shards',
+        description='Merges the shards of evaluate_summarization.py --shard runs into the results of a single run.'
+    )
+    parser.add_argument('manifests', nargs='+', help='the {experiment}_shard-i-of-N.json manifest of every shard.')
+    parser.add_argument('--experiment', default='default', help='Prefix for save file.')
+    args = parser.parse_args()
+    try:
+        merge_shards(args.manifests, args.experiment)
+    except ValueError as e:
+        print(f'Cannot merge the shards:\n{e}')
+        sys.exit(1)
@@ -0,0 +1,209 @@
+"""
+Built-in ROUGE matching rouge_score (default tokenizer, no stemmer) as computed by evaluate's rouge
+with use_aggregator=False.
+
+Every distinct text is tokenized once into integer token ids, which are cached along with its newline
+sentence splits and n-gram counts, so rouge1/rouge2 share the same counts and rougeLsum reuses the splits.
+LCS is computed bit-parallel (each row of the DP table is one integer, updated with a few word-level
+operations per token) and rougeLsum over several sentences backtracks those rows exactly as rouge_score does.
+"""
+import re
+
+from collections import Counter
+
+import numpy as np
+
+ROUGE_TYPES = ['rouge1', 'rouge2', 'rougeL', 'rougeLsum']
+
+# n-gram codes pack n token ids of 21 bits into an int64
+MAX_N = 3
+
+NON_ALPHANUM_RE = re.compile(r'[^a-z0-9]+')
+ROUGEN_RE = re.compile(r'rouge([0-9])$')
+
+
+if hasattr(int, 'bit_count'):
+    _popcount = int.bit_count
+else:
+    def _popcount(value):
+        return bin(value).count('1')
+
+
+def fmeasure(precision, recall):
+    # same as rouge_score.scoring.fmeasure
+    if precision + recall > 0:
+        return 2 * precision * recall / (precision + recall)
+    return 0.0
+
+
+def lcs_rows(ref, can):
+    """
+    Bit-parallel LCS: rows[j] has bit i clear where ref[i] is matched after the first j tokens of can,
+    so the LCS length of ref[:i] and can[:j] (rouge_score's lcs_table[i][j]) is i - popcount( rows[j] & (2**i - 1) ).
+    """
+    matches = {}
+    for ind, tok in enumerate(ref):
+        matches[tok] = matches.get(tok, 0) | (1 << ind)
+    mask = (1 << len(ref)) - 1
+    row = mask
+    rows = [row]
+    for tok in can:
+        match = row & matches.get(tok, 0)
+        row = ((row + match) | (row - match)) & mask
+        rows.append(row)
+    return rows
+
+
+def lcs_length(ref, can):
+    """Length of the longest common subsequence of two token id sequences."""
+    if len(ref) == 0 or len(can) == 0:
+        return 0
+    return len(ref) - _popcount(lcs_rows(ref, can)[-1])
+
+
+def lcs_indices(ref, can):
+    """Indices into ref of the LCS picked by rouge_score's backtracking, in reverse order."""
+    rows = lcs_rows(ref, can)
+    if len(can) == 0 or rows[-1] == rows[0]:
+        return []
+
+    i = len(ref)
+    j = len(can)
+    indices = []
+    while i > 0 and j > 0:
+        if ref[i - 1] == can[j - 1]:
+            indices.append(i - 1)
+            i -= 1
+            j -= 1
+        # lcs_table[i][j - 1] > lcs_table[i - 1][j]
+        elif i - _popcount(rows[j - 1] & ((1 << i) - 1)) > i - 1 - _popcount(rows[j] & ((1 << (i - 1)) - 1)):
+            j -= 1
+        else:
+            i -= 1
+    return indices
+
+
+def _overlap(ref_counts, can_counts):
+    ref_ngrams, ref_cnts = ref_counts
+    can_ngrams, can_cnts = can_counts
+    _, ref_inds, can_inds = np.intersect1d(ref_ngrams, can_ngrams, assume_unique=True, return_indices=True)
+    return int(np.minimum(ref_cnts[ref_inds], can_cnts[can_inds]).sum())
+
+
+class TokenizedText:
+
+    def __init__(self, ids, sentences):
+        self.ids = ids
+        self.sentences = sentences
+        self.ngram_counts = {}
+
+    def ngrams(self, n):
+        """Returns unique n-gram codes with their counts, each n-gram packed into one int64."""
+        if n not in self.ngram_counts:
+            ids = self.ids.astype(np.int64)
+            num_ngrams = max(len(ids) - n + 1, 0)
+            codes = ids[:num_ngrams]
+            for offset in range(1, n):
+                codes = codes * NativeRouge.MAX_VOCAB + ids[offset:offset + num_ngrams]
+            self.ngram_counts[n] = np.unique(codes, return_counts=True)
+        return self.ngram_counts[n]
+
+
+class NativeRouge:
+
+    config_name = 'native'
+    MAX_VOCAB = 1 << 21
+
+    def __init__(self):
+        self.vocab = {}
+        self.texts = {}
+
+    def tokenize(self, text):
+        """Returns the cached TokenizedText for text, tokenizing it on first use."""
+        tokenized = self.texts.get(text)
+        if tokenized is None:
+            sentences = []
+            for sent in text.split('\n'):
+                tokens = NON_ALPHANUM_RE.sub(' ', sent.lower()).split()
+                sentences.append(np.array([self.vocab.setdefault(tok, len(self.vocab)) for tok in tokens], dtype=np.int32))
+            if len(self.vocab) > self.MAX_VOCAB:
+                raise ValueError(f'NativeRouge vocabulary is limited to {self.MAX_VOCAB} tokens')
+            ids = np.concatenate(sentences)
+            # rougeLsum only drops empty lines, lines without tokens still count as sentences
+            lsum_sentences = [tokens for sent, tokens in zip(text.split('\n'), sentences) if len(sent) > 0]
+            tokenized = TokenizedText(ids, lsum_sentences)
+            self.texts[text] = tokenized
+        return tokenized
+
+    def clear_cache(self):
+        """Drops the tokenized texts and their vocabulary, which otherwise grow with every text scored."""
+        self.texts = {}
+        self.vocab = {}
+
+    def score(self, reference, prediction, rouge_types=ROUGE_TYPES):
+        """Returns rouge type -> fmeasure for one pair."""
+        ref = self.tokenize(reference)
+        can = self.tokenize(prediction)
+        scores = {}
+        for rouge_type in rouge_types:
+            if rouge_type == 'rougeL':
+                scores[rouge_type] = self._score_lcs(ref.ids, can.ids)
+            elif rouge_type == 'rougeLsum':
+                scores[rouge_type] = self._score_summary_lcs(ref.sentences, can.sentences)
+            elif ROUGEN_RE.match(rouge_type):
+                n = int(rouge_type[5:])
+                if n <= 0 or n > MAX_N:
+                    raise ValueError('NativeRouge supports rouge1 to rouge%d: %s' % (MAX_N, rouge_type))
+                ref_counts = ref.ngrams(n)
+                can_counts = can.ngrams(n)
+                overlap = _overlap(ref_counts, can_counts)
+                precision = overlap / max(int(can_counts[1].sum()), 1)
+                recall = overlap / max(int(ref_counts[1].sum()), 1)
+                scores[rouge_type] = fmeasure(precision, recall)
+            else:
+                raise ValueError('Invalid rouge type: %s' % rouge_type)
+        return scores
+
+    def _score_lcs(self, ref, can):
+        if len(ref) == 0 or len(can) == 0:
+            return 0.0
+        lcs = lcs_length(ref.tolist(), can.tolist())
+        return fmeasure(lcs / len(can), lcs / len(ref))
+
+    def _score_summary_lcs(self, ref_sents, can_sents):
+        if len(ref_sents) == 0 or len(can_sents) == 0:
+            return 0.0
+        num_ref = sum(map(len, ref_sents))
+        num_can = sum(map(len, can_sents))
+        if num_ref == 0 or num_can == 0:
+            return 0.0
+
+        if len(ref_sents) == 1 and len(can_sents) == 1:
+            # the union is a single LCS, whose tokens can never be double counted
+            hits = lcs_length(ref_sents[0].tolist(), can_sents[0].tolist())
+        else:
+            ref_sents = [sent.tolist() for sent in ref_sents]
+            can_sents = [sent.tolist() for sent in can_sents if len(sent) > 0]
+            ref_cnts = Counter(tok for sent in ref_sents for tok in sent)
+            can_cnts = Counter(tok for sent in can_sents for tok in sent)
+            hits = 0
+            for ref in ref_sents:
+                union = sorted(set().union(*[lcs_indices(ref, can) for can in can_sents]))
+                for tok in [ref[ind] for ind in union]:
+                    if can_cnts[tok] > 0 and ref_cnts[tok] > 0:
+                        hits += 1
+                        can_cnts[tok] -= 1
+                        ref_cnts[tok] -= 1
+        return fmeasure(hits / num_can, hits / num_ref)
+
+    def compute(self, predictions, references, rouge_types=None, use_aggregator=False):
+        """Same per-instance output as evaluate.load('rouge').compute( ..., use_aggregator=False )."""
+        if use_aggregator:
+            raise ValueError('NativeRouge only returns per-instance scores, use use_aggregator=False')
+        rouge_types = rouge_types or ROUGE_TYPES
+        results = {rouge_type: [] for rouge_type in rouge_types}
+        for ref, pred in zip(references, predictions):
+            scores = self.score(ref, pred, rouge_types)
+            for rouge_type in rouge_types:
+                results[rouge_type].append(scores[rouge_type])
+        return results
@@ -0,0 +1,152 @@
+"""
+Partial results of an evaluation while it runs, and the --time_budget sampled estimate of the results.
+
+As each metric ( and with --stream_chunk_size each chunk ) completes, evaluate_summarization.py rewrites
+{experiment}_results.json with the cohort means of what has been scored so far and a 'progress' block saying
+what they cover. The files are replaced atomically, so a reader never sees a half-written one, and the final
+results replace the last snapshot without a 'progress' block.
+
+With --time_budget a stratified random sample of the instances is scored instead of all of them. The strata are
+the system, dataset, division and short/long source of an instance, so every cohort is a union of strata, and
+each round grows the sample of every stratum in proportion to its size. The instances of a stratum are taken in
+a fixed pseudo-random order of their id and division, so all systems are sampled on the same notes and their
+estimates are compared on the same instances. After every round the cohort means are estimated from the strata
+means, with their standard errors, and saved as the results. Rounds double the sample, sized to fit the time
+left, until the budget is spent or every instance is scored ( the estimates are then the exact means ).
+"""
+import hashlib
+
+import numpy as np
+
+# instances every stratum starts with ( all of a smaller one ), two to have a variance
+MIN_PER_STRATUM = 2
+# instances scored in the first round of a --time_budget run, on top of MIN_PER_STRATUM per stratum
+FIRST_ROUND_SIZE = 256
+
+
+class CohortTotals:
+    """Running sums of the scores of every cohort, for the cohort means of instances scored chunk by chunk."""
+
+    def __init__(self, state=None):
+        # cohort -> {'instances': count, 'sums': {key: sum}}, as kept in a --stream_chunk_size checkpoint
+        self.state = {} if state is None else state
+
+    def add(self, keys, matrix, cohorts):
+        """Adds the instances x keys scores matrix of the ( cohort name, instance indices ) cohorts."""
+        for name, indices in cohorts:
+            totals = self.state.setdefault(name, {'instances': 0, 'sums': {}})
+            totals['instances'] += len(indices)
+            for key, val in zip(keys, matrix[indices].sum(axis=0).tolist()):
+                totals['sums'][key] = totals['sums'].get(key, 0.0) + val
+
+    def means(self):
+        """cohort -> {key: mean}, as aggregate_cohorts gives ( NaN for a cohort without instances )."""
+        return {
+            name: {
+                key: val / totals['instances'] if totals['instances'] > 0 else float('nan')
+                for key, val in totals['sums'].items()
+            }
+            for name, totals in self.state.items()
+        }
+
+
+def stratify(instance_infos, note_length_cutoff):
+    """
+    The stratum of every instance of the instance_info of each system in turn: system, dataset, division and
+    whether the source is at most note_length_cutoff words, longer or of unknown length ( as build_cohorts splits
+    them ). Returns the stratum code array and the stratum of each code.
+    """
+    key2code = {}
+    codes = []
+    for system, instance_info in enumerate(instance_infos):
+        for dataset, division, src_len in zip(instance_info['dataset'], instance_info['division'].tolist(),
+                                              instance_info['src_len']):
+            if src_len is None or src_len != src_len:
+                length = 'unknown'
+            else:
+                length = 'shorter' if src_len <= note_length_cutoff else 'longer'
+            codes.append(key2code.setdefault((system, dataset, division, length), len(key2code)))
+    return np.array(codes, dtype=np.int64), list(key2code)
+
+
+def sample_order(ids, divisions, seed=0):
+    """Pseudo-random sort key of every instance from its id and division, the same for every system."""
+    return np.array([
+        int.from_bytes(hashlib.blake2b(f'{seed}/{note_id}/{division}'.encode('utf-8'), digest_size=8).digest(), 'big')
+        for note_id, division in zip(ids, divisions)
+    ], dtype=np.uint64)
+
+
+class StratifiedSample:
+    """A sample of instances grown round by round, every stratum in proportion to its size."""
+
+    def __init__(self, strata, order_keys):
+        self.strata = np.asarray(strata, dtype=np.int64)
+        self.sizes = np.bincount(self.strata)
+        self.starts = np.cumsum(self.sizes) - self.sizes
+        # instance indices by stratum, each stratum in sample order
+        self.order = np.lexsort((order_keys, self.strata))
+        self.taken = np.zeros(len(self.sizes), dtype=np.int64)
+
+    def __len__(self):
+        return int(self.taken.sum())
+
+    @property
+    def complete(self):
+        return bool((self.taken == self.sizes).all())
+
+    def grow(self, size):
+        """Adds about size instances ( at least MIN_PER_STRATUM per stratum ) to the sample, returns their indices."""
+        target = len(self) + size
+        wanted = np.ceil(target * self.sizes / self.sizes.sum()).astype(np.int64)
+        wanted = np.maximum(wanted, np.minimum(self.sizes, MIN_PER_STRATUM))
+        wanted = np.minimum(np.maximum(wanted, self.taken), self.sizes)
+        added = [
+            self.order[start + taken:start + want]
+            for start, taken, want in zip(self.starts, self.taken, wanted) if want > taken
+        ]
+        self.taken = wanted
+        return np.concatenate(added + [np.zeros(0, dtype=np.int64)])
+
+
+def stratified_estimates(keys, matrix, sampled, strata, cohorts):
+    """
+    Estimates of the cohort means from the sampled instances ( a boolean mask, the matrix rows of the others are not
+    read ): the sample mean of every stratum in a cohort weighted by its share of the cohort's instances, with the
+    standard error of stratified sampling without replacement. A stratum with one sampled instance takes the
+    variance of the whole sample of the cohort.
+    Returns cohort -> {key: estimate}, cohort -> {key: standard error} and cohort -> sampled instances
+    """
+    estimates = {}
+    errors = {}
+    num_sampled = {}
+    for name, indices in cohorts:
+        picked = sampled[indices]
+        num_sampled[name] = int(picked.sum())
+        if num_sampled[name] == 0:
+            estimates[name] = {key: float('nan') for key in keys}
+            errors[name] = {key: float('nan') for key in keys}
+            continue
+        _, inverse = np.unique(strata[indices], return_inverse=True)
+        population = np.bincount(inverse).astype(np.float64)
+        values = matrix[indices[picked]]
+        picked_strata = inverse[picked]
+        counts = np.bincount(picked_strata, minlength=len(population)).astype(np.float64)
+        # strata without a sampled instance are left out, the others' weights still sum to one
+        present = counts > 0
+        weights = np.where(present, population, 0.0) / population[present].sum()
+
+        sums = np.stack([np.bincount(picked_strata, weights=values[:, col], minlength=len(population))
+                         for col in range(len(keys))], axis=1)
+        means = sums / np.maximum(counts, 1)[:, None]
+        squares = np.stack([np.bincount(picked_strata, weights=(values[:, col] - means[picked_strata, col]) ** 2,
+                                        minlength=len(population))
+                            for col in range(len(keys))], axis=1)
+        pooled = values.var(axis=0, ddof=1) if len(values) > 1 else np.zeros(len(keys))
+        variances = np.where((counts > 1)[:, None], squares / np.maximum(counts - 1, 1)[:, None], pooled[None, :])
+        # finite population correction, a fully sampled stratum adds no error
+        factors = np.where(present, weights ** 2 * (1 - counts / population) / np.maximum(counts, 1), 0.0)
+
+        estimates[name] = dict(zip(keys, (weights[:, None] * means).sum(axis=0).tolist()))
+        errors[name] = dict(zip(keys, np.sqrt((factors[:, None] * variances).sum(axis=0)).tolist()))
+    return estimates, errors, num_sampled
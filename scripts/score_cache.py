@@ -0,0 +1,88 @@
+"""
+On-disk cache of per-instance metric scores.
+
+Scores are stored in a sqlite file keyed by metric name, metric config (model and compute arguments)
+and a hash of the reference/prediction pair, so re-running an evaluation only scores the pairs
+it has not seen before. The least recently used entries are evicted once max_entries is exceeded.
+"""
+import json
+import time
+import sqlite3
+import hashlib
+
+DEFAULT_MAX_ENTRIES = 1000000
+
+#sqlite limits the number of bound parameters per statement
+_QUERY_CHUNK = 500
+
+
+def pair_hash(reference, prediction):
+    return hashlib.sha256(json.dumps([reference, prediction]).encode('utf-8')).hexdigest()
+
+
+class ScoreCache:
+
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.stats = {}
+        # several metric workers may write to the same file, wait for their locks rather than failing
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS scores ('
+            'metric TEXT NOT NULL, config TEXT NOT NULL, pair TEXT NOT NULL, '
+            'scores TEXT NOT NULL, last_used REAL NOT NULL, '
+            'PRIMARY KEY (metric, config, pair))'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS scores_last_used ON scores (last_used)')
+        self.conn.commit()
+
+    def lookup(self, metric, config, hashes):
+        """
+        Input : metric name, config string, list of pair hashes
+        Return: dict of pair hash -> list of cached score values
+        """
+        found = {}
+        unique_hashes = list(dict.fromkeys(hashes))
+        for ind in range(0, len(unique_hashes), _QUERY_CHUNK):
+            chunk = unique_hashes[ind:ind + _QUERY_CHUNK]
+            rows = self.conn.execute(
+                'SELECT pair, scores FROM scores WHERE metric = ? AND config = ? AND pair IN (%s)'
+                % ','.join('?' * len(chunk)),
+                [metric, config] + chunk
+            )
+            for pair, scores in rows:
+                found[pair] = json.loads(scores)
+
+        # refresh hits so eviction keeps the entries that are still in use
+        now = time.time()
+        self.conn.executemany(
+            'UPDATE scores SET last_used = ? WHERE metric = ? AND config = ? AND pair = ?',
+            [(now, metric, config, pair) for pair in found]
+        )
+        self.conn.commit()
+
+        num_hits = sum(1 for h in hashes if h in found)
+        self.stats[f'{metric}_hits'] = self.stats.get(f'{metric}_hits', 0) + num_hits
+        self.stats[f'{metric}_misses'] = self.stats.get(f'{metric}_misses', 0) + len(hashes) - num_hits
+        return found
+
+    def store(self, metric, config, hash2scores):
+        now = time.time()
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO scores (metric, config, pair, scores, last_used) VALUES (?, ?, ?, ?, ?)',
+            [(metric, config, pair, json.dumps(scores), now) for pair, scores in hash2scores.items()]
+        )
+        self.evict()
+        self.conn.commit()
+
+    def evict(self):
+        num_entries = self.conn.execute('SELECT COUNT(*) FROM scores').fetchone()[0]
+        if num_entries > self.max_entries:
+            self.conn.execute(
+                'DELETE FROM scores WHERE rowid IN (SELECT rowid FROM scores ORDER BY last_used LIMIT ?)',
+                (num_entries - self.max_entries,)
+            )
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,215 @@
+"""
+BERTScore of the taskB section divisions from the token embeddings of the full notes.
+
+Every section division is a span of its note, so with evaluate_summarization.py --section_scoring full_note each
+full reference and prediction note is encoded once and a section is scored by BERTScore's greedy matching between
+the token rows of its spans ( with the note's [CLS] and [SEP] rows, as a text encoded on its own has them ) instead
+of encoding the section text again, cutting the encoder work about 5x. The character spans of the section tagger
+are mapped to tokens with the offsets of the fast tokenizer of the model, checked to give the token ids bert_score
+encodes the note with. A section is encoded on its own as before when it cannot be derived: a side without the
+division, a span past the tokens the model truncates the note to, or a note whose tokens do not match.
+
+The derived scores differ from re-encoding a section, whose tokens then only see the section as context ( and its
+line breaks as __lf1__ ). How much, is reported by
+
+    python section_scores.py --fn_gold gold.csv --fn_sys run.csv --report section_scoring_report.json
+
+which scores the section divisions of a run both ways.
+"""
+import json
+import argparse
+
+import numpy as np
+
+from embedding_store import DEFAULT_MODEL_TYPE, BertEncoder, greedy_match, score_pairs
+
+KEYS = ['precision', 'recall', 'f1']
+# notes encoded ( and their embeddings held ) at a time
+DEFAULT_NOTES_PER_BATCH = 64
+
+
+def instance_parts(texts):
+    """The InstanceTexts of evaluate_summarization instance texts, several for ConcatTexts."""
+    return texts.parts if hasattr(texts, 'parts') else [texts]
+
+
+class SectionBertScore:
+    """
+    The full_note bert_scorer backend: a drop-in for evaluate's bertscore compute on pairs of texts, with
+    score_instances scoring the section divisions of InstanceTexts from their full notes' embeddings.
+    """
+
+    def __init__(self, notes_per_batch=DEFAULT_NOTES_PER_BATCH):
+        self.config_name = 'full_note'
+        self.notes_per_batch = notes_per_batch
+        self.encoder = None
+        self.fast_tokenizer = None
+
+    def load(self, model_type=None, num_layers=None, idf=False, device=None):
+        if idf:
+            raise ValueError('the full_note bert_scorer backend does not weight tokens by idf')
+        model_type = model_type or DEFAULT_MODEL_TYPE
+        if self.encoder is None or self.encoder.model_type != model_type or num_layers not in [None, self.encoder.num_layers]:
+            from transformers import AutoTokenizer, GPT2Tokenizer
+            self.encoder = BertEncoder(model_type, num_layers, device=device or 'cpu')
+            # bert_score encodes with a prefix space for GPT-2 style tokenizers ( RoBERTa, DeBERTa )
+            kwargs = {'add_prefix_space': True} if isinstance(self.encoder.tokenizer, GPT2Tokenizer) else {}
+            self.fast_tokenizer = AutoTokenizer.from_pretrained(model_type, use_fast=True, **kwargs)
+        return self.encoder
+
+    def compute(self, predictions, references, model_type=None, num_layers=None, idf=False, device=None,
+                batch_size=64, **kwargs):
+        return score_pairs(self.load(model_type, num_layers, idf, device), references, predictions, batch_size)
+
+    def token_offsets(self, text, num_rows):
+        """
+        Character offsets into text of the tokens of rows 1 .. num_rows - 2 of its embeddings, and whether the
+        model truncated the text. None if the fast tokenizer does not give the tokens bert_score encodes.
+        """
+        from bert_score.utils import sent_encode
+        stripped = text.strip()
+        encoding = self.fast_tokenizer(stripped, add_special_tokens=False, return_offsets_mapping=True)
+        expected = sent_encode(self.encoder.tokenizer, text)[1:-1]
+        if encoding['input_ids'][:len(expected)] != expected or len(expected) != num_rows - 2:
+            return None
+        # sent_encode strips the text, offsets are into the stripped text
+        offsets = np.array(encoding['offset_mapping'], dtype=np.int64).reshape(-1, 2) + (len(text) - len(text.lstrip()))
+        return offsets[:len(expected)], len(encoding['input_ids']) > len(expected)
+
+    @staticmethod
+    def span_rows(token_offsets, start, end):
+        """Embedding rows of the [CLS] row, the tokens overlapping characters start:end and the [SEP] row, or None."""
+        offsets, truncated = token_offsets
+        if truncated and (len(offsets) == 0 or end > offsets[-1, 1]):
+            return None
+        tokens = np.flatnonzero((offsets[:, 0] < end) & (offsets[:, 1] > start))
+        return np.concatenate([[0], tokens + 1, [len(offsets) + 1]])
+
+    def score_instances(self, references, predictions, model_type=None, num_layers=None, idf=False, device=None,
+                        batch_size=64, **kwargs):
+        """
+        Scores every instance of the InstanceTexts ( or ConcatTexts ) references and predictions, the full notes
+        by their embeddings and the section divisions within them. Trivial pairs get TRIVIAL_PAIR_SCORES.
+        Returns per-instance scores for each key, and the number of instances scored each way
+        """
+        from evaluate_summarization import TRIVIAL_PAIR_SCORES, trivial_pair_kind
+        self.load(model_type, num_layers, idf, device)
+        rules = TRIVIAL_PAIR_SCORES['bert_scorer']
+        stats = {'full_notes': 0, 'derived': 0, 'reencoded': 0, 'trivial': 0}
+        scores = np.zeros((len(references), len(KEYS)), dtype=np.float64)
+        reencode = []
+
+        offset = 0
+        for ref_part, pred_part in zip(instance_parts(references), instance_parts(predictions)):
+            num_notes = len(ref_part.notes)
+            for first in range(0, num_notes, self.notes_per_batch):
+                notes = range(first, min(first + self.notes_per_batch, num_notes))
+                texts = list(dict.fromkeys(
+                    [ref_part.notes[note] for note in notes] + [pred_part.notes[note] for note in notes]
+                ))
+                encoded = dict(zip(texts, self.encoder.encode(texts, batch_size=batch_size)))
+                token_offsets = {}
+                for note in notes:
+                    ref_note, pred_note = ref_part.notes[note], pred_part.notes[note]
+                    for block in range(ref_part.num_blocks):
+                        ind = block * num_notes + note
+                        ref_text, pred_text = ref_part[ind], pred_part[ind]
+                        kind = trivial_pair_kind(ref_text, pred_text)
+                        if kind in rules:
+                            scores[offset + ind] = [rules[kind][key] for key in KEYS]
+                            stats['trivial'] += 1
+                            continue
+                        if block == 0:
+                            scores[offset + ind] = greedy_match(*encoded[ref_note], *encoded[pred_note])
+                            stats['full_notes'] += 1
+                            continue
+
+                        rows = []
+                        for part, text in [(ref_part, ref_note), (pred_part, pred_note)]:
+                            row = part.spans.rows[note, block - 1]
+                            if row < 0:
+                                break
+                            if text not in token_offsets:
+                                token_offsets[text] = self.token_offsets(text, len(encoded[text][0]))
+                            if token_offsets[text] is None:
+                                break
+                            rows.append(self.span_rows(token_offsets[text], part.spans.start[row], part.spans.end[row]))
+                        if len(rows) < 2 or rows[0] is None or rows[1] is None:
+                            reencode.append(offset + ind)
+                            continue
+                        (ref_emb, ref_weights), (hyp_emb, hyp_weights) = encoded[ref_note], encoded[pred_note]
+                        scores[offset + ind] = greedy_match(
+                            ref_emb[rows[0]], ref_weights[rows[0]], hyp_emb[rows[1]], hyp_weights[rows[1]]
+                        )
+                        stats['derived'] += 1
+            offset += len(ref_part)
+
+        # the sections that could not be derived are encoded on their own, as without --section_scoring
+        if len(reencode) > 0:
+            computed = self.compute(
+                [predictions[ind] for ind in reencode], [references[ind] for ind in reencode], model_type=model_type,
+                num_layers=num_layers, device=device, batch_size=batch_size
+            )
+            for col, key in enumerate(KEYS):
+                scores[reencode, col] = computed[key]
+            stats['reencoded'] += len(reencode)
+        return {key: scores[:, col].tolist() for col, key in enumerate(KEYS)}, stats
+
+
+def deviation_report(derived, reencoded, divisions):
+    """
+    How far the derived scores of every section division are from re-encoding the section, see
+    division_deviations. The full notes are compared too, their only difference being the encoder of the backends.
+    """
+    import evaluate_summarization as es
+    return es.division_deviations(
+        KEYS, derived, reencoded, divisions, mean_names=('full_note_mean', 'reencode_mean')
+    )
+
+
+if __name__ == "__main__":
+    import evaluate_summarization as es
+    from table_io import read_table
+
+    parser = argparse.ArgumentParser(
+        prog='section_scores',
+        description='Reports how far --section_scoring full_note BERTScores of the section divisions of a taskB run '
+                    'are from re-encoding every section.'
+    )
+    parser.add_argument('--fn_gold', required=True, help='filename of gold references requires id and note column.')
+    parser.add_argument('--fn_sys', required=True, help='filename of system references requires id and note column.')
+    parser.add_argument('--id_column', default='TestID', help='column to use for identifying id.')
+    parser.add_argument('--note_column', default='SystemOutput', help='column to use for identifying note.')
+    parser.add_argument('--dialogue_column', default='dialogue', help='column to use for identifying dialogue.')
+    parser.add_argument('--section_workers', default=None, type=int, help='processes used for section division.')
+    parser.add_argument(
+        '--backend', default='huggingface',
+        help='bert_scorer backend scoring the re-encoded sections (default huggingface, the evaluator default).'
+    )
+    parser.add_argument('--report', default='section_scoring_report.json', help='JSON file to write the report to.')
+    args = parser.parse_args()
+    args.task = 'taskB'
+
+    full_df = es.merge_inputs(args, read_table(args.fn_gold), read_table(args.fn_sys))
+    _, references, predictions, instance_info = es.build_instances(args, full_df)
+
+    print('Scoring the section divisions from the full notes')
+    scorer, kwargs, keys, _ = es.load_scorer('bert_scorer', 'full_note')
+    derived, stats = scorer.score_instances(references, predictions, **kwargs)
+    print(f'Scoring the section divisions re-encoded ({args.backend})')
+    scorer, kwargs, keys, _ = es.load_scorer('bert_scorer', args.backend)
+    reencoded, _ = es.compute_scores('bert_scorer', scorer, kwargs, keys, es.plan_scoring(references, predictions))
+
+    report = {
+        'instances': stats,
+        'divisions': deviation_report(derived, reencoded, instance_info['division']),
+    }
+    with open(args.report, 'w') as fd:
+        json.dump(report, fd, indent=4)
+    print(f'Instances: {stats}')
+    for division, obj in report['divisions'].items():
+        for key, vals in obj.items():
+            if vals['instances'] > 0:
+                print(f'\t{division} {key}: mean |diff| {vals["mean_abs_diff"]:.4f}, max |diff| {vals["max_abs_diff"]:.4f}, '
+                      f'cohort mean {vals["full_note_mean"]:.4f} vs {vals["reencode_mean"]:.4f}')
+    print(f'Report saved to {args.report}')
@@ -1,6 +1,10 @@
+import os
 import re
 import sys
+import bisect
+import multiprocessing
 
+from array import array
 from collections import OrderedDict
 
 #a colon version asks for :, but also will give a variation of no colon on it's own seperate line
@@ -31,6 +35,8 @@ sectcat2subsections[ 'assessment_and_plan' ] = ap_subsections
 
 #default name when there is no sectionheader
 NOSECTIONHEADER = 'default'
+#whitespace that stays on the same line (\s without \n)
+LINE_WHITESPACE = r'[^\S\n]*'
 #map between subsectionheader to it's parent section
 subsectionheader2section = {}
 for sh, sshdicts in sectcat2subsections.items() :
@@ -38,6 +44,13 @@ for sh, sshdicts in sectcat2subsections.items() :
         subsectionheader2section[ ssh ] = sh
 subsectionheader2section[ NOSECTIONHEADER ] = NOSECTIONHEADER
 
+#metasections of divide_note_by_metasections, divide_many codes each span by its index in this list
+METASECTIONS = [ 'subjective', 'objective_exam', 'objective_results', 'assessment_and_plan' ]
+METASECTION2CODE = { x: ind for ind, x in enumerate( METASECTIONS ) }
+
+#below this many notes divide_many runs serially, starting a process pool costs more than it saves
+DIVIDE_MANY_MIN_PARALLEL = 2000
+
 
 class SectionTagger() :
     
@@ -47,27 +60,50 @@ class SectionTagger() :
         self.compileregexes()
     
     def compileregexes( self ) :
-        self.subsect2regex = {}
+        """
+        Builds the matching engine once:
+          subsect2regex: compiled per-subsection regex, anchored at a line start by .match( text, pos )
+          sectionheader_regex: single multiline prefilter over every header, used to find candidate lines
+          impression_regex: case sensitive special case of impression
+        """
+        self.subsect2regex = OrderedDict()
+        headerexps = []
         for _, sectcat2subsections in self.sectcat2subsections.items() :
             for subsect, vlst in sectcat2subsections.items() :
-                self.subsect2regex[ subsect ] = self._compile_regexexpression( vlst )
-    
+                self.subsect2regex[ subsect ] = re.compile( self._compile_regexexpression( vlst ), re.IGNORECASE | re.MULTILINE )
+                headerexps.extend( self._header_expressions( vlst ) )
+
+        self.impression_regex = re.compile( LINE_WHITESPACE + 'IMPRESSION' )
+
+        #any line that can match a subsection regex starts with one of these, so one search finds every candidate line
+        self.sectionheader_regex = re.compile( '^' + LINE_WHITESPACE + '(?:(?i:' + '|'.join( headerexps ) + ')|IMPRESSION)', re.MULTILINE )
+
+    def _header_expressions( self, vlst ) :
+        #same headers as _compile_regexexpression, but without capture groups (which keeps the prefilter fast)
+        expressions = []
+        for exp in vlst :
+            expressions.append( re.escape( exp ).replace( r'\ ', LINE_WHITESPACE ) )
+            if exp[-1] == ':' :
+                expressions.append( re.escape( exp[:-1] ).replace( r'\ ', LINE_WHITESPACE ) )
+        return expressions
+
     def _compile_regexexpression( self, vlst ) :
+        #whitespace never crosses a line, so the patterns behave the same on the full text as on a single line
         expressions = []
         otherexps = []
         for exp in vlst :
-            exp2 = '(' + re.escape( exp ).replace( '\ ', '\s*' ) +')'
+            exp2 = '(' + re.escape( exp ).replace( r'\ ', LINE_WHITESPACE ) +')'
             expressions.append( exp2 )
             if exp[-1] == ':' :
                 #allow without : if the line is empty
-                exp2 = '(' + re.escape( exp[:-1] ).replace( '\ ', '\s*' ) +')'
+                exp2 = '(' + re.escape( exp[:-1] ).replace( r'\ ', LINE_WHITESPACE ) +')'
                 otherexps.append( exp2 )
-        
-        patt = '\s*(?P<sectionheader1>' + '|'.join( expressions ) + ').*'
+
+        patt = LINE_WHITESPACE + '(?P<sectionheader1>' + '|'.join( expressions ) + ').*'
         if len( otherexps ) > 0 :
-            pattott = '\s*(?P<sectionheader2>' + '|'.join( otherexps ) + ')\s*$'
+            pattott = LINE_WHITESPACE + '(?P<sectionheader2>' + '|'.join( otherexps ) + ')' + LINE_WHITESPACE + '$'
             return '(' + patt + '|' + pattott + ')'
-        
+
         return patt
 
     def tag_sectionheaders( self, text ) :
@@ -76,25 +112,28 @@ class SectionTagger() :
         Return: sections : list of tupples ( subsectionheader, linenum, char_start, char_end  )
         """
         #assumes text is sentence tokenize according to lines
-        offset = 0
         subsects = []
-        for linenum, line in enumerate( text.split( '\n' ) ) :
+        linenum = 0
+        prevpos = 0
+        for cand in self.sectionheader_regex.finditer( text ) :
+            offset = cand.start()
+            linenum += text.count( '\n', prevpos, offset )
+            prevpos = offset
+
             for subsect, rgx in self.subsect2regex.items() :
-                m = re.match( rgx, line, re.IGNORECASE )
+                m = rgx.match( text, offset )
                 if m :
-                    secthlib = m.groupdict()
-                    secthpattname = [ 'sectionheader1' if ( secthlib['sectionheader1'] is not None ) else 'sectionheader2' ][0]
-                    subsects.append( ( subsect, linenum, offset, offset+m.end( secthpattname ) ) )
-            
+                    secthpattname = 'sectionheader1' if ( m.group( 'sectionheader1' ) is not None ) else 'sectionheader2'
+                    subsects.append( ( subsect, linenum, offset, m.end( secthpattname ) ) )
+
             #adding special case of impression as assessment (but don't want lower case versions to show up,
             # as our dataset has impression as part of results )
-            m = re.match( '\s*IMPRESSION', line )
+            m = self.impression_regex.match( text, offset )
             if m :
-                subsects.append( ( 'impression', linenum, offset, offset+m.end() ) )
+                subsects.append( ( 'impression', linenum, offset, m.end() ) )
 
-            offset += len( line ) + 1
         return subsects
-    
+
     def tag_sections( self, text ) :
         """
         Given text, return list of tuples:
@@ -115,29 +154,26 @@ class SectionTagger() :
                 linenum2tuple[ linenum ] = subsect
         
         sectionlist = []
-        offset = 0
-        
+
         #check if first line 
         if 0 in linenum2tuple :
             prevsectionheadertuple = linenum2tuple[ 0 ]
         else :
             prevsectionheadertuple = ( NOSECTIONHEADER, 0, 0, 0 )
 
-        lines = text.split( '\n' )
-        offset = len( lines[0] ) + 1
-        for linenum, line in enumerate( lines[1:], 1 ) :
-
-            if linenum in linenum2tuple :
-                shtuple = linenum2tuple[ linenum ]
-
-                #adding special case of impression as assessment
-                if prevsectionheadertuple[0] == 'impression' :
-                    prevsection = 'assessment_and_plan'
-                else :
-                    prevsection = subsectionheader2section[ prevsectionheadertuple[0] ]
-                sectionlist.append( [prevsection] + list( prevsectionheadertuple ) + [ offset ] )
-                prevsectionheadertuple = shtuple
-            offset += len( line ) + 1
+        #a subsection ends at the line start of the next header, which is the char_start of its tuple
+        for linenum in sorted( linenum2tuple ) :
+            if linenum == 0 :
+                continue
+            shtuple = linenum2tuple[ linenum ]
+
+            #adding special case of impression as assessment
+            if prevsectionheadertuple[0] == 'impression' :
+                prevsection = 'assessment_and_plan'
+            else :
+                prevsection = subsectionheader2section[ prevsectionheadertuple[0] ]
+            sectionlist.append( [prevsection] + list( prevsectionheadertuple ) + [ shtuple[2] ] )
+            prevsectionheadertuple = shtuple
     
         #adding special case of impression as assessment
         if prevsectionheadertuple[0] == 'impression' :
@@ -183,6 +219,80 @@ class SectionTagger() :
 
         return meta_sections
 
+    def divide_many( self, texts, workers=None, chunksize=500, newline=None ) :
+        """
+        Input : list of texts, number of worker processes (default cpu count), notes per worker task,
+            newline: a line break marker of the texts ( e.g. __lf1__ ) read as \n
+        Return: span table : dict of note_index, division, start, end integer arrays with one entry per detected metasection
+            ( division is the index in METASECTIONS, start and end are the subsectheader_start and subsectionend of
+            divide_note_by_metasections, as offsets into the given texts even where newline was read as \n )
+
+        Uses a process pool when there are enough notes, otherwise runs serially.
+        """
+        texts = list( texts )
+        if workers is None :
+            workers = os.cpu_count() or 1
+        workers = min( workers, -( -len( texts ) // chunksize ) )
+
+        if workers <= 1 or len( texts ) < DIVIDE_MANY_MIN_PARALLEL :
+            return self._divide_columns( texts, newline=newline )
+
+        columns = _empty_columns()
+        chunks = [ ( ind, texts[ ind:ind+chunksize ], newline ) for ind in range( 0, len( texts ), chunksize ) ]
+        with multiprocessing.Pool( workers, initializer=_init_divide_worker, initargs=( type( self ), self.sectcat2subsections ) ) as pool :
+            for chunkcolumns in pool.imap( _divide_chunk, chunks ) :
+                for k, v in chunkcolumns.items() :
+                    columns[ k ].extend( v )
+        return columns
+
+    def _divide_columns( self, texts, first_index=0, newline=None ) :
+        columns = _empty_columns()
+        for note_index, text in enumerate( texts, first_index ) :
+            #each note is converted on its own, the offsets are mapped back to the unconverted note
+            markers = None
+            if newline is not None and newline in text :
+                markers = _marker_positions( text, newline )
+                text = text.replace( newline, '\n' )
+            for section in self.divide_note_by_metasections( text ) :
+                start, end = section[3], section[-1]
+                if markers is not None :
+                    shift = len( newline ) - 1
+                    start += shift * bisect.bisect_left( markers, start )
+                    end += shift * bisect.bisect_left( markers, end )
+                columns[ 'note_index' ].append( note_index )
+                columns[ 'division' ].append( METASECTION2CODE[ section[0] ] )
+                columns[ 'start' ].append( start )
+                columns[ 'end' ].append( end )
+        return columns
+
+
+def _empty_columns() :
+    return { 'note_index': array( 'q' ), 'division': array( 'b' ), 'start': array( 'q' ), 'end': array( 'q' ) }
+
+
+def _marker_positions( text, newline ) :
+    #where each newline marker of text sits once every marker is replaced by one \n ( as str.replace finds them )
+    positions = []
+    shift = len( newline ) - 1
+    pos = text.find( newline )
+    while pos != -1 :
+        positions.append( pos - shift * len( positions ) )
+        pos = text.find( newline, pos + len( newline ) )
+    return positions
+
+
+#each pool worker builds its own tagger once, rather than receiving the compiled regexes with every chunk
+_worker_tagger = None
+
+def _init_divide_worker( tagger_class, sectcat2subsections ) :
+    global _worker_tagger
+    _worker_tagger = tagger_class( sectcat2subsections )
+
+
+def _divide_chunk( chunk ) :
+    first_index, texts, newline = chunk
+    return _worker_tagger._divide_columns( texts, first_index, newline )
+
 
 if __name__ == "__main__" :
 
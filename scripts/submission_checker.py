@@ -1,47 +1,31 @@
-import csv
-import os
-
-filepath = ""
-
-
-# Check that the file path exists
-if not os.path.exists(filepath):
-    raise ValueError("File path does not exist")
-
-# Extract the file name from the file path
-filename = os.path.basename(filepath)
-
-# Check that the file name starts with "taskA", "taskB", or "taskC"
-if not (filename.startswith("taskA") or filename.startswith("taskB") or filename.startswith("taskC")):
-    raise ValueError("File name must start with 'taskA', 'taskB', or 'taskC'")
-
-# Check that the file is a CSV file
-if not filename.endswith(".csv"):
-    raise ValueError("File must be a CSV file")
-
-# Open the file and check the number of columns and test IDs
-if (filename.startswith("taskA")): 
-    with open(filepath, "r") as file:
-        reader = csv.reader(file)
-        header = next(reader)
-        if len(header) != 3:
-            raise ValueError("Task A run file must have 3 columns TestID, SystemOutput1, and SystemOutput2.")
-        
-        # Check that the first column contains test IDs:
-        for row in reader:
-            if not (row[0].isdigit()):
-                raise ValueError("First column of Task A run file must contain test IDs.")
-else:
-    if (filename.startswith("taskB") or filename.startswith("taskC")): 
-        with open(filepath, "r") as file:
-            reader = csv.reader(file)
-            header = next(reader)
-            if len(header) != 2:
-                raise ValueError("Task B/C run file must have 2 columns TestID and SystemOutput.")
-            
-            # Check that the first column contains test IDs:
-            for row in reader:
-                if not (row[0].startswith("D2N")):
-                    raise ValueError("First column of Task B/C run file must contain test IDs.")
-
-print("Run file is valid.")
+import sys
+import argparse
+
+from submission_validation import TASKS, DEFAULT_MAX_ERRORS, validate_many, format_errors
+
+if __name__ == "__main__":
+    # Checks one or more run files, e.g.
+    #   python submission_checker.py taskB_teamName_run1.csv taskB_teamName_run2.csv
+    # Every problem is printed with its line number, the exit code is 1 if any file is invalid.
+    parser = argparse.ArgumentParser(prog="submission_checker", description="Validate run files before submission.")
+    parser.add_argument("filepaths", nargs="+", help="run files named task{A|B|C}_teamName_run{1|2|3}.csv")
+    parser.add_argument("--task", default=None, choices=list(TASKS), help="task of every file (default: from the file names)")
+    parser.add_argument("--partial", action="store_true", help="do not require every test encounter to be present")
+    parser.add_argument("--workers", default=None, type=int, help="files checked in parallel (default: cpu count)")
+    parser.add_argument("--max_errors", default=DEFAULT_MAX_ERRORS, type=int, help="problems printed per file")
+    args = parser.parse_args()
+
+    num_invalid = 0
+    for filepath, task, num_rows, errors in validate_many(
+        args.filepaths, workers=args.workers, task=args.task, complete=not args.partial, max_errors=args.max_errors
+    ):
+        if len(errors) == 0:
+            print(f"{filepath}: Run file is valid ({task}, {num_rows} rows).")
+        else:
+            num_invalid += 1
+            for line in format_errors(filepath, errors):
+                print(line)
+
+    if len(args.filepaths) > 1:
+        print(f"{len(args.filepaths) - num_invalid} of {len(args.filepaths)} run files are valid.")
+    sys.exit(1 if num_invalid > 0 else 0)
@@ -0,0 +1,197 @@
+"""
+Streaming validation of run (submission) files, shared by submission_checker.py and evaluate_summarization.py.
+
+Rows are read one at a time with the csv module ( only the ID column of Parquet and Arrow IPC files is read ),
+so only the IDs seen so far are kept in memory, and every problem is collected with the line it was found on
+instead of stopping at the first one. A file is checked for
+its columns, the ID prefix and range of its task, duplicate IDs and, unless partial runs are allowed, that
+every ID of the task range is present. validate_many checks many files in parallel.
+"""
+import os
+import csv
+import functools
+import multiprocessing
+
+import table_io
+
+TASKA_RANGE = [0,199]
+TASKA_PREFIX = ''
+
+TASKB_RANGE = [88,127]
+TASKB_PREFIX = 'D2N'
+
+TASKC_RANGE = [128,167]
+TASKC_PREFIX = 'D2N'
+
+TASKS = {
+    'taskA': {'prefix': TASKA_PREFIX, 'range': TASKA_RANGE, 'columns': ['TestID', 'SystemOutput1', 'SystemOutput2']},
+    'taskB': {'prefix': TASKB_PREFIX, 'range': TASKB_RANGE, 'columns': ['TestID', 'SystemOutput']},
+    'taskC': {'prefix': TASKC_PREFIX, 'range': TASKC_RANGE, 'columns': ['TestID', 'SystemOutput']},
+}
+
+# problems reported per file, the rest are only counted
+DEFAULT_MAX_ERRORS = 100
+# missing IDs listed in the completeness problem
+_MAX_MISSING_LISTED = 10
+
+
+def task_from_filename(fn):
+    """The task a run file is for, from its task{A|B|C}_teamName_run{1|2|3}.csv name, or None."""
+    filename = os.path.basename(fn)
+    for task in TASKS:
+        if filename.startswith(task):
+            return task
+    return None
+
+
+def parse_id(value, prefix):
+    """The number of an ID made of prefix and digits, None if value is not such an ID."""
+    if not value.startswith(prefix):
+        return None
+    number = value[len(prefix):]
+    if not number.isascii() or not number.isdigit():
+        return None
+    return int(number)
+
+
+def _csv_rows(fn, id_column):
+    """Header, then ( line, number of fields, ID or None ) of every row of csv file fn."""
+    with open(fn, newline='', encoding='utf-8') as fd:
+        reader = csv.reader(fd)
+        header = next(reader, None)
+        yield header
+        if header is None:
+            return
+        id_index = 0 if id_column is None or id_column not in header else header.index(id_column)
+        line = reader.line_num + 1
+        for row in reader:
+            # a quoted field may span several lines, report the line the row starts on
+            row_line, line = line, reader.line_num + 1
+            if len(row) == 0:
+                continue
+            yield row_line, len(row), row[id_index] if len(row) > id_index else None
+
+
+def _arrow_rows(fn, id_column):
+    """As _csv_rows for a Parquet or Arrow IPC file, rows numbered as the lines of its csv export."""
+    header = table_io.table_columns(fn)
+    yield header
+    if len(header) == 0:
+        return
+    id_name = header[0] if id_column is None or id_column not in header else id_column
+    ids = table_io.read_arrow(fn, columns=[id_name]).column(0).to_pylist()
+    for row_line, value in enumerate(ids, 2):
+        yield row_line, len(header), '' if value is None else str(value)
+
+
+def validate_file(fn, prefix, id_range, id_column=None, num_columns=None, complete=True,
+                  max_errors=DEFAULT_MAX_ERRORS):
+    """
+    Checks the IDs of csv ( or Parquet / Arrow IPC ) file fn against prefix and the inclusive id_range. id_column
+    defaults to the first column, num_columns is the number of columns the file must have ( any if None ). With
+    complete, every ID of id_range must be present.
+
+    Returns the number of rows and the list of ( line, message ) problems, line None for problems of the
+    whole file.
+    """
+    errors = []
+    num_errors = 0
+
+    def _error(line, message):
+        nonlocal num_errors
+        num_errors += 1
+        if len(errors) < max_errors:
+            errors.append((line, message))
+
+    num_rows = 0
+    seen = {}
+    try:
+        rows = _arrow_rows(fn, id_column) if table_io.is_arrow(fn) else _csv_rows(fn, id_column)
+        header = next(rows)
+        if header is None:
+            return 0, [(None, 'File is empty, expected a header row')]
+        if num_columns is not None and len(header) != num_columns:
+            _error(1, f'Header has {len(header)} columns, expected {num_columns}')
+        if id_column is not None and id_column not in header:
+            return 0, [(1, f'No {id_column} column in the header {header}')]
+
+        for row_line, num_fields, value in rows:
+            num_rows += 1
+            if num_fields != len(header):
+                _error(row_line, f'Row has {num_fields} fields, expected {len(header)}')
+                if value is None:
+                    continue
+            number = parse_id(value, prefix)
+            if number is None:
+                _error(row_line, f'ID {value!r} is not {prefix!r} followed by a number')
+                continue
+            if number < id_range[0] or number > id_range[1]:
+                _error(row_line, f'ID {value!r} is outside of the test encounters {id_range[0]}-{id_range[1]}')
+            if number in seen:
+                _error(row_line, f'ID {value!r} is repeated, first seen on line {seen[number]}')
+            else:
+                seen[number] = row_line
+    except UnicodeDecodeError as e:
+        _error(None, f'File is not valid utf-8 after row {num_rows}: {e}')
+    except csv.Error as e:
+        _error(None, f'File is not valid csv after row {num_rows}: {e}')
+
+    if num_rows == 0:
+        _error(None, 'File has no rows')
+    elif complete:
+        missing = [number for number in range(id_range[0], id_range[1] + 1) if number not in seen]
+        if len(missing) > 0:
+            listed = ', '.join(str(number) for number in missing[:_MAX_MISSING_LISTED])
+            more = ' ...' if len(missing) > _MAX_MISSING_LISTED else ''
+            _error(None, f'{len(missing)} test encounters are missing, ID numbers {listed}{more}')
+
+    if num_errors > len(errors):
+        errors.append((None, f'... and {num_errors - len(errors)} more problems'))
+    return num_rows, errors
+
+
+def validate_submission(fn, task=None, complete=True, max_errors=DEFAULT_MAX_ERRORS):
+    """
+    Checks run file fn as submitted for task ( from its file name if None ): the file name, its columns and its IDs.
+    Returns fn, the task, the number of rows and the list of ( line, message ) problems.
+    """
+    if not os.path.exists(fn):
+        return fn, task, 0, [(None, 'File path does not exist')]
+    if task is None:
+        task = task_from_filename(fn)
+        if task is None:
+            return fn, task, 0, [(None, "File name must start with 'taskA', 'taskB', or 'taskC'")]
+    if not fn.endswith('.csv'):
+        return fn, task, 0, [(None, 'File must be a CSV file')]
+
+    spec = TASKS[task]
+    num_rows, errors = validate_file(
+        fn, spec['prefix'], spec['range'], num_columns=len(spec['columns']), complete=complete, max_errors=max_errors
+    )
+    return fn, task, num_rows, errors
+
+
+def _validate_submission(kwargs, fn):
+    return validate_submission(fn, **kwargs)
+
+
+def validate_many(fns, workers=None, **kwargs):
+    """
+    validate_submission of every file, from a pool of workers processes ( cpu count if None ).
+    Yields the results in the order of fns.
+    """
+    fns = list(fns)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(fns))
+    if workers <= 1:
+        for fn in fns:
+            yield validate_submission(fn, **kwargs)
+        return
+    with multiprocessing.Pool(workers) as pool:
+        yield from pool.imap(functools.partial(_validate_submission, kwargs), fns)
+
+
+def format_errors(fn, errors):
+    """One 'fn:line: message' line per problem."""
+    return [f'{fn}:{line}: {message}' if line is not None else f'{fn}: {message}' for line, message in errors]
@@ -0,0 +1,106 @@
+"""
+Reading and writing the evaluation tables as CSV, Parquet or Arrow IPC ( Feather v2 ), chosen by file extension.
+
+CSV files are read with pd.read_csv exactly as before. Parquet and Arrow IPC files are memory-mapped and read
+with pyarrow, their string columns kept in Arrow memory as the explicit pd.StringDtype('pyarrow') dtype rather
+than copied into Python objects ( an IPC file without compression is read without copying at all ).
+to_object_strings turns them into the object columns a CSV read gives, once the rows that are needed are known.
+"""
+import os
+
+import numpy as np
+
+PARQUET_EXTENSIONS = ['.parquet', '.pq']
+IPC_EXTENSIONS = ['.arrow', '.feather', '.ipc']
+
+
+def table_format(fn):
+    """'parquet', 'ipc' or 'csv' ( any other extension ) for a table file name."""
+    ext = os.path.splitext(fn)[1].lower()
+    if ext in PARQUET_EXTENSIONS:
+        return 'parquet'
+    if ext in IPC_EXTENSIONS:
+        return 'ipc'
+    return 'csv'
+
+
+def is_arrow(fn):
+    return table_format(fn) != 'csv'
+
+
+def _string_types_mapper():
+    import pandas as pd
+    import pyarrow as pa
+    string_dtype = pd.StringDtype('pyarrow')
+    return {pa.string(): string_dtype, pa.large_string(): string_dtype}.get
+
+
+def read_arrow(fn, columns=None):
+    """The pyarrow Table of a Parquet or Arrow IPC file, memory-mapped."""
+    import pyarrow as pa
+    if table_format(fn) == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.read_table(fn, columns=columns, memory_map=True)
+    with pa.memory_map(fn) as source:
+        table = pa.ipc.open_file(source).read_all()
+    return table if columns is None else table.select(columns)
+
+
+def arrow_to_pandas(table):
+    return table.to_pandas(types_mapper=_string_types_mapper())
+
+
+def read_table(fn, columns=None):
+    """DataFrame of a CSV, Parquet or Arrow IPC file, optionally of some columns only."""
+    if not is_arrow(fn):
+        import pandas as pd
+        return pd.read_csv(fn, usecols=columns)
+    return arrow_to_pandas(read_arrow(fn, columns=columns))
+
+
+def read_chunks(fn, chunk_size):
+    """Yields DataFrames of chunk_size rows of a CSV, Parquet or Arrow IPC file."""
+    import pandas as pd
+    fmt = table_format(fn)
+    if fmt == 'csv':
+        yield from pd.read_csv(fn, chunksize=chunk_size)
+        return
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(fn, memory_map=True).iter_batches(batch_size=chunk_size):
+            yield arrow_to_pandas(batch)
+        return
+    table = read_arrow(fn)
+    for start in range(0, table.num_rows, chunk_size):
+        yield arrow_to_pandas(table.slice(start, chunk_size))
+
+
+def table_columns(fn):
+    """Column names of a Parquet or Arrow IPC file, from its schema."""
+    import pyarrow as pa
+    if table_format(fn) == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.read_schema(fn, memory_map=True).names
+    with pa.memory_map(fn) as source:
+        return pa.ipc.open_file(source).schema.names
+
+
+def to_object_strings(df):
+    """df with its Arrow string columns as object columns of str, missing values as NaN, as read from CSV."""
+    import pandas as pd
+    for column in df.columns:
+        if isinstance(df[column].dtype, (pd.StringDtype, pd.ArrowDtype)) and df[column].dtype.kind in 'OU':
+            values = df[column]
+            df[column] = values.astype(object).where(values.notna(), np.nan)
+    return df
+
+
+def write_table(df, fn):
+    """Writes df as Parquet or Arrow IPC by the extension of fn ( CSV otherwise, without the index )."""
+    fmt = table_format(fn)
+    if fmt == 'csv':
+        df.to_csv(fn, index=False)
+    elif fmt == 'parquet':
+        df.to_parquet(fn, index=False)
+    else:
+        df.reset_index(drop=True).to_feather(fn)
@@ -0,0 +1,12 @@
+"""
+Offline tests of the evaluation scripts, run from the repository root with python -m pytest tests.
+The scripts are standalone modules importing each other by name, put on sys.path as benchmarks does.
+"""
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+import benchmarks  # noqa: E402,F401
@@ -0,0 +1,93 @@
+"""
+The CPU-optimized BERTScore backends loaded as the evaluator loads them, on a tiny randomly initialized BERT
+written locally so that no model is downloaded, scored against the full-precision encoder.
+"""
+import os
+import math
+import importlib.util
+
+import pytest
+
+torch = pytest.importorskip('torch')
+transformers = pytest.importorskip('transformers')
+pytest.importorskip('bert_score')
+
+import evaluate_summarization as es
+from cpu_backends import ONNX_DIR_ENV, EncodedBertScore
+
+PAIRS = [
+    ('patient reports chest pain for two days', 'the patient has had chest pain for two days'),
+    ('blood pressure is normal', 'normal blood pressure'),
+    ('continue the current dose of lisinopril', 'we will continue lisinopril at the same dose'),
+    ('no fever or cough', 'denies fever , reports a mild cough'),
+]
+REFERENCES = [ref for ref, _ in PAIRS]
+PREDICTIONS = [pred for _, pred in PAIRS]
+NUM_LAYERS = 2
+
+
+def requires(*modules):
+    missing = [module for module in modules if importlib.util.find_spec(module) is None]
+    return pytest.mark.skipif(len(missing) > 0, reason=f'needs the optional {", ".join(missing)}')
+
+
+# the largest difference to the full-precision encoder allowed per backend, ONNX Runtime in full precision only
+# differs by float rounding
+BACKENDS = [
+    pytest.param('int8', 0.1),
+    pytest.param('onnx', 1e-4, marks=requires('onnxruntime')),
+    pytest.param('onnx-int8', 0.1, marks=requires('onnxruntime', 'onnx')),
+]
+
+
+@pytest.fixture(scope='module')
+def tiny_bert(tmp_path_factory):
+    """Path of a tiny randomly initialized BERT with a tokenizer of the words of PAIRS."""
+    path = str(tmp_path_factory.mktemp('tiny-bert'))
+    torch.manual_seed(0)
+    words = sorted({word for pair in PAIRS for text in pair for word in text.lower().split()})
+    with open(os.path.join(path, 'vocab.txt'), 'w') as fd:
+        fd.write('\n'.join(['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + words) + '\n')
+    transformers.BertTokenizer(os.path.join(path, 'vocab.txt'), model_max_length=64).save_pretrained(path)
+    config = transformers.BertConfig(
+        vocab_size=len(words) + 5, hidden_size=32, num_hidden_layers=NUM_LAYERS, num_attention_heads=2,
+        intermediate_size=64, max_position_embeddings=64,
+    )
+    transformers.BertModel(config).save_pretrained(path)
+    return path
+
+
+@pytest.fixture(scope='module')
+def full_precision(tiny_bert):
+    return EncodedBertScore().compute(PREDICTIONS, REFERENCES, model_type=tiny_bert, num_layers=NUM_LAYERS)
+
+
+@pytest.mark.parametrize('backend,tolerance', BACKENDS)
+def test_backend_scores(backend, tolerance, tiny_bert, full_precision, tmp_path, monkeypatch):
+    monkeypatch.setenv(ONNX_DIR_ENV, str(tmp_path / 'onnx'))
+    scorer, kwargs, keys, _ = es.load_scorer('bert_scorer', backend)
+    assert scorer.config_name == backend
+
+    kwargs = dict(kwargs, model_type=tiny_bert, num_layers=NUM_LAYERS)
+    scores = scorer.compute(predictions=PREDICTIONS, references=REFERENCES, **kwargs)
+    assert sorted(scores) == sorted(keys)
+    for key in keys:
+        assert len(scores[key]) == len(PAIRS)
+        assert all(math.isfinite(val) for val in scores[key])
+        assert scores[key] == pytest.approx(full_precision[key], abs=tolerance)
+
+
+@pytest.mark.parametrize('backend,tolerance', BACKENDS)
+def test_backend_scores_instances(backend, tolerance, tiny_bert, full_precision, tmp_path, monkeypatch):
+    """The backend through compute_scores, the evaluator's batching of the unique pairs of the instances."""
+    monkeypatch.setenv(ONNX_DIR_ENV, str(tmp_path / 'onnx'))
+    scorer, kwargs, keys, _ = es.load_scorer('bert_scorer', backend)
+    kwargs = dict(kwargs, model_type=tiny_bert, num_layers=NUM_LAYERS)
+    # every pair twice, and a trivial empty pair
+    plan = es.plan_scoring(REFERENCES * 2 + ['blood pressure'], PREDICTIONS * 2 + [''])
+    scores, num_scored = es.compute_scores('bert_scorer', scorer, kwargs, keys, plan, max_tokens_per_batch=16)
+    assert num_scored == len(PAIRS)
+    for key in keys:
+        assert len(scores[key]) == 2 * len(PAIRS) + 1
+        assert scores[key][:2 * len(PAIRS)] == pytest.approx(full_precision[key] * 2, abs=tolerance)
+        assert scores[key][-1] == 0.0
@@ -0,0 +1,132 @@
+"""The evaluation server over a Unix socket, with stand-in model scorers so the jobs run offline."""
+import sys
+import json
+import time
+import threading
+
+import pytest
+
+import evaluate_summarization as es
+from benchmarks.stand_in import stand_in_scorers
+from benchmarks.synthetic import generate_dataset
+from evaluation_server import EvaluationServer, SharedScorer, make_server, request
+from submission_validation import TASKB_PREFIX, TASKB_RANGE
+
+# the built-in ROUGE is the rouge scorer stand_in_scorers keeps
+BACKENDS = ['--backends', 'rouge=native']
+POLL_SECONDS = 60
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    """A gold and a system file of every taskB test encounter, and the options of a job evaluating them."""
+    df = generate_dataset(TASKB_RANGE[1] - TASKB_RANGE[0] + 1, seed=0)
+    ids = ['%s%03d' % (TASKB_PREFIX, ind) for ind in range(TASKB_RANGE[0], TASKB_RANGE[1] + 1)]
+    fn_gold = str(tmp_path / 'gold.csv')
+    fn_sys = str(tmp_path / 'taskB_test_run1.csv')
+    df.assign(TestID=ids, SystemOutput=df['note'])[['TestID', 'SystemOutput', 'dialogue']].to_csv(fn_gold, index=False)
+    df.assign(TestID=ids, SystemOutput=df['prediction'])[['TestID', 'SystemOutput']].to_csv(fn_sys, index=False)
+    return tmp_path, ['--fn_gold', fn_gold, '--fn_sys', fn_sys] + BACKENDS
+
+
+@pytest.fixture
+def served(tmp_path):
+    """An EvaluationServer with stand-in scorers loaded, serving on a Unix socket in tmp_path."""
+    evaluation = EvaluationServer()
+    args = evaluation.parser.parse_args(['--fn_gold', '', '--fn_sys', ''] + BACKENDS)
+    for name, (scorer, kwargs, keys, save_keys) in stand_in_scorers(es.SCORERS).items():
+        evaluation.scorers[evaluation.scorer_key(args, name)] = (SharedScorer(scorer), kwargs, keys, save_keys)
+    socket_path = str(tmp_path / 'evaluate.sock')
+    server = make_server(evaluation, socket_path=socket_path)
+    evaluation.start()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield evaluation, socket_path
+    finally:
+        server.shutdown()
+        server.server_close()
+        sys.stdout = evaluation.output.stream
+
+
+def evaluate_in_process(argv):
+    """The results evaluate_summarization gives for argv, as they come out of the server's JSON."""
+    args = es.build_parser().parse_args(argv)
+    results = es.evaluate(args, loaded=stand_in_scorers(es.SCORERS))
+    return json.loads(json.dumps(results))
+
+
+def without_timings(results):
+    return {
+        system: {cohort: obj for cohort, obj in outputs.items() if cohort != 'timings'}
+        for system, outputs in results.items()
+    }
+
+
+def test_job_waits_for_results(inputs, served):
+    tmp_path, argv = inputs
+    _, socket_path = served
+    code, job = request(
+        'POST', '/jobs', {'args': argv + ['--experiment', str(tmp_path / 'served')], 'wait': True},
+        socket_path=socket_path
+    )
+    assert code == 200
+    assert job['status'] == 'done', job['error']
+    assert (tmp_path / 'served_results.json').exists()
+
+    expected = evaluate_in_process(argv + ['--experiment', str(tmp_path / 'local')])
+    assert without_timings(job['results']) == without_timings(expected)
+
+
+def test_job_is_polled_until_done(inputs, served):
+    tmp_path, argv = inputs
+    _, socket_path = served
+    code, job = request(
+        'POST', '/jobs', {'args': argv + ['--experiment', str(tmp_path / 'served')]}, socket_path=socket_path
+    )
+    assert code == 202
+    assert job['status'] in ['queued', 'running']
+
+    deadline = time.time() + POLL_SECONDS
+    while job['status'] in ['queued', 'running'] and time.time() < deadline:
+        time.sleep(0.05)
+        code, job = request('GET', f'/jobs/{job["id"]}', socket_path=socket_path)
+        assert code == 200
+    assert job['status'] == 'done', job['error']
+
+    expected = evaluate_in_process(argv + ['--experiment', str(tmp_path / 'local')])
+    assert without_timings(job['results']) == without_timings(expected)
+
+
+def test_scorer_caches_are_cleared_after_jobs(inputs, served):
+    tmp_path, argv = inputs
+    evaluation, socket_path = served
+    for run in range(2):
+        code, job = request(
+            'POST', '/jobs', {'args': argv + ['--experiment', str(tmp_path / f'run{run}')], 'wait': True},
+            socket_path=socket_path
+        )
+        assert job['status'] == 'done', job['error']
+        rouge = evaluation.scorers[('rouge', 'native', None)][0].scorer
+        assert rouge.texts == {} and rouge.vocab == {}
+
+
+@pytest.mark.parametrize('body', [
+    {},
+    {'args': '--fn_gold gold.csv'},
+    {'args': ['--fn_gold', 'gold.csv']},
+    {'args': ['--fn_gold', 'gold.csv', '--fn_sys', 'sys.csv', '--metrics', 'meteor']},
+    {'args': ['--fn_gold', 'gold.csv', '--fn_sys', 'sys.csv', '--stream_chunk_size', '10', '--shard', '0/2']},
+])
+def test_bad_arguments_are_refused(served, body):
+    evaluation, socket_path = served
+    code, reply = request('POST', '/jobs', body, socket_path=socket_path)
+    assert code == 400
+    assert 'error' in reply
+    assert evaluation.health()['queued'] == 0
+
+
+def test_unknown_job(served):
+    _, socket_path = served
+    code, _ = request('GET', '/jobs/missing', socket_path=socket_path)
+    assert code == 404
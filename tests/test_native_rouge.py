@@ -0,0 +1,75 @@
+"""NativeRouge against rouge_score, as evaluate's rouge calls it ( default tokenizer, no stemmer )."""
+import random
+
+import pytest
+
+rouge_scorer = pytest.importorskip('rouge_score.rouge_scorer')
+
+from native_rouge import ROUGE_TYPES, NativeRouge
+
+PAIRS = {
+    'multi_line': (
+        'the patient reports a cough\nno fever or chills\nlungs are clear bilaterally',
+        'no fever\nthe patient reports cough and chills\nclear lungs',
+    ),
+    'multi_line_crossing': (
+        'a b c d\ne f g h\na b e f',
+        'a e b f\nc g d h',
+    ),
+    'empty_lines': (
+        '\nhistory of present illness\n\n\nchest pain for two days\n',
+        'chest pain\n\nhistory of present illness\n',
+    ),
+    'lines_without_tokens': (
+        'assessment and plan\n---\n:: ;;\nrest and fluids',
+        '***\nrest and fluids\n!!\nassessment and plan',
+    ),
+    'only_lines_without_tokens': ('...\n!!!', 'rest and fluids'),
+    'repeated_tokens': (
+        'pain pain pain in the knee knee\nknee pain',
+        'knee knee pain pain\npain in the the knee',
+    ),
+    'repeated_lines': ('mg mg mg\nmg mg\nmg', 'mg\nmg mg mg mg\nmg'),
+    'empty_prediction': ('physical exam normal', ''),
+    'empty_reference': ('', 'physical exam normal'),
+    'both_empty': ('', ''),
+    'punctuation_and_case': ('BP: 120/80, HR 72.', 'bp 120 80 hr: 72'),
+    'non_ascii': ('café naïve résumé\nx-ray', 'cafe naive resume\nx ray'),
+}
+
+
+def reference_scores(pairs):
+    scorer = rouge_scorer.RougeScorer(rouge_types=ROUGE_TYPES, use_stemmer=False)
+    scores = [scorer.score(ref, pred) for ref, pred in pairs]
+    return {rouge_type: [score[rouge_type].fmeasure for score in scores] for rouge_type in ROUGE_TYPES}
+
+
+def native_scores(pairs):
+    return NativeRouge().compute(
+        predictions=[pred for _, pred in pairs], references=[ref for ref, _ in pairs], use_aggregator=False
+    )
+
+
+@pytest.mark.parametrize('case', list(PAIRS))
+def test_matches_rouge_score(case):
+    pairs = [PAIRS[case]]
+    expected = reference_scores(pairs)
+    scores = native_scores(pairs)
+    for rouge_type in ROUGE_TYPES:
+        assert scores[rouge_type] == pytest.approx(expected[rouge_type], abs=1e-12), rouge_type
+
+
+def test_matches_rouge_score_on_random_notes():
+    rng = random.Random(0)
+    words = ['pain', 'knee', 'cough', 'fever', 'the', 'and', 'no', 'mg', '2', 'x-ray', '.', ',']
+
+    def note():
+        lines = [' '.join(rng.choice(words) for _ in range(rng.randint(0, 12))) for _ in range(rng.randint(1, 6))]
+        return '\n'.join(lines)
+
+    pairs = [(note(), note()) for _ in range(300)]
+    expected = reference_scores(pairs)
+    # one scorer for every pair, with the token cache shared between them as in a run
+    scores = native_scores(pairs)
+    for rouge_type in ROUGE_TYPES:
+        assert scores[rouge_type] == pytest.approx(expected[rouge_type], abs=1e-12), rouge_type